@@ -0,0 +1,118 @@
+# util/catalog.py against walking the recordings tree
+#
+# builds `--recordings` recordings (sidecar and empty parts) under `{plugin}/{author}/%Y-%m`, imports them with
+# 1 and `--workers` threads, then answers "all recordings of an author in a month" and "the parts of a stream id"
+# from the catalog and by walking the tree and reading the sidecars.
+#
+# usage: python -m benchmark.catalog [--recordings 5000] [--parts 3] [--workers 8]
+
+import os
+import argparse
+import json
+import random
+import shutil
+import tempfile
+import time
+from datetime import datetime
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.catalog import Catalog, import_tree, read_sidecar
+
+
+def build_tree(root: str, count: int, parts: int, authors: int = 50) -> list:
+    """returns the metadata stacks"""
+    rng = random.Random(0)
+    stacks = []
+    for i in range(count):
+        author = f"author{i % authors}"
+        started = datetime(2024, rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23), rng.randint(0, 59))
+        stack = [
+            {
+                "plugin": "twitch",
+                "id": str(1000000 + i),
+                "author": author,
+                "category": "Just Chatting",
+                "title": f"stream {i}",
+                "timestamp": started.astimezone().strftime("%Y%m%dT%H%M%S%z"),
+                "datetime": started.strftime("%Y%m%d_%H%M%S"),
+            }
+        ]
+        dirpath = os.path.join(root, "twitch", author, started.strftime("%Y-%m"))
+        os.makedirs(dirpath, exist_ok=True)
+        base = os.path.join(dirpath, f"[{stack[0]['datetime']}][Just Chatting] stream {i} ({stack[0]['id']})")
+        with open(f"{base}.json", "w", encoding="utf8") as f:
+            json.dump(stack, f)
+        for part in range(1, parts + 1):
+            open(f"{base} part{part}.ts", "wb").close()
+        stacks.append(stack)
+    return stacks
+
+
+def walk_query(root: str, author: str, since: float, until: float, stream_id: str) -> tuple:
+    """what answering the questions took without the catalog"""
+    month, parts = [], []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+            stack = read_sidecar(os.path.join(dirpath, filename))
+            if not stack:
+                continue
+            started_at = datetime.strptime(stack[0]["timestamp"], "%Y%m%dT%H%M%S%z").timestamp()
+            if stack[0]["author"] == author and since <= started_at < until:
+                month.append(filename)
+            if any(record["id"] == stream_id for record in stack):
+                base = filename[: -len(".json")]
+                parts += [name for name in filenames if name.startswith(base) and name.endswith(".ts")]
+    return len(month), len(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recordings", type=int, default=5000)
+    parser.add_argument("--parts", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="catalog-")
+    try:
+        data_dir = os.path.join(root, "data")
+        build_tree(data_dir, args.recordings, args.parts)
+
+        for workers in (1, args.workers):
+            catalog_filepath = os.path.join(root, f"catalog-{workers}.sqlite3")
+            result = import_tree(Catalog(catalog_filepath), data_dir, workers)
+            print(json.dumps({"import_workers": workers, **result}))
+
+        catalog = Catalog(catalog_filepath)
+        author, stream_id = "author7", str(1000000 + args.recordings // 2)
+        since, until = datetime(2024, 9, 1).timestamp(), datetime(2024, 10, 1).timestamp()
+
+        started_at = time.perf_counter()
+        month = catalog.query(author=author, since=since, until=until)
+        parts = sum(len(recording["segments"]) for recording in catalog.query(stream_id=stream_id))
+        catalog_seconds = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        walk_month, walk_parts = walk_query(data_dir, author, since, until, stream_id)
+        walk_seconds = time.perf_counter() - started_at
+
+        print(
+            json.dumps(
+                {
+                    "author_month": len(month),
+                    "stream_parts": parts,
+                    "same_answer": (len(month), parts) == (walk_month, walk_parts),
+                    "catalog_ms": round(catalog_seconds * 1000, 3),
+                    "walk_ms": round(walk_seconds * 1000, 3),
+                }
+            )
+        )
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+# util/notifier.py against a local discord webhook stub
+#
+# the stub accepts `--limit` requests per `--window` seconds and answers 429 with `retry_after` after that,
+# like discord's webhook rate limit. it counts requests that ignored `retry_after`.
+#
+# scenarios:
+# - burst: many channels go live at once. messages are coalesced into few requests
+# - rate limit: messages too long to be joined, every one is a request. all of them arrive without ignoring
+#   retry_after
+# - slow webhook: notify() does not wait for the webhook
+# - dedupe: the same stream id is sent once, also after a restart. one that could not be sent is sent after a restart
+#
+# exits with 1 if a scenario fails.
+#
+# usage: python -m benchmark.discord_notifier [--messages 30] [--limit 5] [--window 2]
+
+import os
+import argparse
+import json
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.notifier import DiscordNotifier, SentStore
+
+
+class DiscordStub:
+    def __init__(self, limit: int = 5, window: float = 2.0, delay: float = 0) -> None:
+        self.limit = limit
+        self.window = window
+        self.delay = delay
+
+        self.lock = threading.Lock()
+        self.contents: List[str] = []
+        self.requests = 0
+        self.rate_limited = 0
+        self.early_requests = 0
+        self.window_started_at = 0.0
+        self.window_requests = 0
+        self.blocked_until = 0.0
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.create_handler())
+        self.server.daemon_threads = True
+        thread = threading.Thread(target=self.server.serve_forever, name="discord-stub")
+        thread.daemon = True
+        thread.start()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/api/webhooks/0/token"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, content: str) -> tuple:
+        """(status, body)"""
+        now = time.monotonic()
+        with self.lock:
+            self.requests += 1
+            if now < self.blocked_until:
+                self.early_requests += 1
+            if now - self.window_started_at >= self.window:
+                self.window_started_at = now
+                self.window_requests = 0
+            if self.window_requests >= self.limit:
+                retry_after = self.window - (now - self.window_started_at)
+                self.blocked_until = max(self.blocked_until, now + retry_after)
+                self.rate_limited += 1
+                return 429, {"message": "You are being rate limited.", "retry_after": retry_after, "global": False}
+            self.window_requests += 1
+            self.contents.append(content)
+            return 204, None
+
+    def create_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):  # pylint: disable=invalid-name
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                if stub.delay:
+                    time.sleep(stub.delay)
+                status, response = stub.handle(body.get("content", ""))
+                data = json.dumps(response).encode("utf8") if response else b""
+                self.send_response(status)
+                if data:
+                    self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        return Handler
+
+
+def delivered_lines(stub: DiscordStub) -> List[str]:
+    return [line for content in stub.contents for line in content.split("\n")]
+
+
+def notify_all(notifier: DiscordNotifier, messages: List[str]) -> float:
+    """the longest notify() call in seconds"""
+    worst = 0.0
+    for message in messages:
+        started_at = time.perf_counter()
+        notifier.notify(message)
+        worst = max(worst, time.perf_counter() - started_at)
+    return worst
+
+
+def run_burst(count: int, limit: int, window: float) -> dict:
+    stub = DiscordStub(limit, window)
+    notifier = DiscordNotifier(stub.url, coalesce_window=0.5)
+    notifier.start()
+    messages = [f"[ON][channel{i}] stream {i}" for i in range(count)]
+    worst_notify = notify_all(notifier, messages)
+    started_at = time.monotonic()
+    notifier.flush(60)
+    flush_seconds = time.monotonic() - started_at
+    stub.stop()
+    return {
+        "scenario": "burst",
+        "messages": count,
+        "requests": stub.requests,
+        "delivered": len(delivered_lines(stub)),
+        "flush_seconds": round(flush_seconds, 3),
+        "worst_notify_ms": round(worst_notify * 1000, 3),
+        "passed": sorted(delivered_lines(stub)) == sorted(messages) and stub.requests < count,
+    }
+
+
+def run_rate_limit(count: int, limit: int, window: float) -> dict:
+    stub = DiscordStub(limit, window)
+    notifier = DiscordNotifier(stub.url, coalesce_window=0, max_attempts=count)
+    notifier.start()
+    # no two of them fit into one discord message
+    messages = [f"[ON][channel{i}] " + "x" * 1200 for i in range(count)]
+    notify_all(notifier, messages)
+    notifier.flush(120)
+    stub.stop()
+    return {
+        "scenario": "rate_limit",
+        "messages": count,
+        "requests": stub.requests,
+        "rate_limited": stub.rate_limited,
+        "early_requests": stub.early_requests,
+        "delivered": len(delivered_lines(stub)),
+        "passed": delivered_lines(stub) == messages and stub.early_requests == 0,
+    }
+
+
+def run_slow_webhook(count: int) -> dict:
+    stub = DiscordStub(limit=1000, delay=3)
+    notifier = DiscordNotifier(stub.url, coalesce_window=0)
+    notifier.start()
+    worst_notify = notify_all(notifier, [f"[ON][channel{i}] stream {i}" for i in range(count)])
+    notifier.flush(30)
+    stub.stop()
+    return {
+        "scenario": "slow_webhook",
+        "worst_notify_ms": round(worst_notify * 1000, 3),
+        "passed": worst_notify < 0.1,
+    }
+
+
+def run_dedupe() -> dict:
+    stub = DiscordStub(limit=1000)
+    sent_filepath = os.path.join(tempfile.mkdtemp(prefix="discord-"), "sent.json")
+
+    # nothing listens there. the message fails and its key is not marked as sent
+    notifier = DiscordNotifier("http://127.0.0.1:9/webhook", sent_store=SentStore(sent_filepath), max_attempts=1)
+    notifier.start()
+    results = [notifier.notify("[ON] stream a", kind="ON", key="a")]
+    notifier.flush(10)
+    for _ in range(2):
+        # a restart reads the same file
+        notifier = DiscordNotifier(stub.url, sent_store=SentStore(sent_filepath), coalesce_window=0)
+        notifier.start()
+        results.append(notifier.notify("[ON] stream a", kind="ON", key="a"))
+        results.append(notifier.notify("[ON] stream a", kind="ON", key="a"))
+        notifier.flush(10)
+    stub.stop()
+    return {
+        "scenario": "dedupe",
+        "notify_results": results,
+        "delivered": len(stub.contents),
+        "passed": results == [True, True, False, False, False] and len(stub.contents) == 1,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=30)
+    parser.add_argument("--limit", type=int, default=5, help="requests per window before 429")
+    parser.add_argument("--window", type=float, default=2)
+    args = parser.parse_args()
+
+    results = [
+        run_burst(args.messages, args.limit, args.window),
+        run_rate_limit(args.messages, args.limit, args.window),
+        run_slow_webhook(args.messages),
+        run_dedupe(),
+    ]
+    for result in results:
+        print(json.dumps(result))
+    sys.exit(0 if all(result["passed"] for result in results) else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# write N channels at once with each segment write mode of util/segment_writer.py
+#
+# every channel is a thread that writes `--size` MiB in chunks like the ones the fetcher hands to the
+# native muxer, optionally paced to `--bitrate` Mbit/s. reports the throughput including the final writeback
+# (os.sync), the slowest write() calls, and the fragmentation of the files (extents, from `filefrag`).
+#
+# usage: python -m benchmark.disk_write [--channels 8] [--size 64] [--bitrate 0] [--dir /data/benchmark]
+
+import os
+import argparse
+import json
+import random
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from typing import Callable, List
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.segment_writer import create_segment_file_opener
+
+
+def open_default(filepath: str):
+    # what TSSegmenter opens without a writer
+    return open(filepath, "wb", buffering=1024 * 1024)
+
+
+def write_channel(open_file: Callable, filepath: str, size: int, bitrate: float, latencies: List[float]):
+    rng = random.Random(filepath)
+    chunk = os.urandom(1024 * 1024)
+    file = open_file(filepath)
+    started_at = time.monotonic()
+    written = 0
+    while written < size:
+        # the fetcher hands over whatever arrived, in whole packets
+        length = min(188 * rng.randint(64, 1400), size - written)
+        write_started_at = time.perf_counter()
+        file.write(chunk[:length])
+        latencies.append(time.perf_counter() - write_started_at)
+        written += length
+        if bitrate:
+            delay = started_at + written / bitrate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    file.close()
+
+
+def count_extents(filepath: str) -> int:
+    try:
+        output = subprocess.run(["filefrag", filepath], capture_output=True, check=True, text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return -1
+    match = re.search(r"(\d+) extents? found", output)
+    return int(match.group(1)) if match else -1
+
+
+def run(mode: str, open_file: Callable, dirpath: str, channels: int, size: int, bitrate: float) -> dict:
+    os.makedirs(dirpath, exist_ok=True)
+    filepaths = [os.path.join(dirpath, f"channel{i} part1.ts") for i in range(channels)]
+    latencies: List[float] = []
+    threads = [
+        threading.Thread(target=write_channel, args=(open_file, filepath, size, bitrate, latencies))
+        for filepath in filepaths
+    ]
+    started_at = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    written_at = time.monotonic()
+    os.sync()
+    elapsed = time.monotonic() - started_at
+
+    latencies.sort()
+    extents = [count_extents(filepath) for filepath in filepaths]
+    return {
+        "mode": mode,
+        "channels": channels,
+        "mib_per_channel": size / 1024 / 1024,
+        "write_seconds": round(written_at - started_at, 3),
+        "sync_seconds": round(elapsed - (written_at - started_at), 3),
+        "mib_per_second": round(channels * size / 1024 / 1024 / elapsed, 1),
+        "write_p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+        "write_max_ms": round(latencies[-1] * 1000, 3),
+        "extents_per_file": round(sum(extents) / len(extents), 1),
+        "file_sizes_ok": all(os.path.getsize(filepath) == size for filepath in filepaths),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=8)
+    parser.add_argument("--size", type=int, default=64, help="MiB per channel")
+    parser.add_argument("--bitrate", type=float, default=0, help="Mbit/s per channel. 0 writes as fast as possible")
+    parser.add_argument("--segment-minutes", type=float, default=60)
+    parser.add_argument("--fsync-interval", type=float, default=5)
+    parser.add_argument("--dir", default=None, help="a directory on the disk to test. a temporary one by default")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    bitrate = args.bitrate * 1000 * 1000 / 8
+    # preallocation is sized for the real bitrate even if the benchmark runs unpaced
+    expected_bitrate = bitrate or 10 * 1000 * 1000 / 8
+    modes = {
+        "default": open_default,
+        "preallocate": create_segment_file_opener(
+            bitrate=expected_bitrate,
+            segment_duration=args.segment_minutes * 60,
+            max_preallocate_size=256 * 1024 * 1024,
+        ),
+        "preallocate+fsync": create_segment_file_opener(
+            bitrate=expected_bitrate,
+            segment_duration=args.segment_minutes * 60,
+            max_preallocate_size=256 * 1024 * 1024,
+            fsync_interval=args.fsync_interval,
+        ),
+    }
+
+    root = tempfile.mkdtemp(prefix="disk-write-", dir=args.dir)
+    try:
+        for mode, open_file in modes.items():
+            print(json.dumps(run(mode, open_file, os.path.join(root, mode), args.channels, size, bitrate)))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# record benchmark/fake_hls.py through a cdn outage with and without STREAM_FAILOVER
+#
+# segment requests fail with 503 for `--outage` seconds in the middle of the recording. reports the bytes
+# written, the holes in the output (found by the pts of the video frames) and the failover stats.
+# exits with 1 if the failover recording has a hole.
+#
+# usage: python -m benchmark.failover [--duration 30] [--outage 6] [--segment-duration 2]
+
+import os
+import argparse
+import json
+import sys
+import time
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+import util.stream
+from util.failover import FailoverFetcher
+from util.stream_fetch import StreamFetcher
+from util.ts_segmenter import PACKET_SIZE, SYNC_BYTE, get_payload_offset
+from benchmark.fake_hls import FakeHLSServer, PLUGIN_DIR
+from benchmark.ts_fixture import FPS, VIDEO_PID
+
+
+class HoleChecker:
+    """finds holes in a written mpeg-ts stream of benchmark/ts_fixture.py by the pts of its video frames"""
+
+    def __init__(self, pid: int = VIDEO_PID, fps: int = FPS) -> None:
+        self.pid = pid
+        self.frame_duration = 90000 // fps
+        self.remainder = b""
+        self.pts = None
+        self.holes = 0
+        self.missing_seconds = 0.0
+        self.size = 0
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        self.remainder += data
+        end = len(self.remainder) - len(self.remainder) % PACKET_SIZE
+        for offset in range(0, end, PACKET_SIZE):
+            packet = self.remainder[offset : offset + PACKET_SIZE]
+            if packet[0] != SYNC_BYTE or ((packet[1] & 0x1F) << 8 | packet[2]) != self.pid or not packet[1] & 0x40:
+                continue
+            payload_offset = get_payload_offset(packet)
+            if payload_offset is None:
+                continue
+            timestamp = packet[payload_offset + 9 : payload_offset + 14]
+            pts = (
+                ((timestamp[0] >> 1) & 0x07) << 30
+                | timestamp[1] << 22
+                | (timestamp[2] >> 1) << 15
+                | timestamp[3] << 7
+                | timestamp[4] >> 1
+            )
+            self.on_pts(pts)
+        self.remainder = self.remainder[end:]
+
+    def on_pts(self, pts: int):
+        if self.pts is not None and pts - self.pts > self.frame_duration * 1.5:
+            self.holes += 1
+            self.missing_seconds += (pts - self.pts - self.frame_duration) / 90000
+        self.pts = pts
+
+    def close(self):
+        pass
+
+
+def record(server: FakeHLSServer, use_failover: bool, duration: float, outage: float) -> dict:
+    checker = HoleChecker()
+    if use_failover:
+        fetcher = FailoverFetcher(server.url, "best", f"--plugin-dirs={PLUGIN_DIR}", stall_timeout=5, gap_timeout=10)
+        fetcher.open()
+    else:
+        fetcher = StreamFetcher(server.url, "best", f"--plugin-dirs={PLUGIN_DIR}")
+        fetcher.open()
+    thread = fetcher.start_pump_thread(checker)
+
+    time.sleep(duration / 3)
+    server.fail_segments(outage)
+    time.sleep(duration * 2 / 3)
+    fetcher.close()
+    thread.join(timeout=30)
+
+    result = {
+        "failover": use_failover,
+        "bytes": checker.size,
+        "holes": checker.holes,
+        "missing_seconds": round(checker.missing_seconds, 3),
+    }
+    if use_failover:
+        result.update(fetcher.get_stats())
+        del result["pipelines"]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--outage", type=float, default=6)
+    parser.add_argument("--segment-duration", type=float, default=2)
+    args = parser.parse_args()
+
+    util.stream.SIDELOADED_PLUGIN_DIRS.append(PLUGIN_DIR)
+    util.stream.preload_streamlink_cli()
+
+    failed = False
+    for use_failover in (False, True):
+        server = FakeHLSServer(segment_duration=args.segment_duration, window=6)
+        server.start()
+        server.go_online()
+        result = record(server, use_failover, args.duration, args.outage)
+        result["failed_requests"] = server.failed_requests
+        print(json.dumps(result))
+        server.stop()
+        failed = failed or (use_failover and result["holes"] > 0)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
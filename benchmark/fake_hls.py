@@ -0,0 +1,186 @@
+# a local live hls server for the benchmarks
+#
+# serves a sliding live playlist made of generated mpeg-ts segments (see ts_fixture.py), and a status page
+# which the `fakehls` streamlink plugin (benchmark/plugins/fakehls.py) reads as the channel metadata.
+#
+#   /status.json   {"online": true, "id": ..., "author": ..., "category": ..., "title": ...}
+#   /live.m3u8     the last `window` segments. media sequence numbers follow the wall clock
+#   /<n>.ts        segment n
+#
+# `fail_segments()` makes segment requests fail with 503 for a while, like a cdn error.
+# `end_playlist()` ends the playlist once (#EXT-X-ENDLIST) while the broadcast goes on, which makes the client
+# stop and start again, like a dropped edge server.
+
+import os
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from benchmark.ts_fixture import TSFixture
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plugins")
+
+
+class FakeHLSServer:
+    def __init__(
+        self,
+        segment_duration: float = 2.0,
+        window: int = 4,
+        bitrate: int = 2_000_000,
+        host: str = "127.0.0.1",
+        port: int = 0,
+    ) -> None:
+        self.segment_duration = segment_duration
+        self.window = window
+        self.fixture = TSFixture(bitrate, segment_duration)
+
+        self.lock = threading.Lock()
+        self.segments: Dict[int, bytes] = {}
+        self.next_sequence = 0
+        self.online_at: Optional[float] = None
+        self.broadcast_id = 0
+        self.title = "fake broadcast"
+        self.fail_until = 0.0
+        self.is_ending = False
+        self.requests = 0
+        self.failed_requests = 0
+
+        self.server = ThreadingHTTPServer((host, port), self.create_handler())
+        self.server.daemon_threads = True
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"{host}:{port}"
+
+    @property
+    def url(self) -> str:
+        """the url for streamlink. needs `PLUGIN_DIR` in the plugin dirs"""
+        return f"fakehls://{self.base_url}/channel"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="fake-hls")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def go_online(self, title: Optional[str] = None):
+        with self.lock:
+            self.online_at = time.monotonic()
+            self.broadcast_id += 1
+            self.segments = {}
+            self.next_sequence = 0
+            self.fixture = TSFixture(self.fixture.bitrate, self.segment_duration)
+            if title:
+                self.title = title
+
+    def go_offline(self):
+        with self.lock:
+            self.online_at = None
+
+    def fail_segments(self, duration: float):
+        """segment requests fail with 503 for `duration` seconds"""
+        self.fail_until = time.monotonic() + duration
+
+    def end_playlist(self):
+        """the next playlist response ends the stream. the broadcast and its timestamps continue"""
+        self.is_ending = True
+
+    def get_live_sequence(self) -> Optional[int]:
+        """the newest available media sequence number"""
+        if self.online_at is None:
+            return None
+        return int((time.monotonic() - self.online_at) / self.segment_duration)
+
+    def get_segment(self, sequence: int) -> Optional[bytes]:
+        with self.lock:
+            live_sequence = self.get_live_sequence()
+            if live_sequence is None or sequence > live_sequence or sequence < live_sequence - self.window * 2:
+                return None
+            # segments are generated in order so the timestamps and continuity counters continue
+            self.next_sequence = max(self.next_sequence, live_sequence - self.window * 2)
+            while self.next_sequence <= sequence:
+                self.segments[self.next_sequence] = self.fixture.generate(self.segment_duration)
+                self.segments.pop(self.next_sequence - self.window * 3, None)
+                self.next_sequence += 1
+            return self.segments.get(sequence)
+
+    def get_playlist(self) -> Optional[str]:
+        live_sequence = self.get_live_sequence()
+        if live_sequence is None:
+            return None
+        first_sequence = max(live_sequence - self.window + 1, 0)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            f"#EXT-X-TARGETDURATION:{int(self.segment_duration + 0.999)}",
+            f"#EXT-X-MEDIA-SEQUENCE:{first_sequence}",
+        ]
+        for sequence in range(first_sequence, live_sequence + 1):
+            lines += [f"#EXTINF:{self.segment_duration:.3f},", f"{sequence}.ts"]
+        if self.is_ending:
+            self.is_ending = False
+            lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def get_status(self) -> dict:
+        if self.online_at is None:
+            return {"online": False}
+        return {
+            "online": True,
+            "id": f"broadcast-{self.broadcast_id}",
+            "author": "fakehls",
+            "category": "benchmark",
+            "title": self.title,
+        }
+
+    def create_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def send_body(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                server.requests += 1
+                path = self.path.split("?")[0]
+                if path == "/status.json":
+                    self.send_body(json.dumps(server.get_status()).encode("utf8"), "application/json")
+                    return
+                if path == "/live.m3u8":
+                    playlist = server.get_playlist()
+                    if playlist is None:
+                        self.send_error(404)
+                        return
+                    self.send_body(playlist.encode("utf8"), "application/vnd.apple.mpegurl")
+                    return
+                if path.endswith(".ts"):
+                    if time.monotonic() < server.fail_until:
+                        server.failed_requests += 1
+                        self.send_error(503)
+                        return
+                    try:
+                        segment = server.get_segment(int(path[1:-3]))
+                    except ValueError:
+                        segment = None
+                    if segment is None:
+                        self.send_error(404)
+                        return
+                    self.send_body(segment, "video/mp2t")
+                    return
+                self.send_error(404)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        return Handler
@@ -0,0 +1,95 @@
+# compare logging from the calling thread with the queue + listener thread in util/logger.py
+#
+# reports records/s and the longest time one log call blocked the caller.
+# `--stall-ms` simulates a slow /log volume: every `--stall-every`th write to the file takes that long.
+#
+# usage: python -m benchmark.logger [--count N] [--threads N] [--stall-ms MS] [--stall-every N]
+
+import os
+import argparse
+import json
+import threading
+import time
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position,protected-access
+import util.logger
+from util.logger import get_logger
+
+
+def slow_down(handler, stall_ms: float, stall_every: int):
+    emit = handler.emit
+    count = 0
+
+    def slow_emit(record):
+        nonlocal count
+        count += 1
+        if stall_ms and count % stall_every == 0:
+            time.sleep(stall_ms / 1000)
+        emit(record)
+
+    handler.emit = slow_emit
+
+
+def create_logger(use_queue: bool, stall_ms: float, stall_every: int):
+    name = "benchmark-queue" if use_queue else "benchmark-sync"
+    logger = get_logger(name, use_queue=use_queue)
+    handlers = util.logger._DISPATCH_HANDLER.handlers[name] if use_queue else logger.handlers
+    [stream_handler, file_handler] = handlers
+    # keep the console quiet. the file is what is measured
+    stream_handler.setStream(open(os.devnull, "w", encoding="utf8"))
+    slow_down(file_handler, stall_ms, stall_every)
+    return logger
+
+
+def measure(use_queue: bool, count: int, threads: int, stall_ms: float, stall_every: int) -> dict:
+    logger = create_logger(use_queue, stall_ms, stall_every)
+    worst_stalls = [0.0] * threads
+
+    def run(index: int):
+        worst = 0.0
+        for i in range(count):
+            started_at = time.perf_counter()
+            logger.info("frame=%d fps=60 size=%dkB time=00:00:00 bitrate=6000kbits/s speed=1x", i, i * 4)
+            worst = max(worst, time.perf_counter() - started_at)
+        worst_stalls[index] = worst
+
+    started_at = time.perf_counter()
+    workers = [threading.Thread(target=run, args=(index,)) for index in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started_at
+
+    result = {
+        "mode": "queue" if use_queue else "sync",
+        "records": count * threads,
+        "caller_records_per_second": round(count * threads / elapsed),
+        "worst_stall_ms": round(max(worst_stalls) * 1000, 3),
+    }
+    if use_queue:
+        # until the listener wrote everything
+        while not util.logger._LOG_QUEUE.empty():
+            time.sleep(0.01)
+        elapsed = time.perf_counter() - started_at
+        result["written_records_per_second"] = round(count * threads / elapsed)
+        result["dropped"] = sum(handler.dropped_total for handler in logger.handlers)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=20000, help="records per thread")
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--stall-ms", type=float, default=200)
+    parser.add_argument("--stall-every", type=int, default=5000)
+    args = parser.parse_args()
+
+    for use_queue in (False, True):
+        print(json.dumps(measure(use_queue, args.count, args.threads, args.stall_ms, args.stall_every)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+# memory of the metadata history over a long broadcast, before and after util/metadata_history.py
+#
+# simulates `--hours` of one broadcast probed every `--probe-interval` seconds, with a bot changing the title every
+# `--change-interval` seconds. every probe returns a new stream_info like `streamlink --json` of twitch (all
+# variants with their urls and headers). the old history kept a dict and the raw stream_info per change. reports
+# the memory kept by the history (tracemalloc), the time of one export of the whole history as json at the end
+# (the `.json` file is written like that on every change) and the time of one read of the current metadata.
+# exits with 1 if the bounded history keeps as much memory as the old one.
+#
+# usage: python -m benchmark.metadata_history [--hours 72] [--probe-interval 15] [--change-interval 60]
+
+import os
+import argparse
+import gc
+import json
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+from datetime import datetime, timezone
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.logger import main_logger
+from util.probe_scheduler import ProbeScheduler
+from util.stream_metadata import StreamMetadata, parse_metadata_from_stream_info
+
+VARIANTS = ["audio_only", "160p", "360p", "480p", "720p60", "1080p60", "worst", "best"]
+# a usher token is about this long
+TOKEN = "x" * 700
+
+
+def create_stream_info(title: str, probe: int) -> dict:
+    """a new object every time, like json.loads of the probe output"""
+    streams = {}
+    for variant in VARIANTS:
+        streams[variant] = {
+            "type": "hls",
+            "url": f"https://video-weaver.sel03.hls.ttvnw.net/v1/playlist/{variant}-{probe}.m3u8?token={TOKEN}",
+            "headers": {
+                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/126.0",
+                "Accept": "*/*",
+                "Accept-Encoding": "gzip, deflate",
+                "Connection": "keep-alive",
+            },
+            "master": f"https://usher.ttvnw.net/api/channel/hls/author.m3u8?sig={probe:040d}&token={TOKEN}",
+        }
+    return json.loads(
+        json.dumps(
+            {
+                "plugin": "twitch",
+                "metadata": {"id": "40000000001", "author": "author", "category": "Just Chatting", "title": title},
+                "streams": streams,
+            }
+        )
+    )
+
+
+class LegacyHistory:
+    """the history before util/metadata_history.py"""
+
+    def __init__(self) -> None:
+        self.stack = []
+        self.stack_raw = []
+
+    def update(self, stream_info: dict) -> bool:
+        plugin, metadata_id, author, category, title = parse_metadata_from_stream_info(stream_info)
+        if self.stack:
+            latest = self.stack[-1]
+            if (latest["plugin"], latest["id"], latest["author"], latest["category"], latest["title"]) == (
+                plugin,
+                metadata_id,
+                author,
+                category,
+                title,
+            ):
+                return False
+        self.stack_raw.append(stream_info)
+        self.stack.append(
+            {
+                "plugin": plugin,
+                "id": metadata_id,
+                "author": author,
+                "category": category,
+                "title": title,
+                "timestamp": datetime.now(timezone.utc).astimezone().strftime("%Y%m%dT%H%M%S%z"),
+                "datetime": datetime.now().strftime("%Y%m%d_%H%M%S"),
+            }
+        )
+        return True
+
+    def export(self) -> str:
+        return json.dumps(deepcopy(self.stack), ensure_ascii=False, indent=2)
+
+    def get_current_metadata(self) -> dict:
+        return deepcopy(self.stack[-1])
+
+
+class SimulatedStreamMetadata(StreamMetadata):
+    """probes return `stream_info` instead of running streamlink. the probe thread is not used"""
+
+    stream_info: dict = {}
+
+    def set_metadata_loop(self):
+        pass
+
+    def probe(self) -> dict:
+        return self.stream_info
+
+
+class History:
+    """util/metadata_history.py through StreamMetadata.update_metadata"""
+
+    def __init__(self, max_history: int) -> None:
+        self.store = SimulatedStreamMetadata(
+            "https://www.twitch.tv/author", "", 15, scheduler=ProbeScheduler(15), max_history=max_history
+        )
+        self.store.thread.join()
+
+    def update(self, stream_info: dict) -> bool:
+        count = self.store.history.count
+        self.store.stream_info = stream_info
+        self.store.update_metadata()
+        return self.store.history.count > count
+
+    def export(self) -> str:
+        return json.dumps(self.store.history.to_list(), ensure_ascii=False, indent=2)
+
+    def get_current_metadata(self) -> dict:
+        return self.store.get_current_metadata()
+
+
+def run(name: str, create_history, args) -> dict:
+    probes = int(args.hours * 3600 / args.probe_interval)
+    changes_per_probe = args.change_interval / args.probe_interval
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    history = create_history()
+
+    changes = 0
+    for probe in range(probes):
+        title = f"!bot title {int(probe / changes_per_probe)}"
+        changes += history.update(create_stream_info(title, probe))
+    gc.collect()
+    kept = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    started_at = time.perf_counter()
+    history.export()
+    export_ms = (time.perf_counter() - started_at) * 1000
+
+    started_at = time.perf_counter()
+    for _ in range(args.reads):
+        history.get_current_metadata()
+    read_us = (time.perf_counter() - started_at) / args.reads * 1000000
+
+    result = {
+        "history": name,
+        "probes": probes,
+        "changes": changes,
+        "kept_mib": round(kept / 1024 / 1024, 2),
+        "export_ms": round(export_ms, 2),
+        "read_us": round(read_us, 2),
+    }
+    if isinstance(history, History):
+        started_at = time.perf_counter()
+        for _ in range(args.reads):
+            history.store.get_current_record()
+        result["record_read_us"] = round((time.perf_counter() - started_at) / args.reads * 1000000, 3)
+        result["records_kept"] = len(history.store.history)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=72)
+    parser.add_argument("--probe-interval", type=float, default=15)
+    parser.add_argument("--change-interval", type=float, default=60)
+    parser.add_argument("--max-history", type=int, default=1000)
+    parser.add_argument("--reads", type=int, default=10000)
+    args = parser.parse_args()
+
+    # a log line per change
+    main_logger.disabled = True
+    results = [
+        run("legacy", LegacyHistory, args),
+        run("unbounded", lambda: History(0), args),
+        run(f"bounded-{args.max_history}", lambda: History(args.max_history), args),
+    ]
+    for result in results:
+        print(json.dumps(result))
+    sys.exit(1 if results[2]["kept_mib"] >= results[0]["kept_mib"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# compare `chown -R` of the output directory on every recording start with util/ownership.py
+#
+# builds `--files` files under `{plugin}/{author}/%Y-%m`-like directories and starts `--recordings`
+# recordings into the last one. the old way ran a shell with `sudo chown -R` each time; sudo is left out
+# here, so the old numbers are a lower bound.
+#
+# usage: python -m benchmark.ownership [--files 5000] [--recordings 20] [--owner 1000:1000]
+
+import os
+import argparse
+import json
+import shutil
+import tempfile
+import time
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.ownership import OwnershipManager
+
+
+def build_tree(root: str, count: int) -> str:
+    """returns the directory of the next recording"""
+    months = max(count // 500, 1)
+    for i in range(count):
+        dirpath = os.path.join(root, "twitch", "author", f"2024-{i % months + 1:02d}")
+        os.makedirs(dirpath, exist_ok=True)
+        with open(os.path.join(dirpath, f"recording {i}.ts"), "wb") as f:
+            f.write(b"\0" * 188)
+    return os.path.join(root, "twitch", "author", f"2024-{months:02d}")
+
+
+def run_recursive(dirpath: str, owner: str, recordings: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(recordings):
+        os.makedirs(dirpath, exist_ok=True)
+        os.system(f'chown -R {owner} "{dirpath}"')
+    return time.perf_counter() - started_at
+
+
+def run_manager(dirpath: str, owner: str, recordings: int) -> tuple:
+    manager = OwnershipManager(owner)
+    started_at = time.perf_counter()
+    for i in range(recordings):
+        manager.makedirs(dirpath)
+        manager.chown_file(os.path.join(dirpath, f"recording {i}.ts"))
+    return time.perf_counter() - started_at, manager
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--recordings", type=int, default=20)
+    parser.add_argument("--owner", default=f"{os.geteuid()}:{os.getegid()}", help="uid:gid")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="ownership-")
+    try:
+        dirpath = build_tree(root, args.files)
+        recursive_seconds = run_recursive(dirpath, args.owner, args.recordings)
+
+        # a new month: the directory does not exist yet
+        new_dirpath = os.path.join(os.path.dirname(dirpath), "2099-01")
+        manager_seconds, manager = run_manager(new_dirpath, args.owner, args.recordings)
+        print(
+            json.dumps(
+                {
+                    "files": args.files,
+                    "recordings": args.recordings,
+                    "owner": args.owner,
+                    "is_needed": manager.is_needed,
+                    "chown_recursive_ms": round(recursive_seconds * 1000, 3),
+                    "ownership_manager_ms": round(manager_seconds * 1000, 3),
+                    "saved_ms_per_recording": round((recursive_seconds - manager_seconds) * 1000 / args.recordings, 3),
+                    **manager.get_stats(),
+                }
+            )
+        )
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+# stream_info payloads shaped like `streamlink --json` output of twitch and chzzk
+
+import random
+import string
+
+
+def random_token(size: int) -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=size))
+
+
+def hls_stream(url: str, master: str, headers: dict) -> dict:
+    return {"type": "hls", "url": url, "master": master, "headers": dict(headers)}
+
+
+def twitch_stream_info(title: str = "just chatting with everyone") -> dict:
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0.0.0 Safari/537.36",
+        "Accept-Encoding": "gzip, deflate",
+        "Accept": "*/*",
+        "Connection": "keep-alive",
+        "Client-ID": random_token(30),
+        "Device-ID": random_token(32),
+    }
+    master = f"https://usher.ttvnw.net/api/channel/hls/channel.m3u8?sig={random_token(40)}&token={random_token(900)}"
+    names = ["audio_only", "160p", "360p", "480p", "720p60", "1080p60", "worst", "best"]
+    return {
+        "plugin": "twitch",
+        "metadata": {"id": "41298321545", "author": "channel", "category": "Just Chatting", "title": title},
+        "streams": {
+            name: hls_stream(
+                f"https://video-weaver.sel03.hls.ttvnw.net/v1/playlist/{random_token(1200)}.m3u8", master, headers
+            )
+            for name in names
+        },
+    }
+
+
+def chzzk_stream_info(title: str = "방송 제목") -> dict:
+    headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 Chrome/120.0.0.0 Safari/537.36",
+        "Accept-Encoding": "gzip, deflate",
+        "Accept": "*/*",
+        "Connection": "keep-alive",
+        "Referer": "https://chzzk.naver.com/",
+        "Cookie": f"NID_AUT={random_token(64)}; NID_SES={random_token(400)}",
+    }
+    base_url = "https://livecloud.pstatic.net/chzzk/lip2_kr"
+    master = f"{base_url}/cflexnmss2u0007/{random_token(60)}/hls_playlist.m3u8?hdnts={random_token(300)}"
+    names = ["144p", "360p", "480p", "720p", "1080p", "worst", "best"]
+    return {
+        "plugin": "chzzk",
+        "metadata": {"id": "7d4157ae4fddab134243704cab847f23", "author": "채널", "category": "talk", "title": title},
+        "streams": {
+            name: hls_stream(
+                f"{base_url}/{random_token(60)}/{name}/hdntl={random_token(600)}/chunklist.m3u8",
+                master,
+                headers,
+            )
+            for name in names
+        },
+    }
@@ -0,0 +1,374 @@
+# the whole recorder against N channels of benchmark/fake_hls.py, without network
+#
+# the origins run in a child process (`--origin`), so their cpu and memory are not measured. every channel is
+# online for `--online` seconds and offline for `--offline` seconds, shifted by `--stagger` seconds per channel.
+# while online, the playlist ends every `--restart-every` seconds (FakeHLSServer.end_playlist) and the recording
+# restarts. the recorder runs in this process through supervisor_loop. with `--probe-engine subprocess` the online
+# checks read the `streamlink --json` output of the fakehls plugin, like with a real site.
+#
+# prints one json line per channel and a summary: cpu, rss and threads of the recorder (its streamlink and ffmpeg
+# processes included), time to first byte, throughput, and the bytes lost across restarts (holes in the pts of
+# the recordings). `--save` writes the summary. `--baseline` compares with a saved summary and exits with 1 on a
+# regression. also exits with 1 if a channel recorded nothing.
+#
+# usage: python -m benchmark.pipeline [--mode native-inprocess] [--channels 4] [--duration 60] [--baseline FILE]
+
+import os
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from benchmark.failover import HoleChecker
+from benchmark.time_to_first_byte import MODES, configure
+
+# metric: (1 if higher is worse, -1 if lower is worse, slack). a metric regresses if it is worse than the
+# baseline by more than `--tolerance` of the baseline plus the slack
+REGRESSION_CHECKS = {
+    "cpu_percent": (1, 5),
+    "rss_peak_mib": (1, 10),
+    "threads_peak": (1, 4),
+    "ttfb_max": (1, 1),
+    "missing_seconds": (1, 2),
+    "recorded_ratio": (-1, 0.02),
+}
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+MIB = 1024 * 1024
+
+
+def get_schedule(index: int, args) -> List[Tuple[float, float, List[float]]]:
+    """(online, offline, [restart, ...]) in seconds from the start, for the channel `index`"""
+    schedule = []
+    online_at = index * args.stagger
+    while online_at < args.duration:
+        offline_at = min(online_at + args.online, args.duration)
+        restarts = []
+        if args.restart_every:
+            restart_at = online_at + args.restart_every
+            while restart_at < offline_at - args.segment_duration:
+                restarts.append(restart_at)
+                restart_at += args.restart_every
+        schedule.append((online_at, offline_at, restarts))
+        online_at = offline_at + args.offline
+    return schedule
+
+
+def run_origins(args):
+    """the child process. serves the channels by the schedule until stdin is closed"""
+    from benchmark.fake_hls import FakeHLSServer  # pylint: disable=import-outside-toplevel
+
+    servers = [
+        FakeHLSServer(args.segment_duration, window=6, bitrate=int(args.bitrate * 1000 * 1000))
+        for _ in range(args.channels)
+    ]
+    events = []
+    for index, server in enumerate(servers):
+        server.start()
+        for online_at, offline_at, restarts in get_schedule(index, args):
+            events.append((online_at, index, "online"))
+            events += [(restart_at, index, "restart") for restart_at in restarts]
+            events.append((offline_at, index, "offline"))
+    print(json.dumps([server.url for server in servers]), flush=True)
+
+    started_at = time.monotonic()
+    for at, index, action in sorted(events):
+        delay = started_at + at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        if action == "online":
+            servers[index].go_online(f"channel{index}")
+        elif action == "restart":
+            servers[index].end_playlist()
+        else:
+            servers[index].go_offline()
+    sys.stdin.read()
+
+
+def read_proc_stat(pid: int) -> Tuple[int, float, int]:
+    """(parent pid, cpu seconds, rss bytes) of a process"""
+    with open(f"/proc/{pid}/stat", "r", encoding="utf8") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[1]), (int(fields[11]) + int(fields[12])) / CLOCK_TICKS, int(fields[21]) * PAGE_SIZE
+
+
+class ResourceSampler:
+    """cpu, rss and threads of this process and its children, except `excluded_pids`"""
+
+    def __init__(self, excluded_pids: List[int], interval: float = 0.5) -> None:
+        self.excluded_pids = set(excluded_pids)
+        self.interval = interval
+        self.started_at = time.monotonic()
+        self.started_cpu = sum(os.times()[:2])
+        # the last cpu seconds of every child. children that exited keep their last sample
+        self.children_cpu: Dict[int, float] = {}
+        self.rss: List[int] = []
+        self.threads: List[int] = []
+        self.processes: List[int] = []
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+
+    def get_descendants(self) -> List[int]:
+        parents = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            try:
+                parents[int(name)] = read_proc_stat(int(name))[0]
+            except (OSError, IndexError, ValueError):
+                continue
+        descendants, pids = [], [os.getpid()]
+        while pids:
+            children = [pid for pid, ppid in parents.items() if ppid in pids and pid not in self.excluded_pids]
+            descendants += children
+            pids = children
+        return descendants
+
+    def sample(self):
+        rss = read_proc_stat(os.getpid())[2]
+        children = self.get_descendants()
+        for pid in children:
+            try:
+                _, cpu, child_rss = read_proc_stat(pid)
+            except (OSError, IndexError, ValueError):
+                continue
+            self.children_cpu[pid] = cpu
+            rss += child_rss
+        self.rss.append(rss)
+        self.threads.append(threading.active_count())
+        self.processes.append(len(children))
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.sample()
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self) -> dict:
+        self.stop_event.set()
+        self.thread.join()
+        elapsed = time.monotonic() - self.started_at
+        cpu = sum(os.times()[:2]) - self.started_cpu + sum(self.children_cpu.values())
+        return {
+            "cpu_seconds": round(cpu, 2),
+            "cpu_percent": round(cpu / elapsed * 100, 1),
+            "rss_peak_mib": round(max(self.rss) / MIB, 1),
+            "rss_mean_mib": round(sum(self.rss) / len(self.rss) / MIB, 1),
+            "threads_peak": max(self.threads),
+            "threads_mean": round(sum(self.threads) / len(self.threads), 1),
+            "processes_peak": max(self.processes),
+        }
+
+
+class CoverageChecker(HoleChecker):
+    """also counts the frames written twice, by a restart that starts before the end of the last recording"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.first_pts = None
+        self.duplicate_seconds = 0.0
+
+    def on_pts(self, pts: int):
+        if self.pts is not None and pts <= self.pts:
+            self.duplicate_seconds += self.frame_duration / 90000
+            return
+        if self.first_pts is None:
+            self.first_pts = pts
+        super().on_pts(pts)
+
+    def get_covered_seconds(self) -> float:
+        """seconds of the broadcast in the recordings, once"""
+        if self.first_pts is None:
+            return 0.0
+        return (self.pts - self.first_pts + self.frame_duration) / 90000 - self.missing_seconds
+
+
+def check_recordings(dirpath: str) -> dict:
+    """the recordings of one channel. a broadcast starts its pts at 0, so every broadcast is checked by itself"""
+    result = {
+        "broadcasts": 0,
+        "recordings": 0,
+        "bytes": 0,
+        "holes": 0,
+        "missing_seconds": 0.0,
+        "duplicate_seconds": 0.0,
+        "covered_seconds": 0.0,
+    }
+    if not os.path.isdir(dirpath):
+        return result
+    for broadcast in sorted(os.listdir(dirpath)):
+        checker = CoverageChecker()
+        # `%H%M%S%f part<n>.ts` sorts in the recording order
+        filenames = sorted(
+            filename for filename in os.listdir(os.path.join(dirpath, broadcast)) if filename.endswith(".ts")
+        )
+        for filename in filenames:
+            with open(os.path.join(dirpath, broadcast, filename), "rb") as f:
+                while chunk := f.read(MIB):
+                    checker.write(chunk)
+        result["broadcasts"] += 1
+        result["recordings"] += len(filenames)
+        result["bytes"] += checker.size
+        result["holes"] += checker.holes
+        result["missing_seconds"] += checker.missing_seconds
+        result["duplicate_seconds"] += checker.duplicate_seconds
+        result["covered_seconds"] += checker.get_covered_seconds()
+    return result
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> List[dict]:
+    regressions = []
+    for metric, (direction, slack) in REGRESSION_CHECKS.items():
+        value, base = summary.get(metric), baseline.get(metric)
+        if value is None or base is None:
+            continue
+        if direction * (value - base) > abs(base) * tolerance + slack:
+            regressions.append({"metric": metric, "value": value, "baseline": base})
+    return regressions
+
+
+def run(args) -> Tuple[List[dict], dict]:
+    output_dir = tempfile.mkdtemp(prefix="pipeline-")
+    configure(args.mode, output_dir, hot_standby=args.hot_standby)
+    os.environ["PROBE_ENGINE"] = args.probe_engine
+    os.environ["FILEPATH_TEMPLATE"] = os.path.join(output_dir, "{title}", "{id}", "%H%M%S%f")
+
+    # pylint: disable=import-outside-toplevel
+    import util.stream
+    from util.metrics import RECORDING_RESTARTS, TIME_TO_FIRST_BYTE
+    from benchmark.fake_hls import PLUGIN_DIR
+    from benchmark.ts_fixture import TSFixture
+    import entrypoint
+
+    util.stream.SIDELOADED_PLUGIN_DIRS.append(PLUGIN_DIR)
+    util.stream.preload_streamlink_cli()
+
+    origin = subprocess.Popen(
+        [sys.executable, "-m", "benchmark.pipeline", "--origin"] + sys.argv[1:],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    urls = json.loads(origin.stdout.readline())
+    sampler = ResourceSampler([origin.pid])
+    sampler.start()
+
+    channels_file = os.path.join(output_dir, "channels.json")
+    with open(channels_file, "w", encoding="utf8") as f:
+        json.dump([{"NAME": f"channel{index}", "TARGET_URL": url} for index, url in enumerate(urls)], f)
+    recorder = threading.Thread(target=entrypoint.supervisor_loop, args=(channels_file,), name="pipeline")
+    recorder.daemon = True
+    recorder.start()
+
+    # the last offline transition, and the recordings closing after it
+    time.sleep(args.duration + args.grace)
+    resources = sampler.stop()
+    origin.stdin.close()
+    origin.wait()
+
+    segment = TSFixture(int(args.bitrate * 1000 * 1000), args.segment_duration).generate(args.segment_duration)
+    bytes_per_second = len(segment) / args.segment_duration
+    ttfbs = {value["labels"]["channel"]: value for value in TIME_TO_FIRST_BYTE.to_dict()["values"]}
+    restarts = {key[0]: value for key, value in RECORDING_RESTARTS.get_values().items()}
+
+    channels = []
+    for index in range(args.channels):
+        name = f"channel{index}"
+        result = {"channel": name, **check_recordings(os.path.join(output_dir, name))}
+        result["online_seconds"] = sum(offline_at - online_at for online_at, offline_at, _ in get_schedule(index, args))
+        result["lost_bytes"] = int(result["missing_seconds"] * bytes_per_second)
+        for key in ("missing_seconds", "duplicate_seconds", "covered_seconds"):
+            result[key] = round(result[key], 3)
+        result["restarts"] = int(restarts.get(name, 0))
+        ttfb = ttfbs.get(name)
+        result["ttfb_mean"] = round(ttfb["sum"] / ttfb["count"], 3) if ttfb and ttfb["count"] else None
+        channels.append(result)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+    recorded = sum(channel["bytes"] for channel in channels)
+    covered = sum(channel["covered_seconds"] for channel in channels)
+    online = sum(channel["online_seconds"] for channel in channels)
+    ttfb_means = [channel["ttfb_mean"] for channel in channels if channel["ttfb_mean"] is not None]
+    summary = {
+        "mode": args.mode,
+        "probe_engine": args.probe_engine,
+        "hot_standby": args.hot_standby,
+        "channels": args.channels,
+        "duration": args.duration,
+        "bitrate": args.bitrate,
+        **resources,
+        "ttfb_mean": round(sum(ttfb_means) / len(ttfb_means), 3) if ttfb_means else None,
+        "ttfb_max": max(ttfb_means) if ttfb_means else None,
+        "recordings": sum(channel["recordings"] for channel in channels),
+        "restarts": sum(channel["restarts"] for channel in channels),
+        "recorded_mib": round(recorded / MIB, 2),
+        "throughput_mib_per_second": round(recorded / MIB / (args.duration + args.grace), 3),
+        # the part of the online time in the recordings
+        "recorded_ratio": round(covered / online, 3) if online else None,
+        "holes": sum(channel["holes"] for channel in channels),
+        "missing_seconds": round(sum(channel["missing_seconds"] for channel in channels), 3),
+        "duplicate_seconds": round(sum(channel["duplicate_seconds"] for channel in channels), 3),
+        "lost_bytes": sum(channel["lost_bytes"] for channel in channels),
+    }
+    return channels, summary
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=MODES, default="native-inprocess")
+    parser.add_argument("--probe-engine", choices=["session", "subprocess"], default="session")
+    parser.add_argument("--hot-standby", action="store_true")
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--online", type=float, default=40, help="seconds online of every cycle")
+    parser.add_argument("--offline", type=float, default=8, help="seconds offline of every cycle")
+    parser.add_argument("--stagger", type=float, default=1, help="seconds between the channels' schedules")
+    parser.add_argument("--restart-every", type=float, default=15, help="seconds. 0 never ends the playlist")
+    parser.add_argument("--bitrate", type=float, default=2, help="Mbit/s per channel")
+    parser.add_argument("--segment-duration", type=float, default=2)
+    parser.add_argument("--grace", type=float, default=8, help="seconds after the schedule for the last recordings")
+    parser.add_argument("--save", default=None, help="write the summary to this file")
+    parser.add_argument("--baseline", default=None, help="a summary written by `--save` to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--origin", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.origin:
+        run_origins(args)
+        return
+    if args.mode.startswith("ffmpeg") and not shutil.which("ffmpeg"):
+        print(json.dumps({"mode": args.mode, "skipped": "ffmpeg is not installed"}))
+        return
+
+    channels, summary = run(args)
+    for channel in channels:
+        print(json.dumps(channel))
+    failed = any(channel["bytes"] == 0 for channel in channels)
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf8") as f:
+            baseline = json.load(f)
+        settings = ("mode", "probe_engine", "hot_standby", "channels", "duration", "bitrate")
+        if any(baseline.get(key) != summary[key] for key in settings):
+            print(json.dumps({"warning": "the baseline was run with other settings"}), file=sys.stderr)
+        summary["regressions"] = compare(summary, baseline, args.tolerance)
+        failed = failed or bool(summary["regressions"])
+    print(json.dumps(summary))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf8") as f:
+            json.dump({key: value for key, value in summary.items() if key != "regressions"}, f, indent=2)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,26 @@
+# streamlink plugin for benchmark/fake_hls.py
+#
+# fakehls://127.0.0.1:<port>/<channel>
+
+import re
+
+from streamlink.plugin import Plugin, pluginmatcher
+from streamlink.stream.hls import HLSStream
+
+
+@pluginmatcher(re.compile(r"fakehls://(?P<host>[^/]+)/(?P<channel>[^/]+)"))
+class FakeHLS(Plugin):
+    def _get_streams(self):
+        base_url = f"http://{self.match['host']}"
+        status = self.session.http.get(f"{base_url}/status.json").json()
+        if not status.get("online"):
+            return None
+
+        self.id = status["id"]
+        self.author = status["author"]
+        self.category = status["category"]
+        self.title = status["title"]
+        return {"1080p60": HLSStream(self.session, f"{base_url}/live.m3u8")}
+
+
+__plugin__ = FakeHLS
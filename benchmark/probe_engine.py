@@ -0,0 +1,74 @@
+# compare stream probe latency and cpu time of the subprocess and session engines
+#
+# usage: python -m benchmark.probe_engine <url> [--count N] [--streamlink-args ARGS]
+
+import os
+import argparse
+import json
+import resource
+import time
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.stream import (
+    PROBE_ENGINE_SESSION,
+    PROBE_ENGINE_SUBPROCESS,
+    get_session_probe,
+    get_stream_info,
+)
+
+
+def cpu_seconds() -> float:
+    usage_self = resource.getrusage(resource.RUSAGE_SELF)
+    usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage_self.ru_utime + usage_self.ru_stime + usage_children.ru_utime + usage_children.ru_stime
+
+
+def run(engine: str, url: str, streamlink_args: str, count: int) -> dict:
+    latencies = []
+    online = 0
+    cpu_start = cpu_seconds()
+    for _ in range(count):
+        start = time.perf_counter()
+        stream_info = get_stream_info(url, streamlink_args, engine=engine)
+        latencies.append(time.perf_counter() - start)
+        if "error" not in stream_info:
+            online += 1
+    cpu = cpu_seconds() - cpu_start
+
+    latencies.sort()
+    return {
+        "engine": engine,
+        "count": count,
+        "online": online,
+        "latency_min": latencies[0],
+        "latency_p50": latencies[len(latencies) // 2],
+        "latency_max": latencies[-1],
+        "cpu_total": cpu,
+        "cpu_per_probe": cpu / count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--count", type=int, default=10)
+    parser.add_argument("--streamlink-args", default="")
+    args = parser.parse_args()
+
+    results = [run(PROBE_ENGINE_SUBPROCESS, args.url, args.streamlink_args, args.count)]
+
+    # session creation is a one-time cost, so it is reported separately
+    start = time.perf_counter()
+    get_session_probe(args.streamlink_args)
+    session_setup = time.perf_counter() - start
+    result = run(PROBE_ENGINE_SESSION, args.url, args.streamlink_args, args.count)
+    result["setup"] = session_setup
+    results.append(result)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# compare the old deepcopy-based safe_get with the copy-free lookups used per probe
+#
+# usage: python -m benchmark.safe_get [--count N]
+
+import os
+import argparse
+import json
+import time
+import tracemalloc
+from copy import deepcopy
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.common import safe_get
+from util.stream_metadata import is_online, parse_metadata_from_stream_info
+from benchmark.payloads import twitch_stream_info, chzzk_stream_info
+
+
+def deepcopy_safe_get(data, key_list, default=None):
+    if not isinstance(key_list, list):
+        return deepcopy_safe_get(data, [key_list], default=default)
+    try:
+        result = deepcopy(data)
+        for key in key_list:
+            result = result[key]
+        return result
+    except:  # pylint: disable=bare-except
+        return default
+
+
+def deepcopy_probe(stream_info: dict):
+    # the lookups one probe did before: is_online + parse_metadata_from_stream_info
+    deepcopy_safe_get(stream_info, "error")
+    deepcopy_safe_get(stream_info, ["metadata", "id"])
+    deepcopy_safe_get(stream_info, ["plugin"])
+    deepcopy_safe_get(stream_info, ["metadata", "id"])
+    deepcopy_safe_get(stream_info, ["metadata", "author"])
+    deepcopy_safe_get(stream_info, ["metadata", "category"])
+    deepcopy_safe_get(stream_info, ["metadata", "title"])
+    deepcopy_safe_get(stream_info, ["streams"], {}).keys()
+
+
+def copy_free_probe(stream_info: dict):
+    is_online(stream_info)
+    parse_metadata_from_stream_info(stream_info)
+    safe_get(stream_info, ["streams"], {}).keys()
+
+
+def measure(func, stream_info: dict, count: int) -> dict:
+    start = time.perf_counter()
+    for _ in range(count):
+        func(stream_info)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    func(stream_info)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {"probe_us": elapsed / count * 1e6, "peak_bytes_per_probe": peak}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=2000)
+    args = parser.parse_args()
+
+    results = []
+    for name, stream_info in (("twitch", twitch_stream_info()), ("chzzk", chzzk_stream_info())):
+        results.append(
+            {
+                "payload": name,
+                "payload_bytes": len(json.dumps(stream_info, ensure_ascii=False).encode("utf8")),
+                "deepcopy": measure(deepcopy_probe, stream_info, args.count),
+                "copy_free": measure(copy_free_probe, stream_info, args.count),
+            }
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+# fill a simulated volume with N recording channels, with and without util/storage.py
+#
+# the volume is `--capacity` MiB, of which `--old` MiB are old recordings. every channel writes `--bitrate`
+# MiB/s and closes a segment every `--segment` MiB. a write that does not fit is lost, like ffmpeg failing on a
+# full disk. reports the lost bytes, the removed bytes and the lowest free space seen.
+# exits with 1 if the recording with the storage manager lost anything.
+#
+# usage: python -m benchmark.storage [--channels 4] [--duration 40] [--capacity 300] [--old 150]
+
+import os
+import argparse
+import json
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.metrics import RECORDING_BYTES
+from util.storage import StorageManager
+
+MIB = 1024 * 1024
+
+
+class SimulatedVolume:
+    def __init__(self, capacity: int, used: int) -> None:
+        self.capacity = capacity
+        self.used = used
+        self.lock = threading.Lock()
+        self.lost = 0
+        self.lowest_free = capacity - used
+
+    def reserve(self, size: int) -> bool:
+        with self.lock:
+            if self.used + size > self.capacity:
+                self.lost += size
+                return False
+            self.used += size
+            self.lowest_free = min(self.lowest_free, self.capacity - self.used)
+            return True
+
+    def release(self, size: int):
+        with self.lock:
+            self.used -= size
+
+
+class SimulatedStorageManager(StorageManager):
+    volume: SimulatedVolume
+
+    def get_free(self) -> int:
+        return self.volume.capacity - self.volume.used
+
+    def evict(self, recording, reason) -> int:
+        freed = super().evict(recording, reason)
+        self.volume.release(freed)
+        return freed
+
+
+def write_old_recordings(root: str, size: int, count: int = 30):
+    now = time.time()
+    for i in range(count):
+        dirpath = os.path.join(root, "twitch", f"author{i % 3}", "2024-01")
+        os.makedirs(dirpath, exist_ok=True)
+        filepath = os.path.join(dirpath, f"[20240101_0000{i:02d}][old] title (id{i}) part1.ts")
+        with open(filepath, "wb") as f:
+            f.truncate(size // count)
+        os.utime(filepath, (now - 86400 * (count - i), now - 86400 * (count - i)))
+
+
+def record_channel(root, name, volume, storage, duration, bitrate, segment_size, stop_event):
+    chunk = 256 * 1024
+    dirpath = os.path.join(root, "twitch", name)
+    os.makedirs(dirpath, exist_ok=True)
+    started_at = time.monotonic()
+    part, written, segment_written = 1, 0, 0
+    file = open(os.path.join(dirpath, f"recording part{part}.ts"), "wb")
+    while time.monotonic() - started_at < duration and not stop_event.is_set():
+        if volume.reserve(chunk):
+            # sparse. only the sizes matter
+            file.truncate(segment_written + chunk)
+            file.seek(0, os.SEEK_END)
+            segment_written += chunk
+            RECORDING_BYTES.inc(chunk, channel=name)
+        written += chunk
+        if segment_written >= segment_size:
+            file.close()
+            if storage:
+                storage.add(file.name, name)
+            part += 1
+            segment_written = 0
+            file = open(os.path.join(dirpath, f"recording part{part}.ts"), "wb")
+        delay = started_at + written / bitrate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+    file.close()
+
+
+def run(args, use_storage: bool) -> dict:
+    root = tempfile.mkdtemp(prefix="storage-")
+    try:
+        write_old_recordings(root, args.old * MIB)
+        volume = SimulatedVolume(args.capacity * MIB, args.old * MIB)
+        storage = None
+        if use_storage:
+            SimulatedStorageManager.volume = volume
+            storage = SimulatedStorageManager(
+                root,
+                os.path.join(root, "storage_index.json"),
+                low_watermark=args.low * MIB,
+                high_watermark=args.high * MIB,
+                horizon=args.horizon,
+                check_interval=1,
+            )
+            storage.start()
+
+        stop_event = threading.Event()
+        threads = [
+            threading.Thread(
+                target=record_channel,
+                args=(
+                    root,
+                    f"{'managed' if use_storage else 'plain'}{i}",
+                    volume,
+                    storage,
+                    args.duration,
+                    args.bitrate * MIB,
+                    args.segment * MIB,
+                    stop_event,
+                ),
+            )
+            for i in range(args.channels)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        result = {
+            "storage_manager": use_storage,
+            "written_mib": round(args.channels * args.bitrate * args.duration, 1),
+            "lost_mib": round(volume.lost / MIB, 1),
+            "lowest_free_mib": round(volume.lowest_free / MIB, 1),
+        }
+        if storage:
+            stats = storage.get_stats()
+            result["evicted_mib"] = round(stats["evicted_bytes"] / MIB, 1)
+            result["evicted_files"] = stats["evicted_files"]
+            result["indexed_recordings"] = stats["recordings"]
+        return result
+    finally:
+        shutil.rmtree(root)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--channels", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=40)
+    parser.add_argument("--bitrate", type=float, default=2, help="MiB/s per channel")
+    parser.add_argument("--segment", type=float, default=16, help="MiB per segment")
+    parser.add_argument("--capacity", type=int, default=300, help="MiB")
+    parser.add_argument("--old", type=int, default=150, help="MiB of old recordings")
+    parser.add_argument("--low", type=int, default=40, help="low watermark, MiB")
+    parser.add_argument("--high", type=int, default=80, help="high watermark, MiB")
+    parser.add_argument("--horizon", type=float, default=10)
+    args = parser.parse_args()
+
+    results = [run(args, False), run(args, True)]
+    for result in results:
+        print(json.dumps(result))
+    sys.exit(1 if results[1]["lost_mib"] > 0 else 0)
+
+
+if __name__ == "__main__":
+    main()
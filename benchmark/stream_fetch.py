@@ -0,0 +1,103 @@
+# compare the cpu cost of fetching a stream with `python -m streamlink -O` and with the in-process fetcher
+#
+# usage: python -m benchmark.stream_fetch <url> [--stream best] [--duration 60] [--streamlink-args ARGS]
+#
+# both fetchers write into /dev/null, so only the cost of fetching is measured. In the recorder the
+# subprocess fetcher additionally pays for the pipe into ffmpeg.
+
+import os
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import threading
+import time
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.stream_fetch import StreamFetcher
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_subprocess(url: str, stream: str, streamlink_args: str, duration: float) -> dict:
+    command = [sys.executable, "-m", "streamlink", "-O", url, stream]
+    if streamlink_args:
+        command += [streamlink_args]
+
+    cpu_start = children_cpu_seconds()
+    started_at = time.monotonic()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    bytes_read = 0
+    first_byte_at = None
+
+    def stop():
+        time.sleep(duration)
+        process.terminate()
+
+    threading.Thread(target=stop, daemon=True).start()
+    with open(os.devnull, "wb") as devnull:
+        while True:
+            data = process.stdout.read1(1024 * 1024)
+            if not data:
+                break
+            if first_byte_at is None:
+                first_byte_at = time.monotonic()
+            devnull.write(data)
+            bytes_read += len(data)
+    process.wait()
+    elapsed = time.monotonic() - started_at
+
+    return {
+        "fetch": "subprocess",
+        "bytes": bytes_read,
+        "bytes_per_second": bytes_read / elapsed,
+        "time_to_first_byte": first_byte_at - started_at if first_byte_at else None,
+        "cpu_seconds": children_cpu_seconds() - cpu_start,
+    }
+
+
+def run_inprocess(url: str, stream: str, streamlink_args: str, duration: float) -> dict:
+    cpu_start = time.process_time()
+    started_at = time.monotonic()
+    fetcher = StreamFetcher(url, stream, streamlink_args)
+    fetcher.open()
+
+    threading.Timer(duration, fetcher.close).start()
+    with open(os.devnull, "wb") as devnull:
+        fetcher.pump(devnull.write)
+
+    stats = fetcher.get_stats()
+    return {
+        "fetch": "inprocess",
+        "bytes": stats["bytes_written"],
+        "bytes_per_second": stats["bytes_per_second"],
+        "time_to_first_byte": fetcher.first_byte_at - started_at if fetcher.first_byte_at else None,
+        # includes streamlink's worker and writer threads
+        "cpu_seconds": time.process_time() - cpu_start,
+        "pump_cpu_seconds": stats["cpu_seconds"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("url")
+    parser.add_argument("--stream", default="best")
+    parser.add_argument("--duration", type=float, default=60)
+    parser.add_argument("--streamlink-args", default="")
+    args = parser.parse_args()
+
+    results = [
+        run_subprocess(args.url, args.stream, args.streamlink_args, args.duration),
+        run_inprocess(args.url, args.stream, args.streamlink_args, args.duration),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+# time from a channel going live to the first byte of the recording on the disk
+#
+# runs the recorder's main_loop against benchmark/fake_hls.py and fails (exit code 1) if the time from the
+# online transition to the first byte is over `--target` seconds.
+#
+# modes: <muxer>-<fetch>, e.g. native-inprocess, ffmpeg-subprocess. ffmpeg modes are skipped without ffmpeg.
+# `--hot-standby` starts the streamlink process ahead (HOT_STANDBY=always). `--all` runs the subprocess modes
+# with and without it.
+#
+# usage: python -m benchmark.time_to_first_byte [--mode native-inprocess | --all] [--hot-standby] [--target 5]
+
+import os
+import argparse
+import json
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+MODES = ["native-inprocess", "native-subprocess", "ffmpeg-inprocess", "ffmpeg-subprocess"]
+
+
+def configure(mode: str, output_dir: str, hot_standby: bool):
+    """entrypoint reads its settings from the environment on import"""
+    from benchmark.fake_hls import PLUGIN_DIR  # pylint: disable=import-outside-toplevel
+
+    muxer, fetch = mode.split("-")
+    os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+    os.environ["RECORDER_MUXER"] = muxer
+    os.environ["STREAM_FETCH"] = fetch
+    os.environ["PROBE_ENGINE"] = "session"
+    os.environ["CHECK_INTERVAL"] = "1"
+    os.environ["PROBE_MIN_INTERVAL"] = "1"
+    os.environ["PROBE_MAX_INTERVAL"] = "1"
+    os.environ["PROBE_JITTER"] = "0"
+    os.environ["PROBE_HISTORY_DIR"] = os.path.join(output_dir, "probe_history")
+    os.environ["FILEPATH_TEMPLATE"] = os.path.join(output_dir, "{id}")
+    os.environ["STREAMLINK_ARGS"] = f"--plugin-dirs={PLUGIN_DIR}"
+    os.environ["HOT_STANDBY"] = "always" if hot_standby else "off"
+
+
+def get_first_file_byte_at(output_dir: str, timeout: float) -> float:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for filename in os.listdir(output_dir):
+            if filename.endswith(".ts") and os.path.getsize(os.path.join(output_dir, filename)) > 0:
+                return time.monotonic()
+        time.sleep(0.01)
+    raise TimeoutError(f"no recording in {output_dir} after {timeout}s")
+
+
+def run(mode: str, target: float, timeout: float, hot_standby: bool) -> dict:
+    output_dir = tempfile.mkdtemp(prefix="ttfb-")
+    configure(mode, output_dir, hot_standby)
+
+    # pylint: disable=import-outside-toplevel
+    import util.stream
+    from util.metrics import TIME_TO_FIRST_BYTE
+    from benchmark.fake_hls import FakeHLSServer, PLUGIN_DIR
+    import entrypoint
+
+    util.stream.SIDELOADED_PLUGIN_DIRS.append(PLUGIN_DIR)
+    util.stream.preload_streamlink_cli()
+    server = FakeHLSServer()
+    server.start()
+
+    recorder = threading.Thread(
+        target=entrypoint.main_loop, kwargs={"target_url": server.url, "name": "ttfb"}, name="ttfb"
+    )
+    recorder.daemon = True
+    recorder.start()
+    # let the first offline probes pass
+    time.sleep(2)
+
+    live_at = time.monotonic()
+    server.go_online()
+    first_file_byte_at = get_first_file_byte_at(output_dir, timeout)
+
+    deadline = time.monotonic() + 5
+    values = []
+    while time.monotonic() < deadline and not values:
+        values = [value for value in TIME_TO_FIRST_BYTE.to_dict()["values"] if value["labels"]["channel"] == "ttfb"]
+        time.sleep(0.05)
+    online_to_first_byte = values[0]["sum"] if values else None
+
+    server.go_offline()
+    shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        "mode": mode,
+        "hot_standby": hot_standby,
+        "online_to_first_byte": online_to_first_byte,
+        "live_to_first_byte": first_file_byte_at - live_at,
+        "target": target,
+        "passed": online_to_first_byte is not None and online_to_first_byte <= target,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--mode", choices=MODES, default="native-inprocess")
+    parser.add_argument("--all", action="store_true", help="run every mode, each in its own process")
+    parser.add_argument("--hot-standby", action="store_true")
+    parser.add_argument("--target", type=float, default=5, help="seconds from the online transition")
+    parser.add_argument("--timeout", type=float, default=60)
+    args = parser.parse_args()
+
+    if not args.all:
+        result = run(args.mode, args.target, args.timeout, args.hot_standby)
+        print(json.dumps(result))
+        sys.exit(0 if result["passed"] else 1)
+
+    failed = False
+    runs = [(mode, False) for mode in MODES] + [(mode, True) for mode in MODES if mode.endswith("subprocess")]
+    for mode, hot_standby in runs:
+        if mode.startswith("ffmpeg") and not shutil.which("ffmpeg"):
+            print(json.dumps({"mode": mode, "hot_standby": hot_standby, "skipped": "ffmpeg is not installed"}))
+            continue
+        command = [sys.executable, "-m", "benchmark.time_to_first_byte", "--mode", mode]
+        command += ["--target", str(args.target), "--timeout", str(args.timeout)]
+        command += ["--hot-standby"] if hot_standby else []
+        result = subprocess.run(command, stdout=subprocess.PIPE, text=True, check=False)
+        print(result.stdout.strip().splitlines()[-1] if result.stdout.strip() else json.dumps({"mode": mode}))
+        failed = failed or result.returncode != 0
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
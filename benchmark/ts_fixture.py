@@ -0,0 +1,109 @@
+# generate an mpeg-ts stream shaped like a live hls stream: h264 video + aac audio,
+# every hls segment starts with PAT, PMT and a keyframe.
+#
+# the payload is random data. it is not decodable, but its packet, pes and table structure is valid.
+
+import os
+from typing import Iterator
+
+from util.ts_segmenter import PACKET_SIZE, SYNC_BYTE, crc32_mpeg2
+
+PMT_PID = 0x1000
+VIDEO_PID = 0x0100
+AUDIO_PID = 0x0101
+FPS = 30
+
+
+class TSFixture:
+    def __init__(self, bitrate: int = 6_000_000, segment_duration: float = 2.0) -> None:
+        self.bitrate = bitrate
+        self.segment_duration = segment_duration
+        self.continuity_counters = {}
+        self.frame_number = 0
+
+    def next_cc(self, pid: int) -> int:
+        cc = self.continuity_counters.get(pid, -1)
+        cc = (cc + 1) & 0x0F
+        self.continuity_counters[pid] = cc
+        return cc
+
+    def psi_packet(self, pid: int, table_id: int, body: bytes) -> bytes:
+        section = bytes([table_id]) + (0xB000 | (len(body) + 4)).to_bytes(2, "big") + body
+        section += crc32_mpeg2(section).to_bytes(4, "big")
+        packet = bytes([SYNC_BYTE, 0x40 | (pid >> 8), pid & 0xFF, 0x10 | self.next_cc(pid), 0x00]) + section
+        return packet + b"\xff" * (PACKET_SIZE - len(packet))
+
+    def pat(self) -> bytes:
+        body = b"\x00\x01\xc1\x00\x00" + b"\x00\x01" + (0xE000 | PMT_PID).to_bytes(2, "big")
+        return self.psi_packet(0, 0x00, body)
+
+    def pmt(self) -> bytes:
+        body = b"\x00\x01\xc1\x00\x00" + (0xE000 | VIDEO_PID).to_bytes(2, "big") + b"\xf0\x00"
+        body += bytes([0x1B]) + (0xE000 | VIDEO_PID).to_bytes(2, "big") + b"\xf0\x00"
+        body += bytes([0x0F]) + (0xE000 | AUDIO_PID).to_bytes(2, "big") + b"\xf0\x00"
+        return self.psi_packet(PMT_PID, 0x02, body)
+
+    @staticmethod
+    def encode_timestamp(marker: int, timestamp: int) -> bytes:
+        return bytes(
+            [
+                (marker << 4) | (((timestamp >> 30) & 0x07) << 1) | 1,
+                (timestamp >> 22) & 0xFF,
+                (((timestamp >> 15) & 0x7F) << 1) | 1,
+                (timestamp >> 7) & 0xFF,
+                ((timestamp & 0x7F) << 1) | 1,
+            ]
+        )
+
+    def pes_packets(self, pid: int, stream_id: int, pts: int, es: bytes, is_keyframe: bool) -> Iterator[bytes]:
+        header = b"\x00\x00\x01" + bytes([stream_id]) + b"\x00\x00" + b"\x80\x80\x05"
+        header += self.encode_timestamp(0x2, pts)
+        payload = header + es
+        is_first = True
+        while payload:
+            cc = self.next_cc(pid)
+            if is_first and is_keyframe:
+                # adaptation field with random_access_indicator
+                prefix = bytes([SYNC_BYTE, 0x40 | (pid >> 8), pid & 0xFF, 0x30 | cc, 0x01, 0x40])
+            else:
+                prefix = bytes([SYNC_BYTE, (0x40 if is_first else 0x00) | (pid >> 8), pid & 0xFF, 0x10 | cc])
+            room = PACKET_SIZE - len(prefix)
+            chunk, payload = payload[:room], payload[room:]
+            if len(chunk) < room:
+                # stuff with an adaptation field
+                stuffing = room - len(chunk)
+                if prefix[3] & 0x20:
+                    prefix = prefix[:4] + bytes([prefix[4] + stuffing]) + prefix[5:] + b"\xff" * stuffing
+                else:
+                    prefix = prefix[:3] + bytes([0x30 | cc])
+                    if stuffing == 1:
+                        prefix += b"\x00"
+                    else:
+                        prefix += bytes([stuffing - 1, 0x00]) + b"\xff" * (stuffing - 2)
+            yield prefix + chunk
+            is_first = False
+
+    def frame(self) -> bytes:
+        frames_per_segment = int(FPS * self.segment_duration)
+        is_keyframe = self.frame_number % frames_per_segment == 0
+        pts = (self.frame_number * 90000 // FPS + 90000) % (1 << 33)
+        packets = []
+        if is_keyframe:
+            packets += [self.pat(), self.pmt()]
+
+        video_size = self.bitrate // 8 // FPS
+        nal = b"\x00\x00\x00\x01\x09\xf0" + (b"\x00\x00\x00\x01\x65" if is_keyframe else b"\x00\x00\x00\x01\x41")
+        packets += self.pes_packets(VIDEO_PID, 0xE0, pts, nal + os.urandom(video_size), is_keyframe)
+        if self.frame_number % 2 == 0:
+            packets += self.pes_packets(AUDIO_PID, 0xC0, pts, os.urandom(400), False)
+
+        self.frame_number += 1
+        return b"".join(packets)
+
+    def generate(self, duration: float) -> bytes:
+        return b"".join(self.frame() for _ in range(int(duration * FPS)))
+
+
+def write_fixture(filepath: str, duration: float, bitrate: int = 6_000_000):
+    with open(filepath, "wb") as f:
+        f.write(TSFixture(bitrate).generate(duration))
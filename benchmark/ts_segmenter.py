@@ -0,0 +1,122 @@
+# compare the native mpeg-ts segmenter with `ffmpeg -c copy -f segment` on a generated fixture
+#
+# also checks that the SDT is one packet with the longest title and author. exits with 1 if not.
+#
+# usage: python -m benchmark.ts_segmenter [--duration 600] [--bitrate 6000000] [--segment 60]
+
+import os
+import argparse
+import json
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("LOG_DIR", "/tmp/streamlink-recorder-benchmark/log")
+
+# pylint: disable=wrong-import-position
+from util.ts_segmenter import PACKET_SIZE, TSSegmenter, make_sdt_packet
+from benchmark.ts_fixture import write_fixture
+
+
+def run_native(fixture_filepath: str, output_dir: str, segment: float, chunk_size: int = 1024 * 1024) -> dict:
+    cpu_start = time.process_time()
+    started_at = time.perf_counter()
+    segmenter = TSSegmenter(os.path.join(output_dir, "native"), segment, title="benchmark", artist="benchmark")
+    with open(fixture_filepath, "rb") as f:
+        while data := f.read(chunk_size):
+            segmenter.write(data)
+    segmenter.close()
+    elapsed = time.perf_counter() - started_at
+
+    return {
+        "muxer": "native",
+        "elapsed": elapsed,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "bytes_per_second": os.path.getsize(fixture_filepath) / elapsed,
+        "segments": len(segmenter.segment_filepaths),
+    }
+
+
+def check_sdt() -> list:
+    """(author, title) whose SDT is not a single packet. twitch titles are at most 140 characters"""
+    failures = []
+    for author, title in (
+        ("a" * 25, "t" * 140),
+        ("a" * 40, "t" * 140),
+        ("가" * 25, "제" * 140),
+        ("a" * 25, "🎮" * 140),
+    ):
+        packet = make_sdt_packet(1, author, title)
+        if len(packet) != PACKET_SIZE:
+            failures.append((author, title, len(packet)))
+    return failures
+
+
+def run_ffmpeg(fixture_filepath: str, output_dir: str, segment: float) -> dict:
+    command = [
+        "ffmpeg",
+        "-loglevel",
+        "error",
+        "-i",
+        "-",
+        "-c",
+        "copy",
+        "-metadata",
+        "title=benchmark",
+        "-f",
+        "segment",
+        "-segment_time",
+        str(segment),
+        "-reset_timestamps",
+        "1",
+        "-segment_start_number",
+        "1",
+        os.path.join(output_dir, "ffmpeg part%d.ts"),
+    ]
+    usage_start = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started_at = time.perf_counter()
+    with open(fixture_filepath, "rb") as f:
+        subprocess.run(command, stdin=f, check=True)
+    elapsed = time.perf_counter() - started_at
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        "muxer": "ffmpeg",
+        "elapsed": elapsed,
+        "cpu_seconds": usage.ru_utime + usage.ru_stime - usage_start.ru_utime - usage_start.ru_stime,
+        "bytes_per_second": os.path.getsize(fixture_filepath) / elapsed,
+        "segments": len([name for name in os.listdir(output_dir) if name.startswith("ffmpeg")]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--duration", type=float, default=600, help="fixture length in seconds")
+    parser.add_argument("--bitrate", type=int, default=6_000_000)
+    parser.add_argument("--segment", type=float, default=60, help="segment length in seconds")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fixture_filepath = os.path.join(tmp_dir, "fixture.ts")
+        write_fixture(fixture_filepath, args.duration, args.bitrate)
+
+        results = [run_native(fixture_filepath, tmp_dir, args.segment)]
+        if shutil.which("ffmpeg"):
+            results.append(run_ffmpeg(fixture_filepath, tmp_dir, args.segment))
+        for result in results:
+            # seconds of stream muxed per cpu second: roughly how many channels one core can mux
+            result["channels_per_core"] = args.duration / result["cpu_seconds"] if result["cpu_seconds"] else None
+
+    print(json.dumps(results, indent=2))
+
+    failures = check_sdt()
+    for author, title, size in failures:
+        print(f"SDT of {len(author)} + {len(title)} characters is {size} bytes")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
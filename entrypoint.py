@@ -1,115 +1,333 @@
 import os
 import sys
+import atexit
 import time
 import subprocess
 import traceback
-import json
 import signal
 import threading
-from typing import Dict, List
-from copy import deepcopy
+from contextlib import nullcontext
+from typing import Callable, Optional, Set
 
-from util.logger import main_logger, subprocess_logger
+from util.logger import main_logger
 from util.common import (
-    send_discord_message,
     truncate_string_in_byte_size,
     format_filepath,
     get_stdout_of_command,
     get_output_of_command,
     silent_of,
+    PhaseTimer,
 )
-from util.event import Subscriber
+from util.event import COALESCE, Subscriber
+from util.notifier import DiscordNotifier, SentStore
+from util.ownership import OWNERSHIP
+from util.storage import GIB, RetentionRule, StorageManager
 from util.stream_metadata import StreamMetadata
-from util.stream import install_streamlink
+from util.metadata_history import MetadataHistory
+from util.probe_scheduler import ProbeScheduler
+from util.stream import preload_streamlink_cli
+from util.standby import StreamlinkStandby
+from util.install_cache import StreamlinkInstaller, get_installed_streamlink, resolve_streamlink_source
+from util.supervisor import Channel, Supervisor, load_channels
+from util.metadata_journal import MetadataJournal, write_json_atomic
+from util.stream_fetch import StreamFetcher
+from util.failover import FailoverFetcher
+from util.ts_segmenter import TSSegmenter, pump_pipe_to_segmenter
+from util.segment_writer import create_segment_file_opener
+from util.postprocess import PostProcessor, SegmentWatcher, get_duration
+from util.catalog import Catalog
+from util.profiling import Profiler, parse_signal
+from util.output_pump import get_output_pump
+from util.ffmpeg_progress import FFmpegProgress, ProgressWatchdog
+from util.metrics import (
+    RECORDING_ACTIVE,
+    RECORDING_BYTES,
+    RECORDING_FAILOVERS,
+    RECORDING_RESTARTS,
+    RECORDING_SEGMENTS,
+    FFMPEG_BITRATE,
+    FFMPEG_DROP_FRAMES,
+    FFMPEG_DUP_FRAMES,
+    FFMPEG_OUT_TIME,
+    FFMPEG_SPEED,
+    RECORDING_BEHIND,
+    RECORDING_STALLED,
+    observe_time_to_first_byte,
+    start_metrics_dump,
+    start_metrics_server,
+)
 
 
 STREAMLINK_GITHUB = os.getenv("STREAMLINK_GITHUB", None)
 STREAMLINK_COMMIT = os.getenv("STREAMLINK_COMMIT", None)
 STREAMLINK_VERSION = os.getenv("STREAMLINK_VERSION", None)
+# wheels of the installed streamlink builds. keep it in a volume to start without reinstalling
+STREAMLINK_CACHE_DIR = os.getenv("STREAMLINK_CACHE_DIR") or "/log/streamlink_cache"
 TARGET_URL = os.getenv("TARGET_URL", None)
 TARGET_STREAM = os.getenv("TARGET_STREAM") or "best"
 STREAMLINK_ARGS = os.getenv("STREAMLINK_ARGS", "")
 
 CHECK_INTERVAL = float(os.getenv("CHECK_INTERVAL") or 15)
+PROBE_ENGINE = os.getenv("PROBE_ENGINE") or "session"
+PROBE_MIN_INTERVAL = float(os.getenv("PROBE_MIN_INTERVAL")) if os.getenv("PROBE_MIN_INTERVAL") else None
+PROBE_MAX_INTERVAL = float(os.getenv("PROBE_MAX_INTERVAL")) if os.getenv("PROBE_MAX_INTERVAL") else None
+PROBE_JITTER = float(os.getenv("PROBE_JITTER") or 0.1)
+PROBE_HISTORY_DIR = os.getenv("PROBE_HISTORY_DIR") or "/log/probe_history"
 FILEPATH_TEMPLATE = os.getenv("FILEPATH_TEMPLATE", "{plugin}/{author}/%Y-%m/[%Y%m%d_%H%M%S][{category}] {title} ({id})")
 FFMPEG_SEGMENT_SIZE = int(os.getenv("FFMPEG_SEGMENT_SIZE") or 690)
+# a recording slower than this over a minute is reported as behind real time
+FFMPEG_MIN_SPEED = float(os.getenv("FFMPEG_MIN_SPEED") or 0.95)
+# ffmpeg is stopped (and the download retried) if the recording does not grow for this many seconds. 0 disables.
+# opt-in: streamlink writes nothing during ads which it filters out (--twitch-disable-ads)
+FFMPEG_STALL_TIMEOUT = float(os.getenv("FFMPEG_STALL_TIMEOUT") or 0)
+# how long a new recording waits for its first byte before it is checked only by the stall watchdog (if enabled)
+PIPELINE_READY_TIMEOUT = float(os.getenv("PIPELINE_READY_TIMEOUT") or 30)
+
+# subprocess: `python -m streamlink -O` piped into ffmpeg. inprocess: the recorder fetches the stream itself
+STREAM_FETCH = os.getenv("STREAM_FETCH") or "subprocess"
+STREAM_FETCH_CHUNK_SIZE = int(os.getenv("STREAM_FETCH_CHUNK_SIZE") or 1024 * 1024)
+STREAM_FETCH_READAHEAD_SIZE = int(os.getenv("STREAM_FETCH_READAHEAD_SIZE") or 0) or None
+# in-process fetch only: replace a failing stream within the same file, without writing a segment twice
+STREAM_FAILOVER = os.getenv("STREAM_FAILOVER", "").lower() in ("1", "true", "yes")
+STREAM_FAILOVER_STALL_TIMEOUT = float(os.getenv("STREAM_FAILOVER_STALL_TIMEOUT") or 10)
+STREAM_FAILOVER_GAP_TIMEOUT = float(os.getenv("STREAM_FAILOVER_GAP_TIMEOUT") or 10)
+# keep a streamlink process started before the channel goes online. off, auto (around the usual start time), always
+HOT_STANDBY = (os.getenv("HOT_STANDBY") or "off").lower()
+# ffmpeg: `ffmpeg -c copy -f segment`. native: the recorder splits the mpeg-ts stream itself
+RECORDER_MUXER = os.getenv("RECORDER_MUXER") or "ffmpeg"
+# native muxer only. default: buffered writes. preallocate: preallocated files, large aligned writes, fsync cadence
+SEGMENT_WRITE_MODE = (os.getenv("SEGMENT_WRITE_MODE") or "default").lower()
+SEGMENT_WRITE_BUFFER_SIZE = int(os.getenv("SEGMENT_WRITE_BUFFER_SIZE") or 4 * 1024 * 1024)
+# expected bitrate in Mbit/s. a segment is preallocated for this bitrate, SEGMENT_PREALLOCATE_MAX_SIZE at a time
+SEGMENT_BITRATE = float(os.getenv("SEGMENT_BITRATE") or 10)
+SEGMENT_PREALLOCATE_MAX_SIZE = int(os.getenv("SEGMENT_PREALLOCATE_MAX_SIZE") or 256 * 1024 * 1024)
+SEGMENT_FSYNC_INTERVAL = float(os.getenv("SEGMENT_FSYNC_INTERVAL") or 0)
+
+# free GiB of /data. old recordings are removed before less is left. 0 disables it
+STORAGE_LOW_WATERMARK = float(os.getenv("STORAGE_LOW_WATERMARK") or 0)
+# free GiB after a removal
+STORAGE_HIGH_WATERMARK = float(os.getenv("STORAGE_HIGH_WATERMARK") or 0) or STORAGE_LOW_WATERMARK * 2
+# seconds of recording the free space above the low watermark must last
+STORAGE_HORIZON = float(os.getenv("STORAGE_HORIZON") or 600)
+STORAGE_INDEX = os.getenv("STORAGE_INDEX") or "/log/storage_index.json"
+# finished recordings older (days) or larger in total (GiB per channel) are removed. 0 is no limit
+RETENTION_DAYS = float(os.getenv("RETENTION_DAYS") or 0)
+RETENTION_SIZE = float(os.getenv("RETENTION_SIZE") or 0)
+# sqlite catalog of the recordings, updated while recording. disabled if empty
+CATALOG_FILE = os.getenv("CATALOG_FILE", "")
+
+# remux finished segments to mp4 or mkv. disabled if empty
+POSTPROCESS_FORMAT = os.getenv("POSTPROCESS_FORMAT", "")
+POSTPROCESS_WORKERS = int(os.getenv("POSTPROCESS_WORKERS") or 1)
+POSTPROCESS_NICENESS = int(os.getenv("POSTPROCESS_NICENESS") or 19)
+POSTPROCESS_DELETE_SOURCE = os.getenv("POSTPROCESS_DELETE_SOURCE", "").lower() in ("1", "true", "yes")
+POSTPROCESS_QUEUE = os.getenv("POSTPROCESS_QUEUE") or "/log/postprocess_queue.json"
 
 DISCORD_WEBHOOK = os.getenv("DISCORD_WEBHOOK", None)
-
-# preserve max 10 stream ids per each clf
-SENT_MESSAGE_STREAM_IDS: Dict[str, List[str]] = {}
+# stream ids that got a message, so a restart does not send them again
+DISCORD_SENT_FILE = os.getenv("DISCORD_SENT_FILE") or "/log/discord_sent.json"
+# messages within this many seconds are sent as one
+DISCORD_COALESCE_WINDOW = float(os.getenv("DISCORD_COALESCE_WINDOW") or 2)
+METADATA_JOURNAL = os.getenv("METADATA_JOURNAL", "").lower() in ("1", "true", "yes")
+# metadata changes kept in memory per broadcast: the first one and the newest. 0 is no limit
+METADATA_HISTORY_SIZE = int(os.getenv("METADATA_HISTORY_SIZE") or 0)
+# ffmpeg's progress lines are logged at most once per this many seconds
+PROGRESS_LOG_INTERVAL = float(os.getenv("PROGRESS_LOG_INTERVAL") or 30)
+
+CHANNELS_FILE = os.getenv("CHANNELS_FILE", None)
+MAX_CONCURRENT_RECORDINGS = int(os.getenv("MAX_CONCURRENT_RECORDINGS") or 0)
+MAX_CONCURRENT_PROBES = int(os.getenv("MAX_CONCURRENT_PROBES") or 4)
+
+# prometheus endpoint. disabled if 0
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+# periodic json dump of the same metrics. disabled if empty
+METRICS_DUMP_FILE = os.getenv("METRICS_DUMP_FILE", "")
+METRICS_DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL") or 60)
+
+# off, cprofile (around probes and recordings) or sample (stacks of all threads)
+PROFILE_MODE = (os.getenv("PROFILE_MODE") or "off").lower()
+PROFILE_DIR = os.getenv("PROFILE_DIR") or "/log/profile"
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL") or 0.02)
+PROFILE_DUMP_INTERVAL = float(os.getenv("PROFILE_DUMP_INTERVAL") or 300)
+# top allocations every n seconds. disabled if 0
+PROFILE_TRACEMALLOC_INTERVAL = float(os.getenv("PROFILE_TRACEMALLOC_INTERVAL") or 0)
+PROFILE_TRACEMALLOC_TOP = int(os.getenv("PROFILE_TRACEMALLOC_TOP") or 25)
+# dumps the thread stacks and the channel states. disabled if empty
+PROFILE_DUMP_SIGNAL = os.getenv("PROFILE_DUMP_SIGNAL") or ""
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP") or 10)
+
+POSTPROCESSOR: Optional[PostProcessor] = None
+NOTIFIER: Optional[DiscordNotifier] = None
+STORAGE: Optional[StorageManager] = None
+CATALOG: Optional[Catalog] = None
+PROFILER: Optional[Profiler] = None
+# stop the child processes of every channel on SIGINT/SIGTERM. signal handlers run in the main thread only
+SHUTDOWN_HANDLERS: Set[Callable[[], None]] = set()
+SHUTDOWN_HANDLERS_LOCK = threading.Lock()
 
 
 class RecordException(Exception):
     pass
 
 
+def add_shutdown_handler(handler: Callable[[], None]):
+    with SHUTDOWN_HANDLERS_LOCK:
+        SHUTDOWN_HANDLERS.add(handler)
+
+
+def remove_shutdown_handler(handler: Callable[[], None]):
+    with SHUTDOWN_HANDLERS_LOCK:
+        SHUTDOWN_HANDLERS.discard(handler)
+
+
+def interrupt_handler(__signalnum, __frame):
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    signal.signal(signal.SIGABRT, signal.default_int_handler)
+    with SHUTDOWN_HANDLERS_LOCK:
+        handlers = list(SHUTDOWN_HANDLERS)
+    for handler in handlers:
+        try:
+            handler()
+        except Exception as e:
+            main_logger.error("shutdown error: %s", e)
+    signal.raise_signal(__signalnum)
+
+
+def set_interrupt_handler():
+    signal.signal(signal.SIGINT, interrupt_handler)
+    signal.signal(signal.SIGTERM, interrupt_handler)
+    signal.signal(signal.SIGABRT, interrupt_handler)
+
+
 @silent_of
 def send_discord_message_if_necessary(clf: str, stream_id: str, message: str):
-    if clf not in SENT_MESSAGE_STREAM_IDS:
-        SENT_MESSAGE_STREAM_IDS[clf] = []
-    elif stream_id in SENT_MESSAGE_STREAM_IDS[clf]:
-        return
-    SENT_MESSAGE_STREAM_IDS[clf] = SENT_MESSAGE_STREAM_IDS[clf][-9:] + [stream_id]
-    main_logger.debug("%s sent_stream_ids: %s", clf, SENT_MESSAGE_STREAM_IDS[clf])
-    send_discord_message(f"[{clf}]{message}", discord_webhook=DISCORD_WEBHOOK)
-
-
-def handle_process_stdout(process: subprocess.Popen):
-    subprocess_logger.debug("run")
-    while process.returncode is None:
-        line = process.stdout.readline()
-        process.stdout.flush()
-        if isinstance(line, bytes):
-            line = line.decode("utf-8", errors="ignore")
-        subprocess_logger.info(str(line).rstrip())
-        process.poll()
-    subprocess_logger.debug("done")
-
-
-def handle_process_stderr(process: subprocess.Popen):
-    subprocess_logger.debug("run")
-    while process.returncode is None:
-        line = process.stderr.readline()
-        process.stderr.flush()
-        if isinstance(line, bytes):
-            line = line.decode("utf-8", errors="ignore")
-        subprocess_logger.info(str(line).rstrip())
-        process.poll()
-    subprocess_logger.debug("done")
+    """once per stream id and clf. returns at once, the message is sent in the background"""
+    if NOTIFIER:
+        NOTIFIER.notify(f"[{clf}]{message}", kind=clf, key=stream_id)
+
+
+@silent_of
+def send_discord_message(message: str):
+    if NOTIFIER:
+        NOTIFIER.notify(message)
+
+
+@silent_of
+def update_catalog(update: Callable[[Catalog], None]):
+    """a broken catalog does not stop a recording"""
+    if CATALOG:
+        update(CATALOG)
+
+
+def create_progress_metrics_listener(
+    channel: str, get_written_size: Optional[Callable[[], int]]
+) -> Callable[[FFmpegProgress], None]:
+    """`get_written_size` returns the total of the whole output, so bytes are counted by its delta
+
+    ffmpeg's `total_size` is N/A for the segment muxer, so the size is taken from the files.
+    """
+    bytes_counter = RECORDING_BYTES.labels(channel=channel)
+    speed_gauge = FFMPEG_SPEED.labels(channel=channel)
+    bitrate_gauge = FFMPEG_BITRATE.labels(channel=channel)
+    out_time_gauge = FFMPEG_OUT_TIME.labels(channel=channel)
+    drop_frames_gauge = FFMPEG_DROP_FRAMES.labels(channel=channel)
+    dup_frames_gauge = FFMPEG_DUP_FRAMES.labels(channel=channel)
+    last_size = 0
+
+    def on_progress(progress: FFmpegProgress):
+        nonlocal last_size
+        if progress.speed is not None:
+            speed_gauge.set(progress.speed)
+        if progress.bitrate is not None:
+            bitrate_gauge.set(progress.bitrate)
+        if progress.out_time is not None:
+            out_time_gauge.set(progress.out_time)
+        drop_frames_gauge.set(progress.drop_frames)
+        dup_frames_gauge.set(progress.dup_frames)
+        if get_written_size:
+            size = get_written_size()
+            bytes_counter.inc(max(size - last_size, 0))
+            last_size = max(size, last_size)
+
+    return on_progress
 
 
 def export_metadata_thread(filepath: str, store: StreamMetadata):
     stream_info_subscriber = Subscriber("stream_info")
+    # before the first export, so no change is missed. the whole stack is written, so the latest change is enough
+    store.add_subscriber(stream_info_subscriber, "stream_info", COALESCE)
+    store.add_subscriber(stream_info_subscriber, "is_online")
+    journal = MetadataJournal(filepath) if METADATA_JOURNAL else None
+
+    def export_metadata(history: MetadataHistory):
+        records = history.get_records()
+        stack = [record.to_dict() for record in records]
+        positions = [record.position for record in records]
+        if journal:
+            journal.extend(stack, positions)
+        else:
+            write_json_atomic(f"{filepath}.json", stack, indent=2)
+        update_catalog(lambda catalog: catalog.add_metadata(filepath, stack, positions))
+
     try:
-        [target_dirpath, _] = os.path.split(filepath)
-        os.makedirs(target_dirpath, exist_ok=True)
-        os.system(f'''sudo chown -R abc:abc "{target_dirpath}"''')
+        OWNERSHIP.makedirs(os.path.dirname(filepath))
 
         main_logger.info("write metadata to file")
-        metadata_stack = deepcopy(store.last_stack)
-        with open(f"{filepath}.json", "w", encoding="utf8") as f:
-            json.dump(metadata_stack, f, ensure_ascii=False, indent=2)
+        export_metadata(store.last_history)
     except Exception as e:
         main_logger.error(e)
         main_logger.error(traceback.print_exc())
 
-    store.add_subscriber(stream_info_subscriber, "stream_info")
     while store.is_online:
-        result = stream_info_subscriber.receive(0.5)
-        if result is None:
+        # wakes up on a metadata change or the offline transition
+        event = stream_info_subscriber.receive_event()
+        if event.topic == "is_online":
+            if not event.message:
+                break
             continue
 
         try:
             main_logger.info("update metadata to file")
-            metadata_stack = deepcopy(store.stack)
-            with open(f"{filepath}.json", "w", encoding="utf8") as f:
-                json.dump(metadata_stack, f, ensure_ascii=False, indent=2)
-            stream_info_subscriber.event.clear()
+            export_metadata(store.history)
         except Exception as e:
             main_logger.error(e)
             main_logger.error(traceback.print_exc())
     store.remove_subscriber(stream_info_subscriber, "stream_info")
+    store.remove_subscriber(stream_info_subscriber, "is_online")
+
+    if journal:
+        try:
+            main_logger.info("compact metadata journal")
+            journal.compact()
+        except Exception as e:
+            main_logger.error(e)
+            main_logger.error(traceback.format_exc())
+    OWNERSHIP.chown_file(f"{filepath}.json")
+
+
+def prepare_output_directory(metadata_store: StreamMetadata, filepath_template: str):
+    """create the output directory of the next recording from the metadata of the last one"""
+    metadata = metadata_store.get_last_metadata()
+    dirpath_template = os.path.dirname(filepath_template)
+    # the directory of the next broadcast is not known yet. nothing to prepare
+    if not metadata or any(key in dirpath_template for key in ("{id}", "{title}", "{category}")):
+        return
+
+    dirpath = os.path.dirname(
+        os.path.join(
+            "/data",
+            format_filepath(
+                filepath_template,
+                plugin=metadata["plugin"],
+                metadata_id=metadata["id"],
+                metadata_author=metadata["author"],
+                metadata_category=metadata["category"],
+                metadata_title=metadata["title"],
+            ),
+        )
+    )
+    OWNERSHIP.makedirs(dirpath)
 
 
 def sleep_if_1080_not_available(metadata_store: StreamMetadata, target_stream: str, check_interval: float) -> bool:
@@ -125,20 +343,32 @@ def sleep_if_1080_not_available(metadata_store: StreamMetadata, target_stream: s
         if not is_1080_in_target or is_1080_in_stream:
             return
 
-        main_logger.info("1080 is not in stream. It may be target site error. So wait for some seconds.")
-        time.sleep(check_interval)
+        main_logger.info("1080 is not in stream. It may be target site error. So probe again.")
+        # a short delay so the site has a chance to add it. returns as soon as the probe is done
+        metadata_store.wait_for_next_probe(timeout=check_interval, delay=2)
         nth_try += 1
 
 
-def download_stream(metadata_store: StreamMetadata, target_url: str, target_stream: str, streamlink_args: str):
+def download_stream(
+    metadata_store: StreamMetadata,
+    target_url: str,
+    target_stream: str,
+    streamlink_args: str,
+    filepath_template: str = FILEPATH_TEMPLATE,
+    standby: Optional[StreamlinkStandby] = None,
+):
     streamlink_process = None
+    stream_fetcher = None
     ffmpeg_process = None
+    segmenter = None
+    muxer_thread = None
+    segment_watcher = None
     filepath = None
+    channel = metadata_store.name
+    # only the first attempt after the online transition counts for the time to first byte
+    online_at, metadata_store.online_at = metadata_store.online_at, None
 
-    def interrupt_handler(__signalnum, __frame):
-        signal.signal(signal.SIGINT, signal.default_int_handler)
-        signal.signal(signal.SIGTERM, signal.default_int_handler)
-        signal.signal(signal.SIGABRT, signal.default_int_handler)
+    def stop_pipeline():
         if ffmpeg_process:
             ffmpeg_process.poll()
             if ffmpeg_process.returncode is None:
@@ -147,11 +377,13 @@ def download_stream(metadata_store: StreamMetadata, target_url: str, target_stre
             streamlink_process.poll()
             if streamlink_process.returncode is None:
                 streamlink_process.kill()
-        signal.raise_signal(__signalnum)
+        if stream_fetcher:
+            stream_fetcher.close()
 
-    signal.signal(signal.SIGINT, interrupt_handler)
-    signal.signal(signal.SIGTERM, interrupt_handler)
-    signal.signal(signal.SIGABRT, interrupt_handler)
+    # signal handlers can only be set in the main thread. the supervisor sets them for the channels in other threads
+    if threading.current_thread() is threading.main_thread():
+        set_interrupt_handler()
+    add_shutdown_handler(stop_pipeline)
 
     try:
         current_metadata = metadata_store.get_current_metadata()
@@ -176,7 +408,7 @@ def download_stream(metadata_store: StreamMetadata, target_url: str, target_stre
         filepath = os.path.join(
             "/data",
             format_filepath(
-                FILEPATH_TEMPLATE,
+                filepath_template,
                 plugin=plugin,
                 metadata_id=metadata_id,
                 metadata_author=metadata_author,
@@ -186,21 +418,19 @@ def download_stream(metadata_store: StreamMetadata, target_url: str, target_stre
         )
 
         [dirpath, filename] = os.path.split(filepath)
-        os.makedirs(dirpath, exist_ok=True)
-        os.system(f'''sudo chown -R abc:abc "{dirpath}"''')
-
-        streamlink_command = [
-            sys.executable,
-            "-m",
-            "streamlink",
-            "-O",
-        ]
-        streamlink_command += [target_url, target_stream]
+        OWNERSHIP.makedirs(dirpath)
+        main_logger.debug("ownership: %s", OWNERSHIP.get_stats())
+
+        streamlink_arguments = ["-O", target_url, target_stream]
         if streamlink_args:
-            streamlink_command += [streamlink_args]
+            streamlink_arguments += [streamlink_args]
+        streamlink_command = [sys.executable, "-m", "streamlink"] + streamlink_arguments
 
         ffmpeg_command = [
             "ffmpeg",
+            "-nostats",
+            "-progress",
+            "pipe:1",
             "-i",
             "-",
             "-c",
@@ -218,6 +448,7 @@ def download_stream(metadata_store: StreamMetadata, target_url: str, target_stre
         ]
 
         filepath: str = os.path.join(dirpath, filename)
+        update_catalog(lambda catalog: catalog.start_recording(filepath, channel, current_metadata))
         # ffmpeg templace escape percent character
         ffmpeg_filepath = filepath.replace("%", "%%")
 
@@ -238,79 +469,218 @@ def download_stream(metadata_store: StreamMetadata, target_url: str, target_stre
         filepath_with_extname += ".ts"
         ffmpeg_command += [filepath_with_extname]
 
-        streamlink_process = subprocess.Popen(
-            streamlink_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        ffmpeg_process = subprocess.Popen(
-            ffmpeg_command,
-            stdin=streamlink_process.stdout,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            bufsize=1,
-            universal_newlines=True,
-            encoding="utf-8",
-            errors="ignore",
-        )
+        if STREAM_FETCH == "inprocess" and STREAM_FAILOVER:
+            stream_fetcher = FailoverFetcher(
+                target_url,
+                target_stream,
+                streamlink_args,
+                chunk_size=STREAM_FETCH_CHUNK_SIZE,
+                readahead_size=STREAM_FETCH_READAHEAD_SIZE,
+                bytes_counter=RECORDING_BYTES.labels(channel=channel) if RECORDER_MUXER != "native" else None,
+                stall_timeout=STREAM_FAILOVER_STALL_TIMEOUT,
+                gap_timeout=STREAM_FAILOVER_GAP_TIMEOUT,
+                on_failover=lambda reason: RECORDING_FAILOVERS.inc(channel=channel),
+            )
+            stream_fetcher.open()
+        elif STREAM_FETCH == "inprocess":
+            stream_fetcher = StreamFetcher(
+                target_url,
+                target_stream,
+                streamlink_args,
+                chunk_size=STREAM_FETCH_CHUNK_SIZE,
+                readahead_size=STREAM_FETCH_READAHEAD_SIZE,
+                # the native muxer counts the bytes it writes itself
+                bytes_counter=RECORDING_BYTES.labels(channel=channel) if RECORDER_MUXER != "native" else None,
+            )
+            stream_fetcher.open()
+        else:
+            streamlink_process = standby.take(streamlink_arguments) if standby else None
+            if streamlink_process:
+                main_logger.info("use the standby streamlink process %s", streamlink_process.pid)
+            else:
+                streamlink_process = subprocess.Popen(
+                    streamlink_command,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                )
+        segments_counter = RECORDING_SEGMENTS.labels(channel=channel)
+
+        def on_segment_closed(segment_filepath: str):
+            segments_counter.inc()
+            OWNERSHIP.chown_file(segment_filepath)
+            if STORAGE:
+                STORAGE.add(segment_filepath, channel)
+            if CATALOG:
+                # the native muxer knows the duration. ffmpeg's segments are probed
+                duration = segmenter.get_segment_duration() if segmenter else get_duration(segment_filepath)
+                update_catalog(lambda catalog: catalog.add_segment(filepath, segment_filepath, duration))
+            if POSTPROCESSOR:
+                POSTPROCESSOR.submit(segment_filepath)
+
+        # set once the first byte is on the disk
+        first_byte_event = threading.Event()
+
+        def on_first_byte():
+            if first_byte_event.is_set():
+                return
+            first_byte_event.set()
+            observe_time_to_first_byte(channel, online_at, time.monotonic())
+
+        output_pump = get_output_pump(PROGRESS_LOG_INTERVAL)
+        streamlink_output = None
+        if streamlink_process:
+            streamlink_output = output_pump.register(streamlink_process.stderr, f"{channel} streamlink")
+
+        if RECORDER_MUXER == "native":
+            segmenter = TSSegmenter(
+                filepath,
+                FFMPEG_SEGMENT_SIZE * 60 if FFMPEG_SEGMENT_SIZE else None,
+                title=truncate_string_in_byte_size(metadata_title, 147),
+                artist=metadata_author,
+                genre=metadata_category,
+                date=metadata_datetime,
+                on_segment_closed=on_segment_closed,
+                bytes_counter=RECORDING_BYTES.labels(channel=channel),
+                on_first_byte=on_first_byte,
+                open_file=(
+                    create_segment_file_opener(
+                        SEGMENT_WRITE_BUFFER_SIZE,
+                        SEGMENT_BITRATE * 1000 * 1000 / 8,
+                        FFMPEG_SEGMENT_SIZE * 60 if FFMPEG_SEGMENT_SIZE else None,
+                        SEGMENT_PREALLOCATE_MAX_SIZE,
+                        SEGMENT_FSYNC_INTERVAL,
+                    )
+                    if SEGMENT_WRITE_MODE == "preallocate"
+                    else None
+                ),
+            )
+            if stream_fetcher:
+                muxer_thread = stream_fetcher.start_pump_thread(segmenter)
+            else:
+                muxer_thread = threading.Thread(
+                    target=pump_pipe_to_segmenter,
+                    args=(streamlink_process.stdout, segmenter),
+                    name=f"{threading.current_thread().name}-muxer",
+                )
+                muxer_thread.daemon = True
+                muxer_thread.start()
+        else:
+            ffmpeg_process = subprocess.Popen(
+                ffmpeg_command,
+                stdin=subprocess.PIPE if stream_fetcher else streamlink_process.stdout,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
 
-        if metadata_store.is_online:
-            main_logger.info(streamlink_command)
-            main_logger.info(ffmpeg_command)
+            if stream_fetcher:
+                stream_fetcher.start_pump_thread(ffmpeg_process.stdin)
+            segment_watcher = SegmentWatcher(filepath, FFMPEG_SEGMENT_SIZE is not None, on_segment_closed)
+            segment_watcher.start()
+
+            first_segment_filepath = f"{filepath} part1.ts" if FFMPEG_SEGMENT_SIZE is not None else f"{filepath}.ts"
+
+            def check_first_byte(progress: FFmpegProgress):
+                # ffmpeg does not tell when it writes. check the first segment on every progress report until then
+                if first_byte_event.is_set() or not progress.out_time:
+                    return
+                if os.path.exists(first_segment_filepath) and os.path.getsize(first_segment_filepath) > 0:
+                    on_first_byte()
+
+            ffmpeg_progress = FFmpegProgress(f"{channel} ffmpeg")
+            progress_metrics_listener = create_progress_metrics_listener(
+                channel,
+                # the in-process fetcher counts the bytes it writes itself
+                get_written_size=segment_watcher.get_written_size if stream_fetcher is None else None,
+            )
+            ffmpeg_progress.add_listener(progress_metrics_listener)
+            ffmpeg_progress.add_listener(check_first_byte)
+            output_pump.register(
+                ffmpeg_process.stdout,
+                f"{channel} ffmpeg progress",
+                on_line=ffmpeg_progress.feed_line,
+                is_logged=False,
+            )
+            ffmpeg_output = output_pump.register(ffmpeg_process.stderr, f"{channel} ffmpeg")
 
-        time.sleep(2)
-        if streamlink_process.poll() is not None:
-            raise RecordException("streamlink process is not started")
-        if ffmpeg_process.poll() is not None:
-            streamlink_process.kill()
-            raise RecordException("ffmpeg process is not started")
+        if metadata_store.is_online:
+            main_logger.info(f"in-process {stream_fetcher.stream_name}" if stream_fetcher else streamlink_command)
+            main_logger.info(ffmpeg_command if ffmpeg_process else f"native muxer {segmenter.filepath}")
+        RECORDING_ACTIVE.set(1, channel=channel)
+
+        # wait for the first byte on the disk, or for a part of the pipeline to exit
+        ready_deadline = time.monotonic() + PIPELINE_READY_TIMEOUT
+        while not first_byte_event.wait(0.05):
+            if streamlink_process and streamlink_process.poll() is not None:
+                raise RecordException("streamlink process exited before the first byte")
+            if muxer_thread and not muxer_thread.is_alive():
+                raise RecordException("native muxer exited before the first byte")
+            if ffmpeg_process and ffmpeg_process.poll() is not None:
+                if streamlink_process:
+                    streamlink_process.kill()
+                if stream_fetcher:
+                    stream_fetcher.close()
+                raise RecordException("ffmpeg process exited before the first byte")
+            if time.monotonic() > ready_deadline:
+                main_logger.warning("no data written after %ss yet", PIPELINE_READY_TIMEOUT)
+                break
 
         metadata_export_thread = threading.Thread(target=export_metadata_thread, args=(filepath, metadata_store))
         metadata_export_thread.daemon = True
         metadata_export_thread.start()
 
-        streamlink_log_thread = threading.Thread(target=handle_process_stderr, args=(streamlink_process,))
-        streamlink_log_thread.daemon = True
-        streamlink_log_thread.start()
-        if streamlink_log_thread is None:
-            streamlink_process.kill()
-            ffmpeg_process.kill()
-            raise RecordException("Cannot spawn streamlink log thread")
+        if ffmpeg_process:
 
-        ffmpeg_log_thread = threading.Thread(target=handle_process_stdout, args=(ffmpeg_process,))
-        ffmpeg_log_thread.start()
-        if ffmpeg_log_thread is None:
-            streamlink_process.kill()
-            ffmpeg_process.kill()
-            streamlink_log_thread.join(timeout=10)
-            raise RecordException("Cannot spawn ffmpeg log thread")
-        ffmpeg_log_thread.join()
-
-        ffmpeg_returncode = ffmpeg_process.wait()
-        if ffmpeg_returncode != 0:
-            if ffmpeg_process.stdout and not ffmpeg_process.stdout.closed:
-                ffmpeg_stdout = ffmpeg_process.stdout.readlines()
-                ffmpeg_stdout = [str(output) for output in ffmpeg_stdout]
-            main_logger.warning(
-                "ffmpeg not exited normally.\nreturncode: %s.\nstdout: %s",
-                ffmpeg_returncode,
-                ffmpeg_stdout,
+            def on_stalled():
+                main_logger.warning("stop the stalled ffmpeg process")
+                ffmpeg_process.terminate()
+
+            def on_progress_state(is_behind: bool, is_stalled: bool):
+                RECORDING_BEHIND.set(int(is_behind), channel=channel)
+                RECORDING_STALLED.set(int(is_stalled), channel=channel)
+
+            progress_watchdog = ProgressWatchdog(
+                ffmpeg_progress,
+                min_speed=FFMPEG_MIN_SPEED,
+                stall_timeout=FFMPEG_STALL_TIMEOUT,
+                on_stalled=on_stalled,
+                on_state=on_progress_state,
             )
+            progress_watchdog.start()
+
+            ffmpeg_returncode = ffmpeg_process.wait()
+            progress_watchdog.stop()
+            ffmpeg_output.wait(timeout=10)
+            # count what was written after the last progress report
+            progress_metrics_listener(ffmpeg_progress)
+            main_logger.info("ffmpeg progress: %s", ffmpeg_progress.to_dict())
+            if ffmpeg_returncode != 0:
+                main_logger.warning(
+                    "ffmpeg not exited normally.\nreturncode: %s.\nstderr: %s",
+                    ffmpeg_returncode,
+                    list(ffmpeg_output.tail),
+                )
+        else:
+            muxer_thread.join()
+            main_logger.info("native muxer stats: %s", segmenter.get_stats())
 
         # it should be terminated after ffmpeg process is terminated
-        streamlink_returncode = streamlink_process.wait(timeout=10)
-        if streamlink_returncode != 0:
-            if streamlink_process.stderr and not streamlink_process.stderr.closed:
-                streamlink_stderr = streamlink_process.stderr.readlines()
-                streamlink_stderr = [str(output) for output in streamlink_stderr]
-            main_logger.warning(
-                "streamlink not exited normally.\nreturncode: %s.\nstdout: %s",
-                streamlink_returncode,
-                streamlink_stderr,
-            )
+        if streamlink_process:
+            streamlink_returncode = streamlink_process.wait(timeout=10)
+            streamlink_output.wait(timeout=10)
+            if streamlink_returncode != 0:
+                main_logger.warning(
+                    "streamlink not exited normally.\nreturncode: %s.\nstdout: %s",
+                    streamlink_returncode,
+                    list(streamlink_output.tail),
+                )
+        if stream_fetcher:
+            stream_fetcher.close()
+            main_logger.info("in-process fetch stats: %s", stream_fetcher.get_stats())
 
-        ffmpeg_process.terminate()
-        streamlink_process.terminate()
+        if ffmpeg_process:
+            ffmpeg_process.terminate()
+        if streamlink_process:
+            streamlink_process.terminate()
 
         # force update status
         metadata_store.set_metadata()
@@ -318,51 +688,248 @@ def download_stream(metadata_store: StreamMetadata, target_url: str, target_stre
         main_logger.info("download ends")
         send_discord_message_if_necessary("OFF", metadata_id, discord_message_template)
     except Exception as e:
-        send_discord_message(f"[ERROR]{discord_message_template}", discord_webhook=DISCORD_WEBHOOK)
+        send_discord_message(f"[ERROR]{discord_message_template}")
         raise e
     finally:
+        remove_shutdown_handler(stop_pipeline)
         if ffmpeg_process and ffmpeg_process.poll() is not None:
             ffmpeg_process.kill()
         if streamlink_process and streamlink_process.poll() is not None:
             streamlink_process.kill()
-
-
-main_logger.info(install_streamlink(STREAMLINK_GITHUB, STREAMLINK_COMMIT, STREAMLINK_VERSION))
-main_logger.info(get_stdout_of_command([sys.executable, "-m", "streamlink", "--version"]))
-main_logger.info(get_stdout_of_command(["ffmpeg", "-version"]))
-
-get_output_of_command(["ln", "-s", "/plugins", "~/.local/share/streamlink/plugins"])
-
-
-def main_loop():
-    metadata_store = StreamMetadata(TARGET_URL, STREAMLINK_ARGS, CHECK_INTERVAL)
+        if stream_fetcher:
+            stream_fetcher.close()
+        if segment_watcher:
+            segment_watcher.stop()
+        if filepath:
+            update_catalog(lambda catalog: catalog.end_recording(filepath))
+        RECORDING_ACTIVE.set(0, channel=channel)
+        RECORDING_BEHIND.set(0, channel=channel)
+        RECORDING_STALLED.set(0, channel=channel)
+
+
+STARTUP_TIMER = PhaseTimer()
+
+
+def install_dependencies():
+    """runs before the main loop. importing this module does not install anything"""
+    with STARTUP_TIMER.phase("resolve streamlink source"):
+        streamlink_source = resolve_streamlink_source(STREAMLINK_GITHUB, STREAMLINK_COMMIT, STREAMLINK_VERSION)
+    with STARTUP_TIMER.phase("install streamlink"):
+        main_logger.info(StreamlinkInstaller(STREAMLINK_CACHE_DIR).ensure(streamlink_source))
+    with STARTUP_TIMER.phase("versions"):
+        main_logger.info("streamlink %s", getattr(get_installed_streamlink(), "version", None))
+        main_logger.info(get_stdout_of_command(["ffmpeg", "-version"]))
+    with STARTUP_TIMER.phase("link plugins"):
+        get_output_of_command(["ln", "-s", "/plugins", "~/.local/share/streamlink/plugins"])
+    with STARTUP_TIMER.phase("import streamlink"):
+        preload_streamlink_cli()
+
+
+def main_loop(
+    target_url: str = TARGET_URL,
+    target_stream: str = TARGET_STREAM,
+    streamlink_args: str = STREAMLINK_ARGS,
+    filepath_template: str = FILEPATH_TEMPLATE,
+    check_interval: float = CHECK_INTERVAL,
+    name: Optional[str] = None,
+    recording_slots: Optional[threading.Semaphore] = None,
+    probe_slots: Optional[threading.Semaphore] = None,
+):
+    metadata_store = StreamMetadata(
+        target_url,
+        streamlink_args,
+        check_interval,
+        probe_engine=PROBE_ENGINE,
+        probe_slots=probe_slots,
+        name=name,
+        scheduler=ProbeScheduler(
+            check_interval,
+            min_interval=PROBE_MIN_INTERVAL,
+            max_interval=PROBE_MAX_INTERVAL,
+            jitter=PROBE_JITTER,
+            history_path=os.path.join(PROBE_HISTORY_DIR, f"{name or 'default'}.json"),
+        ),
+        profiler=PROFILER,
+        max_history=METADATA_HISTORY_SIZE,
+    )
+    if PROFILER:
+        PROFILER.add_state(metadata_store.name, metadata_store.get_state)
     subscriber = Subscriber("downloader")
-    metadata_store.add_subscriber(subscriber, "is_online")
-
-    while True:
-        is_online = subscriber.receive(timeout=None)
-        subscriber.event.clear()
+    # only the latest state matters after a recording ends
+    metadata_store.add_subscriber(subscriber, "is_online", COALESCE)
+
+    standby = None
+    # the in-process fetch has no process to start
+    if HOT_STANDBY in ("auto", "always") and STREAM_FETCH != "inprocess":
+        standby = StreamlinkStandby(
+            target_url,
+            is_wanted=lambda: HOT_STANDBY == "always" or metadata_store.scheduler.is_near_usual_start(),
+            name=metadata_store.name,
+            check_interval=check_interval,
+            prepare=lambda: prepare_output_directory(metadata_store, filepath_template),
+        )
+        standby.start()
 
-        if not is_online:
-            continue
+    if standby:
+        add_shutdown_handler(standby.stop)
+    try:
+        while True:
+            is_online = subscriber.receive(timeout=None)
+
+            if not is_online:
+                continue
+
+            try:
+                main_logger.info("start download")
+                with recording_slots or nullcontext():
+                    quick_failures = 0
+                    for nth_try in range(10):
+                        if nth_try > 0:
+                            RECORDING_RESTARTS.inc(channel=metadata_store.name)
+                        started_at = time.monotonic()
+                        try:
+                            sleep_if_1080_not_available(metadata_store, target_stream, check_interval)
+                            with (
+                                PROFILER.section(f"{metadata_store.name}-download", session=True)
+                                if PROFILER
+                                else nullcontext()
+                            ):
+                                download_stream(
+                                    metadata_store,
+                                    target_url,
+                                    target_stream,
+                                    streamlink_args,
+                                    filepath_template=filepath_template,
+                                    standby=standby,
+                                )
+                        except Exception as e:
+                            main_logger.error(e)
+                            main_logger.error(traceback.format_exc())
+                        finally:
+                            # retry at once after a recording that ran for a while. back off only if it keeps failing
+                            if time.monotonic() - started_at < 30:
+                                time.sleep(min(0.5 * 2**quick_failures, 3))
+                                quick_failures += 1
+                            else:
+                                quick_failures = 0
+                            # sometimes stream goes to online -> offline -> online
+                            metadata_store.set_metadata()
+            except Exception as e:
+                main_logger.error(e)
+                main_logger.error(traceback.format_exc())
+    finally:
+        # the supervisor starts the channel again with a new store. the probe thread of this one stops
+        metadata_store.remove_subscriber(subscriber, "is_online")
+        metadata_store.destroy(wait=False)
+        if standby:
+            remove_shutdown_handler(standby.stop)
+            standby.stop()
+
+
+def supervisor_loop(channels_file: str):
+    channels = load_channels(
+        channels_file,
+        target_stream=TARGET_STREAM,
+        streamlink_args=STREAMLINK_ARGS,
+        filepath_template=FILEPATH_TEMPLATE,
+        check_interval=CHECK_INTERVAL,
+        retention_days=RETENTION_DAYS,
+        retention_size=RETENTION_SIZE,
+    )
+    if STORAGE:
+        for channel in channels:
+            STORAGE.set_rule(
+                channel.name,
+                RetentionRule(channel.retention_days * 24 * 60 * 60, int(channel.retention_size * GIB)),
+            )
+    recording_slots = threading.BoundedSemaphore(MAX_CONCURRENT_RECORDINGS) if MAX_CONCURRENT_RECORDINGS else None
+    probe_slots = threading.BoundedSemaphore(MAX_CONCURRENT_PROBES) if MAX_CONCURRENT_PROBES else None
+
+    def run_channel(channel: Channel):
+        main_loop(
+            target_url=channel.target_url,
+            target_stream=channel.target_stream,
+            streamlink_args=channel.streamlink_args,
+            filepath_template=channel.filepath_template,
+            check_interval=channel.check_interval,
+            name=channel.name,
+            recording_slots=recording_slots,
+            probe_slots=probe_slots,
+        )
 
-        try:
-            main_logger.info("start download")
-            for _ in range(10):
-                try:
-                    sleep_if_1080_not_available(metadata_store, TARGET_STREAM, CHECK_INTERVAL)
-                    download_stream(metadata_store, TARGET_URL, TARGET_STREAM, STREAMLINK_ARGS)
-                except Exception as e:
-                    main_logger.error(e)
-                    main_logger.error(traceback.format_exc())
-                finally:
-                    time.sleep(3)
-                    # sometimes stream goes to online -> offline -> online
-                    metadata_store.set_metadata()
-        except Exception as e:
-            main_logger.error(e)
-            main_logger.error(traceback.format_exc())
+    # the channels run in other threads, which cannot set signal handlers
+    if threading.current_thread() is threading.main_thread():
+        set_interrupt_handler()
+    Supervisor(channels, run_channel, restart_interval=CHECK_INTERVAL).run()
 
 
 if __name__ == "__main__":
-    main_loop()
+    install_dependencies()
+
+    with STARTUP_TIMER.phase("profiler"):
+        if PROFILE_MODE != "off" or PROFILE_TRACEMALLOC_INTERVAL or PROFILE_DUMP_SIGNAL:
+            PROFILER = Profiler(
+                PROFILE_DIR,
+                mode=PROFILE_MODE,
+                sample_interval=PROFILE_SAMPLE_INTERVAL,
+                dump_interval=PROFILE_DUMP_INTERVAL,
+                tracemalloc_interval=PROFILE_TRACEMALLOC_INTERVAL,
+                tracemalloc_top=PROFILE_TRACEMALLOC_TOP,
+                dump_signal=parse_signal(PROFILE_DUMP_SIGNAL),
+                keep=PROFILE_KEEP,
+            )
+            PROFILER.start()
+
+    with STARTUP_TIMER.phase("storage"):
+        if STORAGE_LOW_WATERMARK or RETENTION_DAYS or RETENTION_SIZE:
+            STORAGE = StorageManager(
+                "/data",
+                STORAGE_INDEX,
+                int(STORAGE_LOW_WATERMARK * GIB),
+                int(STORAGE_HIGH_WATERMARK * GIB),
+                horizon=STORAGE_HORIZON,
+                default_rule=RetentionRule(RETENTION_DAYS * 24 * 60 * 60, int(RETENTION_SIZE * GIB)),
+            )
+            STORAGE.start()
+
+    with STARTUP_TIMER.phase("catalog"):
+        if CATALOG_FILE:
+            CATALOG = Catalog(CATALOG_FILE)
+
+    with STARTUP_TIMER.phase("postprocessor"):
+        if POSTPROCESS_FORMAT:
+            POSTPROCESSOR = PostProcessor(
+                POSTPROCESS_QUEUE,
+                output_format=POSTPROCESS_FORMAT,
+                workers=POSTPROCESS_WORKERS,
+                niceness=POSTPROCESS_NICENESS,
+                delete_source=POSTPROCESS_DELETE_SOURCE,
+                on_done=STORAGE.replace if STORAGE else None,
+            )
+
+    with STARTUP_TIMER.phase("notifier"):
+        if DISCORD_WEBHOOK:
+            NOTIFIER = DiscordNotifier(
+                DISCORD_WEBHOOK,
+                sent_store=SentStore(DISCORD_SENT_FILE),
+                coalesce_window=DISCORD_COALESCE_WINDOW,
+            )
+            NOTIFIER.start()
+            # the last messages, e.g. an error before the exit
+            atexit.register(NOTIFIER.flush, 5)
+
+    with STARTUP_TIMER.phase("metrics"):
+        if METRICS_PORT:
+            start_metrics_server(METRICS_PORT)
+        if METRICS_DUMP_FILE:
+            start_metrics_dump(METRICS_DUMP_FILE, METRICS_DUMP_INTERVAL)
+    main_logger.info(STARTUP_TIMER.summary())
+    if STREAM_FAILOVER and STREAM_FETCH != "inprocess":
+        main_logger.warning("STREAM_FAILOVER needs STREAM_FETCH=inprocess. it is not used")
+    if SEGMENT_WRITE_MODE != "default" and RECORDER_MUXER != "native":
+        main_logger.warning("SEGMENT_WRITE_MODE needs RECORDER_MUXER=native. ffmpeg writes the files itself")
+
+    if CHANNELS_FILE:
+        supervisor_loop(CHANNELS_FILE)
+    else:
+        main_loop()
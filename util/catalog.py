@@ -0,0 +1,388 @@
+# sqlite catalog of the recordings
+#
+# a recording is otherwise only known by its path and the `.json` sidecar next to its parts. the catalog keeps
+# the stream id, plugin, author, the metadata stack, the segment files with their sizes and durations, indexed by
+# channel, author, stream id and time. the recorder updates it as it records. WAL mode, so the cli can read while
+# the recorder writes.
+#
+# usage:
+#   python -m util.catalog <catalog> query [--author X] [--channel X] [--stream-id X] [--since 2024-09-01]
+#       [--until 2024-10-01] [--segments]
+#   python -m util.catalog <catalog> import <dir> [--workers 8]    # rebuild from the sidecars under <dir>
+
+import os
+import argparse
+import json
+import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Iterable, List, Optional, Tuple
+
+from .metadata_journal import JOURNAL_EXTNAME, read_journal
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+    id INTEGER PRIMARY KEY,
+    filepath TEXT NOT NULL UNIQUE,
+    channel TEXT,
+    plugin TEXT,
+    stream_id TEXT,
+    author TEXT,
+    category TEXT,
+    title TEXT,
+    started_at REAL,
+    ended_at REAL
+);
+CREATE INDEX IF NOT EXISTS recordings_author ON recordings (author, started_at);
+CREATE INDEX IF NOT EXISTS recordings_channel ON recordings (channel, started_at);
+CREATE INDEX IF NOT EXISTS recordings_stream_id ON recordings (stream_id);
+CREATE INDEX IF NOT EXISTS recordings_started_at ON recordings (started_at);
+
+CREATE TABLE IF NOT EXISTS metadata (
+    recording_id INTEGER NOT NULL REFERENCES recordings (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    recorded_at REAL,
+    stream_id TEXT,
+    author TEXT,
+    category TEXT,
+    title TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (recording_id, position)
+);
+CREATE INDEX IF NOT EXISTS metadata_stream_id ON metadata (stream_id);
+
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    recording_id INTEGER NOT NULL REFERENCES recordings (id) ON DELETE CASCADE,
+    filepath TEXT NOT NULL UNIQUE,
+    size INTEGER,
+    duration REAL,
+    closed_at REAL
+);
+CREATE INDEX IF NOT EXISTS segments_recording_id ON segments (recording_id);
+"""
+
+SEGMENT_EXTNAMES = (".ts", ".mp4", ".mkv")
+
+
+def parse_timestamp(value: Optional[str]) -> Optional[float]:
+    """the `timestamp` of a metadata record, e.g. 20240901T203000+0900"""
+    try:
+        return datetime.strptime(value, "%Y%m%dT%H%M%S%z").timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class Catalog:
+    def __init__(self, filepath: str) -> None:
+        self.filepath = filepath
+        os.makedirs(os.path.dirname(filepath) or ".", exist_ok=True)
+        # one connection shared by the recorder threads. writes are a few per recording
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False, timeout=30)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def get_recording_id(self, filepath: str) -> Optional[int]:
+        row = self.connection.execute("SELECT id FROM recordings WHERE filepath = ?", (filepath,)).fetchone()
+        return row[0] if row else None
+
+    def start_recording(self, filepath: str, channel: str, metadata: dict, started_at: Optional[float] = None):
+        """`filepath`: the recording path without part number and extension"""
+        with self.lock, self.connection:
+            self.connection.execute(
+                """
+                INSERT INTO recordings (filepath, channel, plugin, stream_id, author, category, title, started_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (filepath) DO UPDATE SET ended_at = NULL
+                """,
+                (
+                    filepath,
+                    channel,
+                    metadata.get("plugin"),
+                    metadata.get("id"),
+                    metadata.get("author"),
+                    metadata.get("category"),
+                    metadata.get("title"),
+                    started_at if started_at is not None else time.time(),
+                ),
+            )
+
+    def insert_metadata(self, recording_id: int, stack: List[dict], positions: Optional[List[int]] = None):
+        """call with `lock` held, in a transaction. records already in the catalog are skipped
+
+        `positions`: the position of every record in the broadcast, if older records were dropped from the stack
+        """
+        self.connection.executemany(
+            """
+            INSERT OR IGNORE INTO metadata
+            (recording_id, position, recorded_at, stream_id, author, category, title, data)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [
+                (
+                    recording_id,
+                    position,
+                    parse_timestamp(record.get("timestamp")),
+                    record.get("id"),
+                    record.get("author"),
+                    record.get("category"),
+                    record.get("title"),
+                    json.dumps(record, ensure_ascii=False),
+                )
+                for position, record in zip(positions or range(len(stack)), stack)
+            ],
+        )
+
+    def add_metadata(self, filepath: str, stack: List[dict], positions: Optional[List[int]] = None):
+        """the records of the stack which are not in the catalog yet"""
+        with self.lock, self.connection:
+            recording_id = self.get_recording_id(filepath)
+            if recording_id is None:
+                return
+            self.insert_metadata(recording_id, stack, positions)
+
+    def add_segment(self, filepath: str, segment_filepath: str, duration: Optional[float] = None):
+        try:
+            stat = os.stat(segment_filepath)
+            size, closed_at = stat.st_size, stat.st_mtime
+        except OSError:
+            size, closed_at = None, time.time()
+        with self.lock, self.connection:
+            recording_id = self.get_recording_id(filepath)
+            if recording_id is None:
+                return
+            self.connection.execute(
+                """
+                INSERT INTO segments (recording_id, filepath, size, duration, closed_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (filepath) DO UPDATE SET size = excluded.size, duration = excluded.duration,
+                    closed_at = excluded.closed_at
+                """,
+                (recording_id, segment_filepath, size, duration, closed_at),
+            )
+
+    def end_recording(self, filepath: str, ended_at: Optional[float] = None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE recordings SET ended_at = ? WHERE filepath = ?",
+                (ended_at if ended_at is not None else time.time(), filepath),
+            )
+
+    def query(
+        self,
+        author: Optional[str] = None,
+        channel: Optional[str] = None,
+        stream_id: Optional[str] = None,
+        since: Optional[float] = None,
+        until: Optional[float] = None,
+    ) -> List[dict]:
+        """recordings with their segments, oldest first. `stream_id` also matches ids of later metadata records"""
+        conditions, parameters = [], []
+        if author is not None:
+            conditions.append("author = ?")
+            parameters.append(author)
+        if channel is not None:
+            conditions.append("channel = ?")
+            parameters.append(channel)
+        if stream_id is not None:
+            conditions.append("(stream_id = ? OR id IN (SELECT recording_id FROM metadata WHERE stream_id = ?))")
+            parameters += [stream_id, stream_id]
+        if since is not None:
+            conditions.append("started_at >= ?")
+            parameters.append(since)
+        if until is not None:
+            conditions.append("started_at < ?")
+            parameters.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self.lock:
+            self.connection.row_factory = sqlite3.Row
+            try:
+                recordings = [
+                    dict(row)
+                    for row in self.connection.execute(
+                        f"SELECT * FROM recordings {where} ORDER BY started_at", parameters
+                    )
+                ]
+                for recording in recordings:
+                    recording["segments"] = [
+                        dict(row)
+                        for row in self.connection.execute(
+                            "SELECT filepath, size, duration, closed_at FROM segments WHERE recording_id = ? "
+                            "ORDER BY closed_at",
+                            (recording["id"],),
+                        )
+                    ]
+            finally:
+                self.connection.row_factory = None
+        return recordings
+
+    def import_recordings(self, recordings: Iterable[Tuple[str, List[dict], List[Tuple[str, int, float]]]]) -> int:
+        """(filepath, metadata stack, [(segment filepath, size, mtime)]) in one transaction"""
+        count = 0
+        with self.lock, self.connection:
+            for filepath, stack, segments in recordings:
+                first = stack[0] if stack else {}
+                started_at = parse_timestamp(first.get("timestamp"))
+                ended_at = max((mtime for _, _, mtime in segments), default=None)
+                self.connection.execute(
+                    """
+                    INSERT INTO recordings
+                    (filepath, channel, plugin, stream_id, author, category, title, started_at, ended_at)
+                    VALUES (?, NULL, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (filepath) DO UPDATE SET plugin = excluded.plugin, stream_id = excluded.stream_id,
+                        author = excluded.author, category = excluded.category, title = excluded.title,
+                        started_at = excluded.started_at, ended_at = COALESCE(ended_at, excluded.ended_at)
+                    """,
+                    (
+                        filepath,
+                        first.get("plugin"),
+                        first.get("id"),
+                        first.get("author"),
+                        first.get("category"),
+                        first.get("title"),
+                        started_at,
+                        ended_at,
+                    ),
+                )
+                recording_id = self.get_recording_id(filepath)
+                self.insert_metadata(recording_id, stack)
+                self.connection.executemany(
+                    """
+                    INSERT INTO segments (recording_id, filepath, size, closed_at) VALUES (?, ?, ?, ?)
+                    ON CONFLICT (filepath) DO UPDATE SET size = excluded.size
+                    """,
+                    [(recording_id, segment_filepath, size, mtime) for segment_filepath, size, mtime in segments],
+                )
+                count += 1
+        return count
+
+
+def read_sidecar(filepath: str) -> Optional[List[dict]]:
+    """the metadata stack of `<recording>.json` or a leftover `<recording>.jsonl`. None if it is something else"""
+    try:
+        if filepath.endswith(JOURNAL_EXTNAME):
+            stack = read_journal(filepath)
+        else:
+            with open(filepath, "r", encoding="utf8") as f:
+                stack = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(stack, list) or not stack or not all(isinstance(record, dict) for record in stack):
+        return None
+    if "id" not in stack[0] or "plugin" not in stack[0]:
+        return None
+    return stack
+
+
+def scan_directory(dirpath: str) -> List[Tuple[str, List[dict], List[Tuple[str, int, float]]]]:
+    """the recordings of one directory. the directory is listed once"""
+    try:
+        entries = list(os.scandir(dirpath))
+    except OSError:
+        return []
+    sidecars = {}
+    segment_entries = []
+    for entry in entries:
+        if not entry.is_file():
+            continue
+        if entry.name.endswith(".json") or entry.name.endswith(JOURNAL_EXTNAME):
+            base = entry.path[: -len(JOURNAL_EXTNAME)] if entry.name.endswith(JOURNAL_EXTNAME) else entry.path[:-5]
+            # the compacted .json wins over a leftover journal
+            if base not in sidecars or entry.name.endswith(".json"):
+                sidecars[base] = entry.path
+        elif entry.name.endswith(SEGMENT_EXTNAMES) and ".tmp." not in entry.name:
+            segment_entries.append(entry)
+
+    recordings = []
+    for base, sidecar_filepath in sidecars.items():
+        stack = read_sidecar(sidecar_filepath)
+        if stack is None:
+            continue
+        segments = []
+        for entry in segment_entries:
+            name = entry.path[len(base) :]
+            if not entry.path.startswith(base) or not (name.startswith(" part") or name.startswith(".")):
+                continue
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            segments.append((entry.path, stat.st_size, stat.st_mtime))
+        recordings.append((base, stack, sorted(segments, key=lambda segment: segment[2])))
+    return recordings
+
+
+def import_tree(catalog: Catalog, root: str, workers: int = 8) -> dict:
+    """rebuild the catalog from the sidecars under `root`. directories are read by `workers` threads"""
+    started_at = time.monotonic()
+    dirpaths = [dirpath for dirpath, _, _ in os.walk(root)]
+    imported = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="catalog-import") as executor:
+        for recordings in executor.map(scan_directory, dirpaths):
+            if recordings:
+                imported += catalog.import_recordings(recordings)
+    return {
+        "directories": len(dirpaths),
+        "recordings": imported,
+        "seconds": round(time.monotonic() - started_at, 3),
+    }
+
+
+def parse_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    return datetime.fromisoformat(value).timestamp()
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m util.catalog")
+    parser.add_argument("catalog", help="the sqlite file, e.g. /log/catalog.sqlite3")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    query_parser = commands.add_parser("query")
+    query_parser.add_argument("--author")
+    query_parser.add_argument("--channel")
+    query_parser.add_argument("--stream-id")
+    query_parser.add_argument("--since", help="local date or datetime, e.g. 2024-09-01")
+    query_parser.add_argument("--until", help="local date or datetime, exclusive")
+    query_parser.add_argument("--segments", action="store_true", help="print the segment files")
+
+    import_parser = commands.add_parser("import")
+    import_parser.add_argument("root", help="the recordings directory, e.g. /data")
+    import_parser.add_argument("--workers", type=int, default=8)
+
+    args = parser.parse_args()
+    catalog = Catalog(args.catalog)
+    if args.command == "import":
+        print(json.dumps(import_tree(catalog, args.root, args.workers)))
+        return
+
+    recordings = catalog.query(
+        author=args.author,
+        channel=args.channel,
+        stream_id=args.stream_id,
+        since=parse_date(args.since),
+        until=parse_date(args.until),
+    )
+    for recording in recordings:
+        segments = recording.pop("segments")
+        recording["size"] = sum(segment["size"] or 0 for segment in segments)
+        recording["duration"] = sum(segment["duration"] or 0 for segment in segments)
+        recording["parts"] = len(segments)
+        if args.segments:
+            recording["segments"] = segments
+        sys.stdout.write(json.dumps(recording, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,13 @@
 import os
+import time
 import subprocess
-from typing import Union, List, Callable, Optional
+from typing import Union, List, Callable, Optional, Tuple
 from copy import deepcopy
+from contextlib import contextmanager
 import functools
 import traceback
 from datetime import datetime
 
-import requests
-
 from .logger import main_logger
 
 
@@ -15,17 +15,48 @@ def safe_get(
     data: Union[dict, list],
     key_list: Union[List[Union[str, int]], str, int],
     default=None,
+    copy: bool = False,
 ):
-    if not isinstance(key_list, list):
-        return safe_get(data, [key_list], default=default)
+    """walk `key_list` into `data` without copying it
+
+    Set `copy` if the caller mutates the result. Only the result is copied then, not `data`.
+    """
+    if not isinstance(key_list, (list, tuple)):
+        key_list = (key_list,)
 
     try:
-        result = deepcopy(data)
+        result = data
         for key in key_list:
             result = result[key]
-        return result
-    except:
+    except (KeyError, IndexError, TypeError):
         return default
+    return deepcopy(result) if copy else result
+
+
+class KeyPath:
+    """a precompiled `safe_get` key list
+
+    ```python
+    METADATA_TITLE = KeyPath("metadata", "title")
+    title = METADATA_TITLE(stream_info)
+    ```
+    """
+
+    __slots__ = ("keys",)
+
+    def __init__(self, *keys: Union[str, int]):
+        self.keys = keys
+
+    def __call__(self, data: Union[dict, list], default=None):
+        try:
+            for key in self.keys:
+                data = data[key]
+        except (KeyError, IndexError, TypeError):
+            return default
+        return data
+
+    def __repr__(self) -> str:
+        return f"KeyPath{self.keys}"
 
 
 def silent_of(func: Callable) -> Callable:
@@ -38,19 +69,6 @@ def silent_of(func: Callable) -> Callable:
     return functools.update_wrapper(__func, func)
 
 
-@silent_of
-def send_discord_message(content: str, discord_webhook: str = None, username: str = None):
-    if not discord_webhook:
-        return
-
-    data = {"content": content}
-    if username:
-        data["username"] = username
-
-    response = requests.post(discord_webhook, json=data)
-    response.raise_for_status()
-
-
 def truncate_string_in_byte_size(unicode_string: str, size: int):
     # byte_string = unicode_string.encode('utf-8')
     # limit = size
@@ -152,3 +170,25 @@ def get_stdout_of_command(command: List[str]) -> Optional[str]:
         text=True,
     )
     return result
+
+
+class PhaseTimer:
+    """logs the time spent in each phase of the startup"""
+
+    def __init__(self) -> None:
+        self.started_at = time.monotonic()
+        self.phases: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str):
+        started_at = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - started_at
+            self.phases.append((name, elapsed))
+            main_logger.info("startup: %s took %.2fs", name, elapsed)
+
+    def summary(self) -> str:
+        phases = ", ".join(f"{name} {elapsed:.2f}s" for name, elapsed in self.phases)
+        return f"startup took {time.monotonic() - self.started_at:.2f}s ({phases})"
@@ -2,50 +2,186 @@
 # ("is_online", True)
 # ("is_online", False)
 # ("stream_info", stream_info)
+#
+# every subscriber has a bounded queue. nothing is lost unless the queue is full, and then the
+# subscription's policy decides what is dropped:
+# - DROP_OLDEST: the oldest queued message
+# - DROP_NEWEST: the new message
+# - COALESCE: only the latest message of the topic is kept at all. for state, e.g. "is the stream online"
+#
+# messages can be received blocking, with a timeout, or from asyncio.
 
+import asyncio
 import threading
-from typing import Dict, List, Optional
+import time
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
 from .logger import main_logger
+from .metrics import EVENT_DROPPED, EVENT_LAG, EVENT_QUEUE_DEPTH
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+COALESCE = "coalesce"
+
+
+class Event:
+    __slots__ = ("topic", "message", "published_at")
+
+    def __init__(self, topic: str, message: Any, published_at: float) -> None:
+        self.topic = topic
+        self.message = message
+        # time.monotonic()
+        self.published_at = published_at
+
+    def __repr__(self) -> str:
+        return f"Event({self.topic}, {self.message})"
 
 
 class Subscriber:
-    def __init__(self, name: str):
+    def __init__(self, name: str, maxsize: int = 100):
         self.name = name
-        self.event = threading.Event()
-        self.message = None
+        self.maxsize = maxsize
+        self.queue: Deque[Event] = deque()
+        self.condition = threading.Condition()
+        self.policies: Dict[str, str] = {}
+        # asyncio receivers waiting for a message
+        self.waiters: List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]] = []
+        # seconds from publish to receive of the last message, per topic
+        self.lags: Dict[str, float] = {}
+
+    def put(self, event: Event) -> str:
+        """returns what happened to the event: queued, coalesced or dropped"""
+        policy = self.policies.get(event.topic, DROP_OLDEST)
+        result = "queued"
+        with self.condition:
+            if policy == COALESCE:
+                for index, queued in enumerate(self.queue):
+                    if queued.topic == event.topic:
+                        del self.queue[index]
+                        result = "coalesced"
+                        break
+            if len(self.queue) >= self.maxsize:
+                if policy == DROP_NEWEST:
+                    return "dropped"
+                self.queue.popleft()
+                result = "dropped"
+            self.queue.append(event)
+            self.condition.notify_all()
+            waiters, self.waiters = self.waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_wake_up, future)
+        return result
 
-    def receive(self, timeout: Optional[float]):
-        """you must call `.event.clear()` after done"""
-        is_published = self.event.wait(timeout)
-        if not is_published:
+    def pop(self) -> Optional[Event]:
+        """call with `condition` held"""
+        if not self.queue:
             return None
+        event = self.queue.popleft()
+        self.lags[event.topic] = time.monotonic() - event.published_at
+        main_logger.info("receive event %s: %s", self.name, str(event.message))
+        return event
+
+    def receive_event(self, timeout: Optional[float] = None) -> Optional[Event]:
+        """the next event, or None after `timeout` seconds"""
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.queue, timeout):
+                return None
+            return self.pop()
 
-        # force to use the value only once
-        message = self.message
-        self.message = None
+    def receive(self, timeout: Optional[float] = None):
+        """the next message, or None after `timeout` seconds"""
+        event = self.receive_event(timeout)
+        return event.message if event else None
 
-        main_logger.info("receive event %s: %s", self.name, str(message))
-        return message
+    async def receive_event_async(self, timeout: Optional[float] = None) -> Optional[Event]:
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            with self.condition:
+                event = self.pop()
+                if event is not None:
+                    return event
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                with self.condition:
+                    if (loop, future) in self.waiters:
+                        self.waiters.remove((loop, future))
+                    return self.pop()
+
+    async def receive_async(self, timeout: Optional[float] = None):
+        event = await self.receive_event_async(timeout)
+        return event.message if event else None
+
+    def get_depth(self, topic: str) -> Tuple[int, float]:
+        """(queued messages of the topic, age of the oldest one in seconds)"""
+        now = time.monotonic()
+        with self.condition:
+            queued = [event for event in self.queue if event.topic == topic]
+        return len(queued), (now - queued[0].published_at if queued else 0.0)
+
+
+def _wake_up(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
 
 
 class Publisher:
-    def __init__(self):
+    def __init__(self, name: Optional[str] = None):
+        self.name = name or "default"
         self.subscribers: Dict[str, List[Subscriber]] = {}
+        self.lock = threading.Lock()
+        # published, dropped, coalesced per topic
+        self.counts: Dict[str, Dict[str, int]] = {}
 
-    def subscribe(self, subscriber: Subscriber, topic: str):
-        if topic not in self.subscribers:
-            self.subscribers[topic] = []
-        self.subscribers[topic].append(subscriber)
+    def subscribe(self, subscriber: Subscriber, topic: str, policy: str = DROP_OLDEST):
+        with self.lock:
+            subscriber.policies[topic] = policy
+            self.subscribers[topic] = self.subscribers.get(topic, []) + [subscriber]
 
     def unsubscribe(self, subscriber: Subscriber, topic: str):
-        if topic not in self.subscribers:
-            return
-        self.subscribers[topic] = [sub for sub in self.subscribers[topic] if sub != subscriber]
+        with self.lock:
+            if topic not in self.subscribers:
+                return
+            self.subscribers[topic] = [sub for sub in self.subscribers[topic] if sub != subscriber]
 
     def publish(self, topic, message):
         main_logger.info("publish event %s: %s", topic, str(message))
-        if topic in self.subscribers:
-            for subscriber in self.subscribers[topic]:
-                subscriber.message = message
-                subscriber.event.set()
+        event = Event(topic, message, time.monotonic())
+        with self.lock:
+            subscribers = self.subscribers.get(topic, [])
+        results = [subscriber.put(event) for subscriber in subscribers]
+
+        with self.lock:
+            counts = self.counts.setdefault(topic, {"published": 0, "dropped": 0, "coalesced": 0})
+            counts["published"] += 1
+            counts["dropped"] += results.count("dropped")
+            counts["coalesced"] += results.count("coalesced")
+        for subscriber, result in zip(subscribers, results):
+            if result == "dropped":
+                EVENT_DROPPED.inc(channel=self.name, topic=topic)
+                main_logger.warning("subscriber %s is full. dropped an event of %s", subscriber.name, topic)
+
+    def get_stats(self) -> Dict[str, dict]:
+        """per topic: subscribers, counts, queued messages, the oldest queued message and the last receive lag"""
+        with self.lock:
+            subscribers = dict(self.subscribers)
+            counts = {topic: dict(value) for topic, value in self.counts.items()}
+        stats = {}
+        for topic in set(subscribers) | set(counts):
+            depths = [subscriber.get_depth(topic) for subscriber in subscribers.get(topic, [])]
+            lags = [subscriber.lags[topic] for subscriber in subscribers.get(topic, []) if topic in subscriber.lags]
+            stats[topic] = {
+                "subscribers": len(subscribers.get(topic, [])),
+                **counts.get(topic, {"published": 0, "dropped": 0, "coalesced": 0}),
+                "depth": sum(depth for depth, _ in depths),
+                "oldest": max((age for _, age in depths), default=0.0),
+                "lag": max(lags, default=0.0),
+            }
+            EVENT_QUEUE_DEPTH.set(stats[topic]["depth"], channel=self.name, topic=topic)
+            EVENT_LAG.set(stats[topic]["lag"], channel=self.name, topic=topic)
+        return stats
@@ -0,0 +1,536 @@
+# keep an in-process recording going through stream errors without a gap or a new file
+#
+# - every byte read from streamlink's hls reader is tagged with the media sequence number of its segment
+# - `SequenceOutput` writes each media sequence once and in order, whichever pipeline delivered it first
+# - `FailoverFetcher` starts a replacement pipeline when the current one stalls, skips a segment or ends,
+#   and closes the old one only after the replacement took over. the replacement starts from the oldest
+#   segment of the playlist, but segments that are already written are not downloaded again
+# - when a media sequence is missing, the following ones are held back for `gap_timeout` seconds so the
+#   replacement can fill it in
+# - segments which streamlink filters out (ads with --twitch-disable-ads) count as written without data, so they
+#   are neither gaps nor stalls
+# - the tracker wraps methods of streamlink's hls writer. if they are not the known ones (any streamlink version
+#   can be installed), the recording runs without failover
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from .logger import main_logger
+from .stream_fetch import StreamFetcher
+
+
+class HLSSequenceTracker:
+    """maps the bytes read from a streamlink hls reader back to the media sequence numbers of their segments
+
+    `skip(sequence)` is asked before a segment is downloaded. `on_filtered()` is called when streamlink filters out
+    a segment. has to be attached before the reader is opened.
+    """
+
+    @staticmethod
+    def is_supported(reader) -> bool:
+        writer = getattr(reader, "writer", None)
+        buffer = getattr(reader, "buffer", None)
+        return all(callable(getattr(writer, name, None)) for name in ("fetch", "write", "should_filter_segment")) and (
+            callable(getattr(buffer, "write", None))
+        )
+
+    def __init__(self, reader, skip: Callable[[int], bool], on_filtered: Optional[Callable[[], None]] = None) -> None:
+        # (media sequence, stream offset of its first byte)
+        self.boundaries: Deque[Tuple[int, int]] = deque()
+        # (media sequence, stream offset) of the filtered segments
+        self.filtered_segments: Deque[Tuple[int, int]] = deque()
+        # held while read data is split and written, so a filtered segment is reported after the data before it
+        self.lock = threading.Lock()
+        self.written_offset = 0
+        self.read_offset = 0
+        self.sequence: Optional[int] = None
+        self.skipped = 0
+        self.filtered = 0
+
+        writer = reader.writer
+        fetch, write, buffer_write = writer.fetch, writer.write, reader.buffer.write
+
+        def tracked_fetch(segment):
+            if skip(segment.num):
+                self.skipped += 1
+                return None
+            return fetch(segment)
+
+        def tracked_write(segment, result, *data):
+            if writer.should_filter_segment(segment):
+                # nothing reaches the buffer
+                self.filtered += 1
+                self.filtered_segments.append((segment.num, self.written_offset))
+                if on_filtered:
+                    on_filtered()
+            else:
+                self.boundaries.append((segment.num, self.written_offset))
+            return write(segment, result, *data)
+
+        def tracked_buffer_write(data):
+            buffer_write(data)
+            self.written_offset += len(data)
+
+        writer.fetch = tracked_fetch
+        writer.write = tracked_write
+        reader.buffer.write = tracked_buffer_write
+
+    def pop_filtered(self, offset: int) -> List[Tuple[int, None]]:
+        """the filtered segments up to the stream offset"""
+        pieces = []
+        while self.filtered_segments and self.filtered_segments[0][1] <= offset:
+            pieces.append((self.filtered_segments.popleft()[0], None))
+        return pieces
+
+    def split(self, data: bytes) -> List[Tuple[Optional[int], Optional[bytes]]]:
+        """(media sequence, bytes) pairs of data read from the reader. bytes is None for a filtered segment"""
+        pieces = []
+        position = 0
+        while position < len(data):
+            offset = self.read_offset + position
+            pieces += self.pop_filtered(offset)
+            while self.boundaries and self.boundaries[0][1] <= offset:
+                self.sequence = self.boundaries.popleft()[0]
+            end = len(data)
+            if self.boundaries:
+                end = min(end, self.boundaries[0][1] - self.read_offset)
+            if self.filtered_segments:
+                end = min(end, self.filtered_segments[0][1] - self.read_offset)
+            pieces.append((self.sequence, data[position:end]))
+            position = end
+        self.read_offset += len(data)
+        return pieces + self.pop_filtered(self.read_offset)
+
+
+class _PendingSegment:
+    def __init__(self, source: object) -> None:
+        self.source = source
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+
+class SequenceOutput:
+    """writes every media sequence once and in order, from any number of pipelines (`source`s)
+
+    The segment being written is done when its source moves on to a later one, ends, or delivers nothing for
+    `gap_timeout` seconds. Later segments are held back until then. A missing segment is waited for
+    `gap_timeout` seconds or `max_pending_size` bytes.
+    """
+
+    def __init__(
+        self,
+        write: Callable[[bytes], None],
+        gap_timeout: float = 10,
+        max_pending_size: int = 64 * 1024 * 1024,
+        on_gap: Optional[Callable[[int], None]] = None,
+        bytes_counter=None,
+    ) -> None:
+        self.write_output = write
+        self.gap_timeout = gap_timeout
+        self.max_pending_size = max_pending_size
+        self.on_gap = on_gap
+        self.bytes_counter = bytes_counter
+
+        self.lock = threading.Lock()
+        self.sequence: Optional[int] = None
+        self.owner: Optional[object] = None
+        self.is_complete = True
+        self.pending: Dict[int, _PendingSegment] = {}
+        self.pending_size = 0
+        self.last_sequences: Dict[object, int] = {}
+        self.ended_sources = set()
+        self.gap_since: Optional[float] = None
+        self.emitted_at = time.monotonic()
+
+        self.bytes_written = 0
+        self.duplicate_bytes = 0
+        self.missing_sequences = 0
+        self.filtered_sequences = 0
+        self.switches = 0
+
+    def is_taken(self, sequence: int) -> bool:
+        """True if the segment is written or on its way. it does not have to be downloaded again"""
+        with self.lock:
+            return (self.sequence is not None and sequence <= self.sequence) or sequence in self.pending
+
+    def write(self, source: object, sequence: Optional[int], data: bytes):
+        with self.lock:
+            if sequence is None:
+                # not an hls stream. nothing to line up: the newest source takes over
+                if self.owner is None or source is self.owner or source not in self.last_sequences:
+                    self.last_sequences.setdefault(source, 0)
+                    self.set_owner(source)
+                    self.emit(data)
+                else:
+                    self.duplicate_bytes += len(data)
+                return
+
+            self.update_source(source, sequence)
+
+            if sequence == self.sequence and source is self.owner:
+                self.emit(data)
+                return
+            if self.sequence is not None and sequence <= self.sequence:
+                self.duplicate_bytes += len(data)
+                return
+
+            segment = self.pending.get(sequence)
+            if segment is None:
+                segment = self.pending[sequence] = _PendingSegment(source)
+            if segment.source is not source:
+                self.duplicate_bytes += len(data)
+                return
+            # a view of the fetcher's buffer, which is reused
+            segment.chunks.append(bytes(data))
+            segment.size += len(data)
+            self.pending_size += len(data)
+            self.advance()
+
+    def write_filtered(self, source: object, sequence: int):
+        """the source filtered out the segment. it is written as an empty segment, not waited for"""
+        with self.lock:
+            self.update_source(source, sequence)
+            if (self.sequence is not None and sequence <= self.sequence) or sequence in self.pending:
+                return
+            self.pending[sequence] = _PendingSegment(source)
+            self.filtered_sequences += 1
+            self.advance()
+
+    def update_source(self, source: object, sequence: int):
+        if self.last_sequences.get(source, sequence) < sequence and self.owner is source:
+            # the owner moved on
+            self.is_complete = True
+        self.last_sequences[source] = max(self.last_sequences.get(source, sequence), sequence)
+
+    def end_source(self, source: object):
+        """the source delivers nothing more. its segments are as complete as they get"""
+        with self.lock:
+            self.ended_sources.add(source)
+            if source is self.owner:
+                self.is_complete = True
+            self.advance()
+
+    def check(self):
+        """gives up on a missing segment after `gap_timeout`. called periodically"""
+        with self.lock:
+            self.advance()
+
+    def flush(self):
+        """writes everything that is held back. at the end of the recording"""
+        with self.lock:
+            self.is_complete = True
+            self.advance(force=True)
+
+    def advance(self, force: bool = False):
+        if not self.is_complete and self.pending and time.monotonic() - self.emitted_at > self.gap_timeout:
+            main_logger.warning("media sequence %d stopped. continue with the next one", self.sequence)
+            self.is_complete = True
+        while self.pending and (self.is_complete or force):
+            next_sequence = min(self.pending) if self.sequence is None else self.sequence + 1
+            if next_sequence not in self.pending:
+                if self.gap_since is None:
+                    self.gap_since = time.monotonic()
+                    main_logger.warning("media sequence %d is missing. wait for it", next_sequence)
+                    if self.on_gap:
+                        self.on_gap(next_sequence)
+                is_waiting = time.monotonic() - self.gap_since < self.gap_timeout
+                if is_waiting and self.pending_size < self.max_pending_size and not force:
+                    return
+                next_sequence = min(self.pending)
+                missing = next_sequence - self.sequence - 1
+                main_logger.warning("media sequence %d-%d is missing", self.sequence + 1, next_sequence - 1)
+                self.missing_sequences += missing
+            self.gap_since = None
+
+            segment = self.pending.pop(next_sequence)
+            self.pending_size -= segment.size
+            self.sequence = next_sequence
+            # an empty (filtered) segment is progress, too
+            self.emitted_at = time.monotonic()
+            self.set_owner(segment.source)
+            self.is_complete = (
+                segment.source in self.ended_sources or self.last_sequences.get(segment.source, 0) > next_sequence
+            )
+            for chunk in segment.chunks:
+                self.emit(chunk)
+            if force:
+                self.is_complete = True
+
+    def set_owner(self, source: object):
+        if self.owner is not None and source is not self.owner:
+            self.switches += 1
+        self.owner = source
+
+    def emit(self, data: bytes):
+        self.write_output(data)
+        self.emitted_at = time.monotonic()
+        self.bytes_written += len(data)
+        if self.bytes_counter:
+            self.bytes_counter.inc(len(data))
+
+    def get_stats(self) -> dict:
+        return {
+            "sequence": self.sequence,
+            "bytes_written": self.bytes_written,
+            "duplicate_bytes": self.duplicate_bytes,
+            "missing_sequences": self.missing_sequences,
+            "filtered_sequences": self.filtered_sequences,
+            "switches": self.switches,
+        }
+
+
+class FailoverFetcher:
+    """a `StreamFetcher` that replaces its pipeline on errors. same interface as StreamFetcher
+
+    `stall_timeout`: seconds without anything written before a replacement is started
+    `replacement_live_edge`: segments from the end of the playlist a replacement starts with (hls-live-edge)
+    `max_attempts`: replacements in a row that deliver nothing before the recording ends
+    """
+
+    def __init__(
+        self,
+        target_url: str,
+        target_stream: str,
+        streamlink_args: Optional[str],
+        chunk_size: int = 1024 * 1024,
+        readahead_size: Optional[int] = None,
+        bytes_counter=None,
+        stall_timeout: float = 10,
+        gap_timeout: float = 10,
+        replacement_live_edge: int = 99,
+        max_attempts: int = 3,
+        on_failover: Optional[Callable[[str], None]] = None,
+    ) -> None:
+        self.target_url = target_url
+        self.target_stream = target_stream
+        self.streamlink_args = streamlink_args
+        self.chunk_size = chunk_size
+        self.readahead_size = readahead_size
+        self.bytes_counter = bytes_counter
+        self.stall_timeout = stall_timeout
+        self.gap_timeout = gap_timeout
+        self.replacement_live_edge = replacement_live_edge
+        self.max_attempts = max_attempts
+        self.on_failover = on_failover
+
+        self.lock = threading.Lock()
+        self.fetchers: List[StreamFetcher] = []
+        self.pump_threads: Dict[StreamFetcher, threading.Thread] = {}
+        self.output: Optional[SequenceOutput] = None
+        self.is_closed = False
+        self.is_output_closed = False
+        self.wakeup = threading.Event()
+        self.failover_reason: Optional[str] = None
+        # False if the hls writer of the installed streamlink cannot be tracked
+        self.can_failover = True
+
+        self.failovers = 0
+        self.started_at: Optional[float] = None
+        self.first_byte_at: Optional[float] = None
+        self.ended_at: Optional[float] = None
+
+    @property
+    def stream_name(self) -> Optional[str]:
+        return self.fetchers[0].stream_name if self.fetchers else None
+
+    def create_fetcher(self, live_edge: Optional[int]) -> StreamFetcher:
+        def track_sequences(reader):
+            if not HLSSequenceTracker.is_supported(reader):
+                main_logger.warning("the hls writer of streamlink is not the known one. record without failover")
+                self.can_failover = False
+                return
+            fetcher.sequence_tracker = HLSSequenceTracker(
+                reader,
+                skip=self.is_taken,
+                on_filtered=self.wakeup.set,
+            )
+
+        fetcher = StreamFetcher(
+            self.target_url,
+            self.target_stream,
+            self.streamlink_args,
+            chunk_size=self.chunk_size,
+            readahead_size=self.readahead_size,
+            live_edge=live_edge,
+            prepare_reader=track_sequences,
+        )
+        fetcher.sequence_tracker = None
+        fetcher.open()
+        return fetcher
+
+    def is_taken(self, sequence: int) -> bool:
+        return self.output is not None and self.output.is_taken(sequence)
+
+    def open(self):
+        self.fetchers.append(self.create_fetcher(None))
+        self.started_at = self.fetchers[0].started_at
+
+    def close(self):
+        self.is_closed = True
+        self.wakeup.set()
+        with self.lock:
+            fetchers = list(self.fetchers)
+        for fetcher in fetchers:
+            fetcher.close()
+
+    def request_failover(self, reason: str):
+        if self.failover_reason is None:
+            self.failover_reason = reason
+        self.wakeup.set()
+
+    def start_pipeline(self, fetcher: StreamFetcher):
+        def write(data: bytes):
+            if self.first_byte_at is None:
+                self.first_byte_at = time.monotonic()
+            tracker = fetcher.sequence_tracker
+            try:
+                if tracker is None:
+                    self.output.write(fetcher, None, data)
+                    return
+                with tracker.lock:
+                    self.write_pieces(fetcher, tracker.split(data))
+            except (BrokenPipeError, ValueError):
+                self.is_output_closed = True
+                self.wakeup.set()
+                raise
+
+        def pump():
+            try:
+                fetcher.pump(write)
+            finally:
+                self.output.end_source(fetcher)
+                self.wakeup.set()
+
+        thread = threading.Thread(target=pump, name=f"{threading.current_thread().name}-{len(self.pump_threads)}")
+        thread.daemon = True
+        thread.start()
+        self.pump_threads[fetcher] = thread
+
+    def write_pieces(self, fetcher: StreamFetcher, pieces: List[Tuple[Optional[int], Optional[bytes]]]):
+        for sequence, piece in pieces:
+            if piece is None:
+                self.output.write_filtered(fetcher, sequence)
+            else:
+                self.output.write(fetcher, sequence, piece)
+
+    def write_filtered(self):
+        """the filtered segments after everything read so far. the pump of a paused stream reads nothing"""
+        for fetcher in list(self.fetchers):
+            tracker = fetcher.sequence_tracker
+            if tracker is None or not tracker.lock.acquire(blocking=False):
+                # the pump is writing. it writes them, too
+                continue
+            try:
+                self.write_pieces(fetcher, tracker.pop_filtered(tracker.read_offset))
+            finally:
+                tracker.lock.release()
+
+    def replace(self, reason: str) -> bool:
+        main_logger.warning("start a replacement stream: %s", reason)
+        try:
+            fetcher = self.create_fetcher(self.replacement_live_edge)
+        except Exception as e:
+            main_logger.warning("cannot open a replacement stream: %s", e)
+            return False
+        with self.lock:
+            if self.is_closed:
+                fetcher.close()
+                return False
+            self.fetchers.append(fetcher)
+        self.failovers += 1
+        if self.on_failover:
+            self.on_failover(reason)
+        self.start_pipeline(fetcher)
+        return True
+
+    def retire_old_pipelines(self):
+        """close the pipelines before the newest one once the newest one is written"""
+        newest = self.fetchers[-1]
+        if self.output.owner is not newest:
+            return
+        for fetcher in self.fetchers[:-1]:
+            if not fetcher.is_closed:
+                main_logger.info("the replacement stream took over. close the old one")
+                fetcher.close()
+
+    def run(self, pipe):
+        binary_pipe = getattr(pipe, "buffer", pipe)
+        self.output = SequenceOutput(
+            binary_pipe.write,
+            gap_timeout=self.gap_timeout,
+            on_gap=lambda sequence: self.request_failover(f"media sequence {sequence} is missing"),
+            bytes_counter=self.bytes_counter,
+        )
+        attempts = 0
+        progress = None
+        progress_at = time.monotonic()
+        try:
+            self.start_pipeline(self.fetchers[0])
+            while not self.is_closed and not self.is_output_closed:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                self.write_filtered()
+                self.output.check()
+                self.retire_old_pipelines()
+
+                if (self.output.bytes_written, self.output.sequence) != progress:
+                    progress = (self.output.bytes_written, self.output.sequence)
+                    progress_at = time.monotonic()
+                    attempts = 0
+
+                reason, self.failover_reason = self.failover_reason, None
+                if not any(thread.is_alive() for thread in self.pump_threads.values()):
+                    reason = "the stream ended"
+                elif reason is None and time.monotonic() - progress_at > self.stall_timeout:
+                    reason = f"nothing written for {self.stall_timeout}s"
+                if reason is None or self.is_closed or self.is_output_closed:
+                    continue
+                if not self.can_failover:
+                    if reason == "the stream ended":
+                        break
+                    continue
+
+                if attempts >= self.max_attempts:
+                    main_logger.warning("%d replacement streams delivered nothing. stop: %s", attempts, reason)
+                    break
+                attempts += 1
+                # the replacement gets its own `stall_timeout`
+                progress_at = time.monotonic()
+                if not self.replace(reason) and reason == "the stream ended":
+                    # most likely the broadcast ended
+                    break
+        finally:
+            self.ended_at = time.monotonic()
+            self.close()
+            for thread in self.pump_threads.values():
+                thread.join(timeout=10)
+            try:
+                self.output.flush()
+            except (BrokenPipeError, ValueError):
+                pass
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def start_pump_thread(self, pipe) -> threading.Thread:
+        thread = threading.Thread(target=self.run, args=(pipe,), name=f"{threading.current_thread().name}-fetch")
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get_stats(self) -> dict:
+        ended_at = self.ended_at or time.monotonic()
+        elapsed = ended_at - self.started_at if self.started_at else 0
+        stats = {
+            "stream": self.stream_name,
+            "elapsed": elapsed,
+            "time_to_first_byte": self.first_byte_at - self.started_at if self.first_byte_at else None,
+            "failovers": self.failovers,
+            "pipelines": [fetcher.get_stats() for fetcher in self.fetchers],
+        }
+        if self.output:
+            stats.update(self.output.get_stats())
+        return stats
@@ -0,0 +1,200 @@
+# live stats of a recording from ffmpeg's `-progress pipe:1`
+#
+# ffmpeg writes `key=value` lines and ends every block with `progress=continue` (or `progress=end`).
+# a block is applied at once, so readers never see a half updated state.
+
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from .logger import main_logger
+
+
+def parse_float(value: Optional[str]) -> Optional[float]:
+    """`N/A`, `4000.0kbits/s`, `1.01x` -> None, 4000.0, 1.01"""
+    if value is None:
+        return None
+    value = value.strip().rstrip("x").replace("kbits/s", "")
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def parse_int(value: Optional[str]) -> Optional[int]:
+    if value is None:
+        return None
+    try:
+        return int(value.strip())
+    except ValueError:
+        return None
+
+
+class FFmpegProgress:
+    def __init__(self, name: str, speed_window: float = 60) -> None:
+        """`speed_window`: seconds over which `recent_speed` is measured"""
+        self.name = name
+        self.speed_window = speed_window
+
+        self.lock = threading.Lock()
+        self.block: Dict[str, str] = {}
+        self.listeners: List[Callable[["FFmpegProgress"], None]] = []
+
+        # seconds of media written
+        self.out_time: Optional[float] = None
+        # bytes written. N/A for the segment muxer
+        self.total_size: Optional[int] = None
+        # kbit/s
+        self.bitrate: Optional[float] = None
+        # average since the start, as reported by ffmpeg
+        self.speed: Optional[float] = None
+        self.dup_frames = 0
+        self.drop_frames = 0
+        self.is_ended = False
+
+        self.started_at = time.monotonic()
+        self.updated_at: Optional[float] = None
+        # the last time out_time or total_size increased
+        self.advanced_at = self.started_at
+        self.history: Deque[Tuple[float, float]] = deque()
+
+    def add_listener(self, listener: Callable[["FFmpegProgress"], None]):
+        """`listener` is called from the output pump after every block"""
+        self.listeners.append(listener)
+
+    def feed_line(self, line: str):
+        key, sep, value = line.partition("=")
+        if not sep:
+            return
+        key = key.strip()
+        if key != "progress":
+            self.block[key] = value.strip()
+            return
+        self.apply(self.block, is_ended=value.strip() == "end")
+        self.block = {}
+
+    def apply(self, block: Dict[str, str], is_ended: bool = False):
+        now = time.monotonic()
+        # out_time_us is out_time in microseconds. out_time_ms is microseconds too (an ffmpeg bug kept for compat)
+        out_time_us = parse_int(block.get("out_time_us") or block.get("out_time_ms"))
+        out_time = out_time_us / 1_000_000 if out_time_us is not None and out_time_us >= 0 else None
+        total_size = parse_int(block.get("total_size"))
+
+        with self.lock:
+            if (out_time is not None and (self.out_time is None or out_time > self.out_time)) or (
+                total_size is not None and (self.total_size is None or total_size > self.total_size)
+            ):
+                self.advanced_at = now
+            if out_time is not None:
+                self.out_time = out_time
+                self.history.append((now, out_time))
+                while self.history and now - self.history[0][0] > self.speed_window:
+                    self.history.popleft()
+            if total_size is not None:
+                self.total_size = total_size
+            self.bitrate = parse_float(block.get("bitrate"))
+            self.speed = parse_float(block.get("speed"))
+            self.dup_frames = parse_int(block.get("dup_frames")) or 0
+            self.drop_frames = parse_int(block.get("drop_frames")) or 0
+            self.is_ended = is_ended
+            self.updated_at = now
+
+        for listener in self.listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                main_logger.warning("%s progress listener error: %s", self.name, e)
+
+    @property
+    def recent_speed(self) -> Optional[float]:
+        """media seconds written per second over the last `speed_window`. None until the window is filled"""
+        with self.lock:
+            if len(self.history) < 2:
+                return None
+            (first_at, first_out_time), (last_at, last_out_time) = self.history[0], self.history[-1]
+        if last_at - first_at < self.speed_window / 2:
+            return None
+        return (last_out_time - first_out_time) / (last_at - first_at)
+
+    def is_behind(self, min_speed: float = 1.0) -> bool:
+        speed = self.recent_speed
+        return speed is not None and speed < min_speed
+
+    def is_stalled(self, timeout: float) -> bool:
+        """neither the media time nor the size grew for `timeout` seconds"""
+        return not self.is_ended and time.monotonic() - self.advanced_at > timeout
+
+    def to_dict(self) -> dict:
+        return {
+            "out_time": self.out_time,
+            "total_size": self.total_size,
+            "bitrate": self.bitrate,
+            "speed": self.speed,
+            "recent_speed": self.recent_speed,
+            "dup_frames": self.dup_frames,
+            "drop_frames": self.drop_frames,
+            "is_ended": self.is_ended,
+        }
+
+
+class ProgressWatchdog:
+    """warns when a recording falls behind real time, and calls `on_stalled` once when it stops growing"""
+
+    def __init__(
+        self,
+        progress: FFmpegProgress,
+        min_speed: float,
+        stall_timeout: float,
+        on_stalled: Optional[Callable[[], None]] = None,
+        on_state: Optional[Callable[[bool, bool], None]] = None,
+        interval: float = 5,
+    ) -> None:
+        """`on_state(is_behind, is_stalled)` is called after every check"""
+        self.progress = progress
+        self.min_speed = min_speed
+        self.stall_timeout = stall_timeout
+        self.on_stalled = on_stalled
+        self.on_state = on_state
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.was_behind = False
+
+    def check(self) -> bool:
+        """returns False once stalled"""
+        progress = self.progress
+        is_behind = progress.is_behind(self.min_speed)
+        is_stalled = bool(self.stall_timeout) and progress.is_stalled(self.stall_timeout)
+        if self.on_state:
+            self.on_state(is_behind, is_stalled)
+
+        if is_behind and not self.was_behind:
+            main_logger.warning(
+                "%s falls behind real time: speed %.3f over the last %ds",
+                progress.name,
+                progress.recent_speed,
+                progress.speed_window,
+            )
+        elif self.was_behind and not is_behind:
+            main_logger.info("%s caught up with real time", progress.name)
+        self.was_behind = is_behind
+
+        if is_stalled:
+            main_logger.warning("%s stopped growing for %ds: %s", progress.name, self.stall_timeout, progress.to_dict())
+            if self.on_stalled:
+                self.on_stalled()
+            return False
+        return True
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            if self.progress.is_ended or not self.check():
+                return
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name=f"{threading.current_thread().name}-progress")
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,247 @@
+# install streamlink once per source instead of on every start
+#
+# - the requested source (STREAMLINK_GITHUB, STREAMLINK_COMMIT, STREAMLINK_VERSION or the latest release on pypi)
+#   is resolved to a version or a commit
+# - nothing is installed if that exact build is already installed, so pip does not run on a normal start
+# - built wheels are kept in `cache_dir`, so a reinstall works without network access
+# - an install runs before the recorder starts. streamlink is never replaced under running recordings, which
+#   import it in-process and start `python -m streamlink` subprocesses
+
+import glob
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from importlib import metadata
+from typing import Optional, Tuple
+
+from .logger import main_logger
+from .metadata_journal import write_json_atomic
+
+STREAMLINK_REPOSITORY = "https://github.com/streamlink/streamlink.git"
+STREAMLINK_PYPI_URL = "https://pypi.org/pypi/streamlink/json"
+
+
+class StreamlinkSource:
+    def __init__(self, requirement: str, version: Optional[str] = None, commit: Optional[str] = None) -> None:
+        """`requirement` is passed to pip. `version` or `commit` identifies the build, if known"""
+        self.requirement = requirement
+        self.version = version
+        self.commit = commit
+
+    @property
+    def key(self) -> str:
+        if self.commit:
+            return f"commit:{self.commit}"
+        if self.version:
+            return f"version:{self.version}"
+        return f"requirement:{self.requirement}"
+
+    @property
+    def is_resolved(self) -> bool:
+        return bool(self.commit or self.version)
+
+    def __repr__(self) -> str:
+        return f"StreamlinkSource({self.requirement}, {self.key})"
+
+
+def split_git_url(url: str) -> Tuple[str, Optional[str]]:
+    """(repository, ref) of `<repository>[@<ref>]`
+
+    the `@` of a user (`ssh://git@github.com/...`, `git@github.com:...`) is not a ref. scp-like urls are returned
+    as `ssh://` urls, which pip installs.
+    """
+    if "://" in url:
+        scheme, _, rest = url.partition("://")
+        netloc, slash, path = rest.partition("/")
+        prefix = f"{scheme}://{netloc}{slash}"
+    else:
+        # scp-like `git@github.com:user/repo.git`
+        netloc, _, path = url.partition(":")
+        prefix = f"ssh://{netloc}/"
+    if "@" in path:
+        path, _, ref = path.rpartition("@")
+    else:
+        ref = None
+    return prefix + path, ref or None
+
+
+def resolve_git_commit(repository: str, ref: Optional[str], timeout: float = 10) -> Optional[str]:
+    """`git ls-remote`. None without network access"""
+    if ref and len(ref) == 40 and all(c in "0123456789abcdef" for c in ref.lower()):
+        return ref.lower()
+    try:
+        output = subprocess.check_output(
+            ["git", "ls-remote", repository, ref or "HEAD"],
+            stderr=subprocess.DEVNULL,
+            text=True,
+            timeout=timeout,
+        )
+    except (OSError, subprocess.SubprocessError) as e:
+        main_logger.warning("cannot resolve %s@%s: %s", repository, ref or "HEAD", e)
+        return None
+    for line in output.splitlines():
+        commit, _, name = line.partition("\t")
+        if name in (ref or "HEAD", f"refs/heads/{ref}", f"refs/tags/{ref}", f"refs/tags/{ref}^{{}}"):
+            return commit
+    return output.split("\t", 1)[0] or None
+
+
+def resolve_latest_release(timeout: float = 10) -> Optional[str]:
+    """the version of the latest release on pypi. None without network access"""
+    try:
+        with urllib.request.urlopen(STREAMLINK_PYPI_URL, timeout=timeout) as response:
+            return json.load(response)["info"]["version"]
+    except (OSError, ValueError, KeyError) as e:
+        main_logger.warning("cannot resolve the latest streamlink release: %s", e)
+        return None
+
+
+def resolve_streamlink_source(
+    streamlink_github: Optional[str] = None,
+    streamlink_commit: Optional[str] = None,
+    streamlink_version: Optional[str] = None,
+) -> StreamlinkSource:
+    """same precedence as the environment variables: github, commit, version, the latest release"""
+    if streamlink_github:
+        repository, ref = split_git_url(streamlink_github)
+        commit = resolve_git_commit(repository, ref)
+        return StreamlinkSource(f"git+{repository}" + (f"@{ref}" if ref else ""), commit=commit)
+    if streamlink_commit:
+        # e.g. `refs/pull/<id>/head`. pip installs the ref, the commit it points to identifies the build
+        commit = resolve_git_commit(STREAMLINK_REPOSITORY, streamlink_commit)
+        return StreamlinkSource(f"git+{STREAMLINK_REPOSITORY}@{streamlink_commit}", commit=commit)
+    if streamlink_version:
+        return StreamlinkSource(f"streamlink=={streamlink_version}", version=streamlink_version)
+    version = resolve_latest_release()
+    if version:
+        return StreamlinkSource(f"streamlink=={version}", version=version)
+    return StreamlinkSource("streamlink")
+
+
+def get_installed_streamlink() -> Optional[StreamlinkSource]:
+    try:
+        distribution = metadata.distribution("streamlink")
+    except metadata.PackageNotFoundError:
+        return None
+    commit = None
+    try:
+        direct_url = json.loads(distribution.read_text("direct_url.json") or "{}")
+        commit = direct_url.get("vcs_info", {}).get("commit_id")
+    except (OSError, ValueError):
+        pass
+    return StreamlinkSource("streamlink", version=distribution.version, commit=commit)
+
+
+class StreamlinkInstaller:
+    def __init__(self, cache_dir: str) -> None:
+        self.cache_dir = cache_dir
+        self.wheel_dir = os.path.join(cache_dir, "wheels")
+        self.state_filepath = os.path.join(cache_dir, "state.json")
+        self.lock = threading.Lock()
+
+    def load_state(self) -> dict:
+        try:
+            with open(self.state_filepath, "r", encoding="utf8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"wheels": {}}
+
+    def save_state(self, state: dict):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        write_json_atomic(self.state_filepath, state, indent=2)
+
+    def is_installed(self, source: StreamlinkSource, installed: Optional[StreamlinkSource]) -> bool:
+        if installed is None:
+            return False
+        if source.commit:
+            if installed.commit == source.commit:
+                return True
+            # installed from a wheel of this commit. the wheel has no vcs info
+            return self.load_state().get("installed") == source.key
+        if source.version:
+            return installed.version == source.version and not installed.commit
+        if source.requirement == "streamlink":
+            # the latest release, but pypi is not reachable. there is nothing to compare with
+            return True
+        # an unresolved git url: anything installed from this request is fine for now
+        return self.load_state().get("requested") == source.requirement
+
+    def get_cached_wheel(self, source: StreamlinkSource) -> Optional[str]:
+        if not source.is_resolved:
+            return None
+        filename = self.load_state()["wheels"].get(source.key)
+        if filename and os.path.exists(os.path.join(self.wheel_dir, filename)):
+            return os.path.join(self.wheel_dir, filename)
+        return None
+
+    def build_wheel(self, source: StreamlinkSource) -> Optional[str]:
+        os.makedirs(self.wheel_dir, exist_ok=True)
+        started_at = time.time()
+        subprocess.run(
+            [sys.executable, "-m", "pip", "wheel", "--wheel-dir", self.wheel_dir, source.requirement],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            check=True,
+        )
+        pattern = f"streamlink-{source.version}-*.whl" if source.version else "streamlink-*.whl"
+        wheels = sorted(glob.glob(os.path.join(self.wheel_dir, pattern)), key=os.path.getmtime)
+        if not wheels:
+            return None
+        wheel = wheels[-1]
+        if source.commit and os.path.getmtime(wheel) < started_at:
+            return None
+        return wheel
+
+    def install(self, source: StreamlinkSource) -> str:
+        with self.lock:
+            if not source.is_resolved:
+                # an unresolved source. pip decides if there is anything to do
+                command = [sys.executable, "-m", "pip", "install", "--upgrade", source.requirement]
+                wheel = None
+            else:
+                wheel = self.get_cached_wheel(source)
+                if wheel:
+                    main_logger.info("install streamlink from the cached wheel %s", os.path.basename(wheel))
+                else:
+                    main_logger.info("build streamlink %s", source.requirement)
+                    wheel = self.build_wheel(source)
+                command = [sys.executable, "-m", "pip", "install", "--upgrade", "--force-reinstall"]
+                # dependencies were built into the same directory by `pip wheel`
+                command += ["--no-index", "--find-links", self.wheel_dir, wheel] if wheel else [source.requirement]
+
+            output = subprocess.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                check=True,
+            ).stdout
+
+            state = self.load_state()
+            if wheel:
+                state["wheels"][source.key] = os.path.basename(wheel)
+            state["installed"] = source.key
+            state["requested"] = source.requirement
+            self.save_state(state)
+            return output
+
+    def ensure(self, source: StreamlinkSource) -> str:
+        """installs `source` unless it is installed. call before streamlink is imported. returns a line for the log"""
+        installed = get_installed_streamlink()
+        if self.is_installed(source, installed):
+            return f"streamlink {installed.version} is already installed for {source.requirement}"
+
+        try:
+            self.install(source)
+        except Exception as e:
+            if installed is None:
+                # nothing to record with
+                raise
+            main_logger.error("cannot install %s: %s", source, e)
+            return f"keep streamlink {installed.version}"
+        installed = get_installed_streamlink()
+        return f"installed streamlink {installed.version if installed else '?'} for {source.requirement}"
@@ -1,9 +1,28 @@
 # multithread-safe, but not multiprocessing-safe
+#
+# loggers only put records on a queue. one listener thread formats and writes them,
+# so a slow /log volume does not block the threads that log (e.g. the ones feeding ffmpeg).
 
 from datetime import datetime, timezone
+import atexit
+import json
 import logging
-from logging.handlers import TimedRotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
 import os
+import queue
+import threading
+from typing import Dict, List, Optional
+
+from .ownership import OWNERSHIP
+
+# text or json. json writes one object per line to `<name>.jsonl` instead of `<name>.log`
+LOG_FORMAT = os.getenv("LOG_FORMAT") or "text"
+# records waiting for the writer. records below WARNING are dropped (and counted) when it is nearly full
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE") or 10000)
+# the part of the queue kept for WARNING and above
+LOG_QUEUE_RESERVE = 0.1
+# seconds a WARNING or above waits for room when even the reserve is full
+LOG_QUEUE_BLOCK_TIMEOUT = 1.0
 
 raw_formatter = logging.Formatter(fmt="%(message)s")
 
@@ -53,28 +72,138 @@ class _CustomFormatter(logging.Formatter):
         super().__init__(fmt, datefmt, style, validate)
         self.name = name
         self.use_color = use_color
+        self.formatters: Dict[int, logging.Formatter] = {
+            levelno: _TimezoneFormatter(self.format_message(levelno)) for levelno in self.COLORS
+        }
 
     def format_message(self, levelno):
         return (
             (self.COLORS.get(levelno) if self.use_color else "")
             + "[%(asctime)s]["
             + self.name
-            + "][%(levelname)s][%(process)s] %(message)s"
+            + "][%(levelname)s][%(process)s][%(threadName)s] %(message)s"
             + (self.reset if self.use_color else "")
             + "\n\t(%(pathname)s:%(lineno)d (%(funcName)s)"
         )
 
     def format(self, record):
-        message_format = self.format_message(record.levelno)
-        formatter = _TimezoneFormatter(message_format)
+        formatter = self.formatters.get(record.levelno)
+        if formatter is None:
+            formatter = self.formatters[record.levelno] = _TimezoneFormatter(self.format_message(record.levelno))
         return formatter.format(record)
 
 
+class _JsonFormatter(_TimezoneFormatter):
+    def format(self, record):
+        data = {
+            "time": self.formatTime(record),
+            "logger": record.name,
+            "level": record.levelname,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+            "pathname": record.pathname,
+            "lineno": record.lineno,
+            "funcName": record.funcName,
+        }
+        if record.exc_info:
+            data["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False)
+
+
+class _DispatchHandler(logging.Handler):
+    """runs in the listener thread and passes each record to the handlers of its logger"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.handlers: Dict[str, List[logging.Handler]] = {}
+
+    def handle(self, record):
+        for handler in self.handlers.get(record.name, ()):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+    def emit(self, record):
+        pass
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """never blocks the caller below WARNING. those records are dropped when the queue is nearly full and reported
+    later. WARNING and above can use the reserved end of the queue, and wait briefly for room when it is full too
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped_count = 0
+        self.dropped_total = 0
+        self.counter_lock = threading.Lock()
+        # records below WARNING are dropped from this size on
+        self.soft_limit = log_queue.maxsize - max(int(log_queue.maxsize * LOG_QUEUE_RESERVE), 1)
+
+    def handle(self, record):
+        # the queue is thread safe. with the handler lock every thread would wait for one which waits for room
+        rv = self.filter(record)
+        if rv:
+            self.emit(rv if isinstance(rv, logging.LogRecord) else record)
+        return rv
+
+    def put(self, record, can_wait: bool) -> bool:
+        try:
+            if can_wait:
+                self.queue.put(record, timeout=LOG_QUEUE_BLOCK_TIMEOUT)
+                return True
+            if self.queue.maxsize > 0 and self.queue.qsize() >= self.soft_limit:
+                return False
+            self.queue.put_nowait(record)
+            return True
+        except queue.Full:
+            return False
+
+    def enqueue(self, record):
+        with self.counter_lock:
+            dropped_count, self.dropped_count = self.dropped_count, 0
+        if dropped_count:
+            report = logging.makeLogRecord(
+                {
+                    "name": record.name,
+                    "levelno": logging.WARNING,
+                    "levelname": "WARNING",
+                    "msg": f"{dropped_count} log records were dropped",
+                }
+            )
+            # the report does not take the reserve. it is sent with a later record if it does not fit
+            if not self.put(report, can_wait=False):
+                with self.counter_lock:
+                    self.dropped_count += dropped_count
+
+        if not self.put(record, can_wait=record.levelno >= logging.WARNING):
+            with self.counter_lock:
+                self.dropped_count += 1
+                self.dropped_total += 1
+
+
+_LOG_QUEUE: queue.Queue = queue.Queue(LOG_QUEUE_SIZE)
+_DISPATCH_HANDLER = _DispatchHandler()
+_LISTENER: Optional[QueueListener] = None
+_LISTENER_LOCK = threading.Lock()
+
+
+def __start_listener():
+    global _LISTENER  # pylint: disable=global-statement
+    with _LISTENER_LOCK:
+        if _LISTENER is not None:
+            return
+        _LISTENER = QueueListener(_LOG_QUEUE, _DISPATCH_HANDLER)
+        _LISTENER.start()
+        # write what is left in the queue before exit
+        atexit.register(_LISTENER.stop)
+
+
 def __get_file_handler(name: str, log_dir: str):
-    filename = f"{name}.log"
+    filename = f"{name}.jsonl" if LOG_FORMAT == "json" else f"{name}.log"
     filepath = os.path.join(log_dir, filename)
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
-    os.system(f'sudo chown -R abc:abc "{os.path.dirname(filepath)}"')
+    OWNERSHIP.makedirs(os.path.dirname(filepath))
 
     file_handler = TimedRotatingFileHandler(
         filename=filepath,
@@ -90,7 +219,8 @@ def __get_file_handler(name: str, log_dir: str):
     return file_handler
 
 
-def get_logger(name: str, custom_format=True):
+def get_logger(name: str, custom_format=True, use_queue=True):
+    """`use_queue=False` writes from the calling thread"""
     log_dir = os.path.realpath(os.getenv("LOG_DIR", "/log"))
 
     logger = logging.getLogger(name)
@@ -102,15 +232,22 @@ def get_logger(name: str, custom_format=True):
         stream_handler.setFormatter(_CustomFormatter(name))
     else:
         stream_handler.setFormatter(raw_formatter)
-    logger.handlers = [stream_handler]
 
     file_handler = __get_file_handler(name, log_dir=log_dir)
-    if custom_format:
+    if LOG_FORMAT == "json":
+        file_handler.setFormatter(_JsonFormatter())
+    elif custom_format:
         file_handler.setFormatter(_CustomFormatter(name, use_color=False))
     else:
         file_handler.setFormatter(raw_formatter)
-    logger.addHandler(file_handler)
 
+    if not use_queue:
+        logger.handlers = [stream_handler, file_handler]
+        return logger
+
+    _DISPATCH_HANDLER.handlers[name] = [stream_handler, file_handler]
+    logger.handlers = [_DroppingQueueHandler(_LOG_QUEUE)]
+    __start_listener()
     return logger
 
 
@@ -0,0 +1,112 @@
+# the metadata changes of a broadcast
+#
+# a 24/7 stream with a bot changing the title every few minutes makes thousands of changes. a record is a
+# __slots__ object with a float time and interned plugin, id, author and category, and a bounded history keeps the
+# first record (the start of the broadcast) and the newest `max_size - 1`. every record keeps its position in the
+# broadcast, so the journal and the catalog know which records they have after older ones were dropped.
+
+import sys
+import threading
+import time
+from collections import deque
+from typing import Deque, List, Optional
+
+
+def intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class MetadataRecord:
+    """read-only once added to a history"""
+
+    __slots__ = ("position", "plugin", "id", "author", "category", "title", "changed_at")
+
+    def __init__(
+        self,
+        position: int,
+        plugin: str,
+        metadata_id: str,
+        author: str,
+        category: str,
+        title: str,
+        changed_at: Optional[float] = None,
+    ) -> None:
+        self.position = position
+        self.plugin = intern(plugin)
+        self.id = intern(metadata_id)
+        self.author = intern(author)
+        self.category = intern(category)
+        # mostly different per record. interning them only grows the interned strings table
+        self.title = title
+        # unix time
+        self.changed_at = time.time() if changed_at is None else changed_at
+
+    def is_same(self, plugin: str, metadata_id: str, author: str, category: str, title: str) -> bool:
+        return (
+            self.plugin == plugin
+            and self.id == metadata_id
+            and self.author == author
+            and self.category == category
+            and self.title == title
+        )
+
+    def to_dict(self) -> dict:
+        """a new dict in the format of the `.json` file"""
+        changed_at = time.localtime(self.changed_at)
+        return {
+            "plugin": self.plugin,
+            "id": self.id,
+            "author": self.author,
+            "category": self.category,
+            "title": self.title,
+            "timestamp": time.strftime("%Y%m%dT%H%M%S%z", changed_at),
+            "datetime": time.strftime("%Y%m%d_%H%M%S", changed_at),
+        }
+
+    def __repr__(self) -> str:
+        return f"MetadataRecord({self.position}, {self.to_dict()})"
+
+
+class MetadataHistory:
+    def __init__(self, max_size: int = 0) -> None:
+        """`max_size`: records kept, at least 2. 0 is no limit"""
+        self.max_size = max(max_size, 2) if max_size else 0
+        self.first: Optional[MetadataRecord] = None
+        self.rest: Deque[MetadataRecord] = deque(maxlen=self.max_size - 1 if self.max_size else None)
+        # records ever added
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return (self.first is not None) + len(self.rest)
+
+    @property
+    def latest(self) -> Optional[MetadataRecord]:
+        with self.lock:
+            return self.rest[-1] if self.rest else self.first
+
+    @property
+    def dropped(self) -> int:
+        return self.count - len(self)
+
+    def add(self, plugin: str, metadata_id: str, author: str, category: str, title: str) -> Optional[MetadataRecord]:
+        """the new record, or None if the metadata did not change"""
+        latest = self.latest
+        if latest is not None and latest.is_same(plugin, metadata_id, author, category, title):
+            return None
+        record = MetadataRecord(self.count, plugin, metadata_id, author, category, title)
+        with self.lock:
+            if self.first is None:
+                self.first = record
+            else:
+                self.rest.append(record)
+            self.count += 1
+        return record
+
+    def get_records(self) -> List[MetadataRecord]:
+        """the kept records, oldest first. the list is new, the records are shared"""
+        with self.lock:
+            return ([self.first] if self.first is not None else []) + list(self.rest)
+
+    def to_list(self) -> List[dict]:
+        return [record.to_dict() for record in self.get_records()]
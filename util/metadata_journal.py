@@ -0,0 +1,105 @@
+# append-only metadata journal
+#
+# while recording, every metadata change is appended to `<filepath>.jsonl` as one json line and fsync'd.
+# when the recording ends the journal is compacted to the usual pretty `<filepath>.json`.
+# a crash leaves at most one truncated line, which `read_journal` skips.
+#
+# usage: python -m util.metadata_journal <filepath.jsonl> [...]    # compact leftover journals
+
+import os
+import sys
+import json
+from typing import List, Optional
+
+from .logger import main_logger
+
+JOURNAL_EXTNAME = ".jsonl"
+
+
+def write_json_atomic(filepath: str, data, **kwargs):
+    """write to a temporary file and rename it, so readers see either the old or the new file"""
+    tmp_filepath = f"{filepath}.tmp"
+    with open(tmp_filepath, "w", encoding="utf8") as f:
+        json.dump(data, f, ensure_ascii=False, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filepath, filepath)
+
+
+def read_journal(filepath: str) -> List[dict]:
+    records = []
+    with open(filepath, "r", encoding="utf8", errors="ignore") as f:
+        for nth, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                main_logger.warning("skip broken journal line %s:%d", filepath, nth)
+    return records
+
+
+class MetadataJournal:
+    def __init__(self, filepath: str) -> None:
+        """`filepath` is the recording path without extension"""
+        self.filepath = filepath
+        self.journal_filepath = f"{filepath}{JOURNAL_EXTNAME}"
+        # the position of the next record
+        self.count = 0
+        self.fd = None
+
+    def open(self):
+        if self.fd is not None:
+            return
+        self.fd = os.open(self.journal_filepath, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+        # terminate a line truncated by a previous crash so the next record starts on its own line
+        size = os.fstat(self.fd).st_size
+        if size and os.pread(self.fd, 1, size - 1) != b"\n":
+            os.write(self.fd, b"\n")
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def append(self, record: dict):
+        self.open()
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf8")
+        # O_APPEND with a single write keeps a record in one piece unless the process dies mid-write
+        written = os.write(self.fd, data)
+        while written < len(data):
+            written += os.write(self.fd, data[written:])
+        os.fsync(self.fd)
+        self.count += 1
+
+    def extend(self, stack: List[dict], positions: Optional[List[int]] = None):
+        """append the records of `stack` which are not in the journal yet
+
+        `positions`: the position of every record in the broadcast, if older records were dropped from the stack
+        """
+        for position, record in zip(positions or range(len(stack)), stack):
+            if position < self.count:
+                continue
+            self.append(record)
+            self.count = position + 1
+
+    def compact(self):
+        """write `<filepath>.json` from the journal and remove the journal"""
+        self.close()
+        if not os.path.exists(self.journal_filepath):
+            return
+        write_json_atomic(f"{self.filepath}.json", read_journal(self.journal_filepath), indent=2)
+        os.remove(self.journal_filepath)
+
+
+def compact_journal(journal_filepath: str):
+    if not journal_filepath.endswith(JOURNAL_EXTNAME):
+        raise ValueError(f"not a journal: {journal_filepath}")
+    MetadataJournal(journal_filepath[: -len(JOURNAL_EXTNAME)]).compact()
+
+
+if __name__ == "__main__":
+    for arg in sys.argv[1:]:
+        compact_journal(arg)
+        main_logger.info("compacted %s", arg)
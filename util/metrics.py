@@ -0,0 +1,304 @@
+# in-process metrics
+#
+# counters, gauges and histograms with labels, exposed as prometheus text on `METRICS_PORT`
+# and optionally dumped to a json file periodically.
+#
+# updates are a dict lookup and an addition under a per-metric lock. on hot paths, bind the labels once
+# with `.labels(...)` and update the returned child.
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+from .logger import main_logger
+from .metadata_journal import write_json_atomic
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Child:
+    """a metric with its labels bound"""
+
+    __slots__ = ("metric", "key")
+
+    def __init__(self, metric: "_Metric", key: Tuple) -> None:
+        self.metric = metric
+        self.key = key
+
+    def inc(self, value: float = 1):
+        self.metric.inc_key(self.key, value)
+
+    def set(self, value: float):
+        self.metric.set_key(self.key, value)
+
+    def observe(self, value: float):
+        self.metric.observe_key(self.key, value)
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values: Dict[Tuple, float] = {}
+
+    def get_key(self, labels: dict) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def labels(self, **labels) -> _Child:
+        return _Child(self, self.get_key(labels))
+
+    def inc_key(self, key: Tuple, value: float):
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def set_key(self, key: Tuple, value: float):
+        with self.lock:
+            self.values[key] = value
+
+    def get_values(self) -> Dict[Tuple, float]:
+        with self.lock:
+            return dict(self.values)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            items = list(self.values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{format_labels(self.label_names, key)} {value}")
+        return lines
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            items = list(self.values.items())
+        return {
+            "type": self.metric_type,
+            "values": [{"labels": dict(zip(self.label_names, key)), "value": value} for key, value in items],
+        }
+
+
+class Counter(_Metric):
+    metric_type = "counter"
+
+    def inc(self, value: float = 1, **labels):
+        self.inc_key(self.get_key(labels), value)
+
+
+class Gauge(_Metric):
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.set_key(self.get_key(labels), value)
+
+    def inc(self, value: float = 1, **labels):
+        self.inc_key(self.get_key(labels), value)
+
+
+class Histogram(_Metric):
+    metric_type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [bucket counts..., +Inf count, sum]
+        self.histograms: Dict[Tuple, List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        self.observe_key(self.get_key(labels), value)
+
+    def observe_key(self, key: Tuple, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 2)
+            histogram[index] += 1
+            histogram[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            items = [(key, list(histogram)) for key, histogram in self.histograms.items()]
+        for key, histogram in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram[:-1]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                bucket_labels = format_labels(self.label_names, key, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, key)} {histogram[-1]}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            items = [(key, list(histogram)) for key, histogram in self.histograms.items()]
+        return {
+            "type": self.metric_type,
+            "buckets": list(self.buckets),
+            "values": [
+                {
+                    "labels": dict(zip(self.label_names, key)),
+                    "counts": histogram[:-1],
+                    "count": sum(histogram[:-1]),
+                    "sum": histogram[-1],
+                }
+                for key, histogram in items
+            ],
+        }
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self.metrics: Dict[str, _Metric] = {}
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def to_dict(self) -> dict:
+        return {"timestamp": time.time(), "metrics": {name: metric.to_dict() for name, metric in self.metrics.items()}}
+
+
+REGISTRY = MetricsRegistry()
+
+PROBE_DURATION = REGISTRY.register(
+    Histogram("recorder_probe_duration_seconds", "Duration of one online check", ("channel", "engine"))
+)
+STREAM_TRANSITIONS = REGISTRY.register(
+    Counter("recorder_stream_transitions_total", "Online and offline transitions", ("channel", "state"))
+)
+RECORDING_BYTES = REGISTRY.register(
+    Counter("recorder_recording_bytes_total", "Bytes written by recordings", ("channel",))
+)
+RECORDING_SEGMENTS = REGISTRY.register(
+    Counter("recorder_recording_segments_total", "Segment files finished by recordings", ("channel",))
+)
+RECORDING_RESTARTS = REGISTRY.register(
+    Counter("recorder_recording_restarts_total", "download_stream retries within one broadcast", ("channel",))
+)
+RECORDING_FAILOVERS = REGISTRY.register(
+    Counter("recorder_recording_failovers_total", "Replacement streams started within one recording", ("channel",))
+)
+RECORDING_ACTIVE = REGISTRY.register(Gauge("recorder_recording_active", "1 while recording", ("channel",)))
+TIME_TO_FIRST_BYTE = REGISTRY.register(
+    Histogram(
+        "recorder_time_to_first_byte_seconds",
+        "Time from the online transition to the first byte written",
+        ("channel",),
+        buckets=(1, 2, 5, 10, 15, 30, 60, 120),
+    )
+)
+FFMPEG_SPEED = REGISTRY.register(
+    Gauge("recorder_ffmpeg_speed", "ffmpeg processing speed (1.0 = realtime)", ("channel",))
+)
+FFMPEG_BITRATE = REGISTRY.register(Gauge("recorder_ffmpeg_bitrate_kbps", "ffmpeg output bitrate", ("channel",)))
+FFMPEG_OUT_TIME = REGISTRY.register(
+    Gauge("recorder_ffmpeg_out_time_seconds", "Media time written by ffmpeg", ("channel",))
+)
+FFMPEG_DROP_FRAMES = REGISTRY.register(Gauge("recorder_ffmpeg_drop_frames", "Frames dropped by ffmpeg", ("channel",)))
+FFMPEG_DUP_FRAMES = REGISTRY.register(Gauge("recorder_ffmpeg_dup_frames", "Frames duplicated by ffmpeg", ("channel",)))
+RECORDING_BEHIND = REGISTRY.register(
+    Gauge("recorder_recording_behind", "1 while the recording is slower than real time", ("channel",))
+)
+RECORDING_STALLED = REGISTRY.register(
+    Gauge("recorder_recording_stalled", "1 when the recording stopped growing", ("channel",))
+)
+
+EVENT_QUEUE_DEPTH = REGISTRY.register(
+    Gauge("recorder_event_queue_depth", "Events waiting for subscribers", ("channel", "topic"))
+)
+EVENT_LAG = REGISTRY.register(
+    Gauge("recorder_event_lag_seconds", "Time from publish to receive of the last event", ("channel", "topic"))
+)
+EVENT_DROPPED = REGISTRY.register(
+    Counter("recorder_events_dropped_total", "Events dropped because a subscriber queue was full", ("channel", "topic"))
+)
+STANDBY_READY = REGISTRY.register(
+    Gauge("recorder_standby_ready", "1 while a pre-started streamlink process waits", ("channel",))
+)
+STANDBY_TAKEN = REGISTRY.register(
+    Counter("recorder_standby_taken_total", "Recordings started with a pre-started streamlink process", ("channel",))
+)
+STORAGE_FREE_BYTES = REGISTRY.register(Gauge("recorder_storage_free_bytes", "Free bytes of the recording volume"))
+STORAGE_TIME_TO_FULL = REGISTRY.register(
+    Gauge("recorder_storage_time_to_full_seconds", "Time until the low watermark is reached, -1 if nothing is written")
+)
+STORAGE_EVICTED = REGISTRY.register(
+    Counter("recorder_storage_evicted_bytes_total", "Bytes of recordings removed for free space", ("channel", "reason"))
+)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render_prometheus().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def start_metrics_server(port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server")
+    thread.daemon = True
+    thread.start()
+    main_logger.info("metrics endpoint: http://%s:%d/metrics", host, port)
+    return server
+
+
+def start_metrics_dump(filepath: str, interval: float) -> threading.Thread:
+    def dump_loop():
+        while True:
+            time.sleep(interval)
+            try:
+                write_json_atomic(filepath, REGISTRY.to_dict())
+            except Exception as e:
+                main_logger.warning("cannot dump metrics to %s: %s", filepath, e)
+
+    thread = threading.Thread(target=dump_loop, name="metrics-dump")
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def observe_time_to_first_byte(channel: str, online_at: Optional[float], first_byte_at: Optional[float]):
+    """`online_at` and `first_byte_at` are time.monotonic() values"""
+    if online_at is None or first_byte_at is None:
+        return
+    TIME_TO_FIRST_BYTE.observe(max(first_byte_at - online_at, 0), channel=channel)
@@ -0,0 +1,237 @@
+# discord webhook notifications from a background thread
+#
+# - `notify()` only queues the message, so a slow or rate limited webhook never delays a recording
+# - messages that arrive within `coalesce_window` seconds are sent as one (many channels going live at once)
+# - one pooled http session with timeouts. 429 waits for discord's `retry_after`, 5xx and connection errors
+#   back off exponentially
+# - "already sent" keys are kept in a json file, so a restart does not send the same ON message again. a key is
+#   marked by the background thread once discord accepted the message, so a dropped or failed one is sent again
+
+import json
+import os
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+import requests
+
+from .logger import main_logger
+from .metadata_journal import write_json_atomic
+
+# discord rejects longer contents
+MAX_CONTENT_LENGTH = 2000
+
+
+class SentStore:
+    """the last `size` keys sent per kind, e.g. the stream ids of ON messages. kept in `filepath` if set
+
+    `add` writes the file. call it from the thread which sends, not from the one which records
+    """
+
+    def __init__(self, filepath: Optional[str] = None, size: int = 100) -> None:
+        self.filepath = filepath
+        self.size = size
+        self.lock = threading.Lock()
+        self.keys: Dict[str, List[str]] = {}
+        if filepath:
+            try:
+                with open(filepath, "r", encoding="utf8") as f:
+                    self.keys = json.load(f)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                main_logger.warning("cannot read %s: %s", filepath, e)
+
+    def contains(self, kind: str, key: str) -> bool:
+        with self.lock:
+            return key in self.keys.get(kind, [])
+
+    def add(self, kind: str, key: str) -> bool:
+        """False if the key was already sent"""
+        with self.lock:
+            keys = self.keys.get(kind, [])
+            if key in keys:
+                return False
+            self.keys[kind] = keys[-(self.size - 1) :] + [key]
+            if self.filepath:
+                try:
+                    os.makedirs(os.path.dirname(self.filepath) or ".", exist_ok=True)
+                    write_json_atomic(self.filepath, self.keys)
+                except OSError as e:
+                    main_logger.warning("cannot write %s: %s", self.filepath, e)
+            return True
+
+
+class DiscordNotifier:
+    def __init__(
+        self,
+        webhook: str,
+        sent_store: Optional[SentStore] = None,
+        username: Optional[str] = None,
+        coalesce_window: float = 2.0,
+        timeout: Tuple[float, float] = (3.05, 10),
+        max_attempts: int = 5,
+        max_backoff: float = 60,
+        queue_size: int = 1000,
+    ) -> None:
+        """`timeout`: (connect, read) seconds of one request"""
+        self.webhook = webhook
+        self.sent_store = sent_store or SentStore()
+        self.username = username
+        self.coalesce_window = coalesce_window
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.max_backoff = max_backoff
+
+        # (content, kind, key)
+        self.queue: "queue.Queue[Tuple[str, Optional[str], Optional[str]]]" = queue.Queue(queue_size)
+        # (kind, key) of the messages queued and not sent yet
+        self.queued_keys: Set[Tuple[str, str]] = set()
+        self.session = requests.Session()
+        self.thread: Optional[threading.Thread] = None
+        # messages queued and not sent yet
+        self.pending = 0
+        self.pending_lock = threading.Lock()
+        self.is_idle = threading.Event()
+        self.is_idle.set()
+
+        self.sent_messages = 0
+        self.failed_messages = 0
+        self.dropped_messages = 0
+        self.rate_limited = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="discord-notifier")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self, content: str, kind: Optional[str] = None, key: Optional[str] = None) -> bool:
+        """queue a message. with `kind` and `key`, a message is sent once per key"""
+        has_key = bool(kind and key)
+        with self.pending_lock:
+            if has_key and ((kind, key) in self.queued_keys or self.sent_store.contains(kind, key)):
+                return False
+            if has_key:
+                self.queued_keys.add((kind, key))
+            self.pending += 1
+            self.is_idle.clear()
+        try:
+            self.queue.put_nowait((content, kind, key))
+            return True
+        except queue.Full:
+            self.done([(content, kind, key)], is_sent=False)
+            self.dropped_messages += 1
+            main_logger.warning("discord queue is full. drop: %s", content)
+            return False
+
+    def done(self, messages: List[Tuple[str, Optional[str], Optional[str]]], is_sent: bool):
+        """marks the keys of sent messages. the keys of the others can be queued again"""
+        for _, kind, key in messages:
+            if kind and key and is_sent:
+                self.sent_store.add(kind, key)
+        with self.pending_lock:
+            for _, kind, key in messages:
+                self.queued_keys.discard((kind, key))
+            self.pending -= len(messages)
+            if self.pending <= 0:
+                self.is_idle.set()
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """wait until the queue is sent. False on timeout"""
+        return self.is_idle.wait(timeout)
+
+    def collect(self) -> List[Tuple[str, Optional[str], Optional[str]]]:
+        """the next message and everything that arrives within `coalesce_window` after it"""
+        messages = [self.queue.get()]
+        deadline = time.monotonic() + self.coalesce_window
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                messages.append(self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait())
+            except queue.Empty:
+                return messages
+
+    @staticmethod
+    def join_messages(messages: List[Tuple]) -> List[Tuple[str, List[Tuple]]]:
+        """as few contents as possible, each within the length limit, with the messages in each"""
+        contents = []
+        for message in messages:
+            content = message[0][:MAX_CONTENT_LENGTH]
+            if contents and len(contents[-1][0]) + 1 + len(content) <= MAX_CONTENT_LENGTH:
+                contents[-1] = (contents[-1][0] + "\n" + content, contents[-1][1] + [message])
+            else:
+                contents.append((content, [message]))
+        return contents
+
+    def run(self):
+        while True:
+            for content, messages in self.join_messages(self.collect()):
+                try:
+                    is_sent = self.send(content)
+                except Exception as e:
+                    main_logger.error("cannot send a discord message: %s", e)
+                    is_sent = False
+                if is_sent:
+                    self.sent_messages += 1
+                else:
+                    self.failed_messages += 1
+                self.done(messages, is_sent)
+
+    def send(self, content: str) -> bool:
+        data = {"content": content}
+        if self.username:
+            data["username"] = self.username
+
+        backoff = 1.0
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = self.session.post(self.webhook, json=data, timeout=self.timeout)
+            except requests.RequestException as e:
+                main_logger.warning("discord webhook error (%d/%d): %s", attempt, self.max_attempts, e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+
+            if response.status_code == 429:
+                self.rate_limited += 1
+                retry_after = self.get_retry_after(response)
+                main_logger.info("discord rate limit. retry after %.2fs", retry_after)
+                time.sleep(min(retry_after, self.max_backoff))
+                continue
+            if response.status_code >= 500:
+                main_logger.warning("discord webhook %s (%d/%d)", response.status_code, attempt, self.max_attempts)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            if response.status_code >= 400:
+                main_logger.error("discord webhook %s: %s", response.status_code, response.text[:200])
+                return False
+            if response.headers.get("X-RateLimit-Remaining") == "0":
+                # the next message would be rate limited
+                time.sleep(min(float(response.headers.get("X-RateLimit-Reset-After") or 1), self.max_backoff))
+            return True
+
+        main_logger.error("cannot send a discord message after %d attempts: %s", self.max_attempts, content)
+        return False
+
+    @staticmethod
+    def get_retry_after(response: requests.Response) -> float:
+        """seconds. discord puts it in the body, and (rounded up) in the Retry-After header"""
+        try:
+            return float(response.json()["retry_after"])
+        except (ValueError, KeyError, TypeError):
+            pass
+        try:
+            return float(response.headers.get("Retry-After", 1))
+        except ValueError:
+            return 1.0
+
+    def get_stats(self) -> dict:
+        return {
+            "queued": self.queue.qsize(),
+            "sent": self.sent_messages,
+            "failed": self.failed_messages,
+            "dropped": self.dropped_messages,
+            "rate_limited": self.rate_limited,
+        }
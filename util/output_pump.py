@@ -0,0 +1,230 @@
+# one thread that reads the output of every child process
+#
+# replaces a readline() thread per pipe. output is read in blocks as soon as it is available, decoded at once,
+# and the lines of one read are written as one log record.
+#
+# - ffmpeg's progress lines (`frame= ... speed=1x`) are logged at most once per `progress_interval`
+# - the same line repeated is logged once with a count
+# - lines mentioning errors or warnings are logged at that level
+
+import logging
+import os
+import re
+import selectors
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+
+from .logger import main_logger, subprocess_logger
+
+PROGRESS_PATTERN = re.compile(r"^\s*(frame|size)=|speed=\s*\S+x")
+ERROR_PATTERN = re.compile(r"error|failed|invalid|cannot|could not", re.IGNORECASE)
+WARNING_PATTERN = re.compile(r"warn|non-monotonous|corrupt|discard|timeout|timed out", re.IGNORECASE)
+NEWLINE_PATTERN = re.compile(rb"[\r\n]")
+
+
+def get_line_level(line: str) -> int:
+    if ERROR_PATTERN.search(line):
+        return logging.ERROR
+    if WARNING_PATTERN.search(line):
+        return logging.WARNING
+    return logging.INFO
+
+
+class PumpedOutput:
+    """the state of one registered pipe"""
+
+    def __init__(
+        self,
+        pipe,
+        name: str,
+        on_line: Optional[Callable[[str], None]],
+        logger: logging.Logger,
+        progress_interval: float,
+        is_logged: bool = True,
+        tail_size: int = 20,
+    ) -> None:
+        self.pipe = pipe
+        self.name = name
+        self.on_line = on_line
+        self.logger = logger
+        self.progress_interval = progress_interval
+        self.is_logged = is_logged
+
+        self.buffer = b""
+        # the last lines, for error reports after the process exited
+        self.tail: Deque[str] = deque(maxlen=tail_size)
+        self.done = threading.Event()
+
+        self.last_line: Optional[str] = None
+        self.repeat_count = 0
+        self.last_progress_logged_at = 0.0
+        self.last_progress_line: Optional[str] = None
+        self.suppressed_progress_count = 0
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """wait until the pipe reached EOF"""
+        return self.done.wait(timeout)
+
+    def feed(self, data: bytes):
+        self.buffer += data
+        parts = NEWLINE_PATTERN.split(self.buffer)
+        self.buffer = parts.pop()
+        if parts:
+            self.handle_lines(b"\n".join(parts).decode("utf-8", errors="ignore").split("\n"))
+
+    def finish(self):
+        if self.buffer:
+            self.handle_lines([self.buffer.decode("utf-8", errors="ignore")])
+            self.buffer = b""
+        records: List[Tuple[int, str]] = []
+        self.flush_repeat(records)
+        if self.suppressed_progress_count and self.last_progress_line:
+            records.append((logging.INFO, self.last_progress_line))
+        self.emit(records)
+        self.done.set()
+
+    def flush_repeat(self, records: List[Tuple[int, str]]):
+        if self.repeat_count:
+            records.append((logging.INFO, f"last message repeated {self.repeat_count} times"))
+            self.repeat_count = 0
+
+    def handle_lines(self, lines: List[str]):
+        records: List[Tuple[int, str]] = []
+        now = time.monotonic()
+        for line in lines:
+            line = line.rstrip()
+            if not line:
+                continue
+            self.tail.append(line)
+            if self.on_line:
+                try:
+                    self.on_line(line)
+                except Exception as e:
+                    main_logger.warning("%s line handler error: %s", self.name, e)
+            if not self.is_logged:
+                continue
+
+            if PROGRESS_PATTERN.search(line):
+                self.last_progress_line = line
+                if now - self.last_progress_logged_at < self.progress_interval:
+                    self.suppressed_progress_count += 1
+                    continue
+                self.last_progress_logged_at = now
+                self.suppressed_progress_count = 0
+                records.append((logging.INFO, line))
+                continue
+
+            if line == self.last_line:
+                self.repeat_count += 1
+                continue
+            self.flush_repeat(records)
+            self.last_line = line
+            records.append((get_line_level(line), line))
+        self.emit(records)
+
+    def emit(self, records: List[Tuple[int, str]]):
+        """consecutive lines of the same level go out as one record"""
+        start = 0
+        while start < len(records):
+            level = records[start][0]
+            end = start
+            while end < len(records) and records[end][0] == level:
+                end += 1
+            message = "\n".join(f"[{self.name}] {line}" for _, line in records[start:end])
+            self.logger.log(level, message)
+            start = end
+
+
+class OutputPump:
+    def __init__(
+        self,
+        logger: logging.Logger = subprocess_logger,
+        progress_interval: float = 30,
+        read_size: int = 64 * 1024,
+    ) -> None:
+        self.logger = logger
+        self.progress_interval = progress_interval
+        self.read_size = read_size
+
+        self.selector = selectors.DefaultSelector()
+        self.lock = threading.Lock()
+        self.pending: List[PumpedOutput] = []
+        # the selector is only touched by the pump thread. other threads wake it up through this pipe
+        self.wakeup_reader, self.wakeup_writer = os.pipe()
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ, None)
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="output-pump")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def register(
+        self,
+        pipe,
+        name: str,
+        on_line: Optional[Callable[[str], None]] = None,
+        is_logged: bool = True,
+    ) -> PumpedOutput:
+        """pump `pipe` until EOF. the pipe is closed at EOF"""
+        output = PumpedOutput(pipe, name, on_line, self.logger, self.progress_interval, is_logged=is_logged)
+        with self.lock:
+            self.pending.append(output)
+        os.write(self.wakeup_writer, b"\0")
+        return output
+
+    def add_pending(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        for output in pending:
+            try:
+                self.selector.register(output.pipe.fileno(), selectors.EVENT_READ, output)
+            except (OSError, ValueError) as e:
+                main_logger.warning("cannot pump %s: %s", output.name, e)
+                output.finish()
+
+    def remove(self, fd: int, output: PumpedOutput):
+        self.selector.unregister(fd)
+        try:
+            output.pipe.close()
+        except OSError:
+            pass
+        output.finish()
+
+    def run(self):
+        while True:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    os.read(self.wakeup_reader, 4096)
+                    self.add_pending()
+                    continue
+
+                output: PumpedOutput = key.data
+                try:
+                    data = os.read(key.fd, self.read_size)
+                except OSError as e:
+                    main_logger.warning("%s read error: %s", output.name, e)
+                    data = b""
+                if not data:
+                    self.remove(key.fd, output)
+                    continue
+                try:
+                    output.feed(data)
+                except Exception as e:
+                    main_logger.error("%s output error: %s", output.name, e)
+
+
+_OUTPUT_PUMP: Optional[OutputPump] = None
+_OUTPUT_PUMP_LOCK = threading.Lock()
+
+
+def get_output_pump(progress_interval: float = 30) -> OutputPump:
+    """the pump shared by all recordings of this process. `progress_interval` is used when it is created"""
+    global _OUTPUT_PUMP  # pylint: disable=global-statement
+    with _OUTPUT_PUMP_LOCK:
+        if _OUTPUT_PUMP is None:
+            _OUTPUT_PUMP = OutputPump(progress_interval=progress_interval)
+            _OUTPUT_PUMP.start()
+        return _OUTPUT_PUMP
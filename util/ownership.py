@@ -0,0 +1,145 @@
+# the owner of the directories and files the recorder creates
+#
+# this used to be `sudo chown -R abc:abc <dir>` on every recording start and metadata export. that forked a
+# shell and sudo, and walked every file under e.g. `/data/{plugin}/{author}/%Y-%m`. now:
+# - only the path components that did not exist before are chowned, and only once per directory
+# - nothing is done when the process already runs as the owner (the image runs as abc)
+# - os.chown when it is allowed (root), `sudo -n chown` (not recursive) of the same paths otherwise
+
+import logging
+import os
+import pwd
+import grp
+import subprocess
+import threading
+import time
+from typing import List, Optional, Set, Tuple
+
+# user[:group], names or ids
+OUTPUT_OWNER = os.getenv("OUTPUT_OWNER") or "abc:abc"
+
+# util.logger creates its log directories with this module. `main` is set up by then for everything else
+_logger = logging.getLogger("main")
+
+
+def parse_owner(owner: str) -> Optional[Tuple[int, int]]:
+    """(uid, gid), or None if the user or group does not exist here"""
+    user, _, group = owner.partition(":")
+    try:
+        if user.isdigit():
+            uid = int(user)
+            gid = int(group) if group.isdigit() else (grp.getgrnam(group).gr_gid if group else uid)
+        else:
+            entry = pwd.getpwnam(user)
+            uid = entry.pw_uid
+            gid = int(group) if group.isdigit() else (grp.getgrnam(group).gr_gid if group else entry.pw_gid)
+    except KeyError:
+        return None
+    return uid, gid
+
+
+class OwnershipManager:
+    def __init__(self, owner: str = OUTPUT_OWNER) -> None:
+        self.ids = parse_owner(owner)
+        self.lock = threading.Lock()
+        # directories created and chowned already
+        self.handled: Set[str] = set()
+
+        self.calls = 0
+        self.cached = 0
+        self.chowned = 0
+        self.seconds = 0.0
+
+    @property
+    def is_needed(self) -> bool:
+        """False if there is no such owner, or files are created with it anyway"""
+        return self.ids is not None and (os.geteuid(), os.getegid()) != self.ids
+
+    def makedirs(self, dirpath: str):
+        """os.makedirs(dirpath, exist_ok=True) and chown the directories that it created"""
+        dirpath = os.path.abspath(dirpath)
+        with self.lock:
+            self.calls += 1
+            is_cached = dirpath in self.handled
+            if is_cached:
+                self.cached += 1
+        if is_cached:
+            # it may have been removed since
+            os.makedirs(dirpath, exist_ok=True)
+            return
+
+        started_at = time.perf_counter()
+        created = []
+        path = dirpath
+        while not os.path.isdir(path):
+            created.append(path)
+            parent = os.path.dirname(path)
+            if parent == path:
+                break
+            path = parent
+        os.makedirs(dirpath, exist_ok=True)
+        if self.is_needed and created:
+            self.chown(list(reversed(created)))
+        elapsed = time.perf_counter() - started_at
+
+        with self.lock:
+            self.handled.add(dirpath)
+            self.seconds += elapsed
+        if created:
+            _logger.info(
+                "created %s: %d new directories, chowned: %s, %.2fms",
+                dirpath,
+                len(created),
+                self.is_needed,
+                elapsed * 1000,
+            )
+
+    def chown_file(self, filepath: str):
+        """a file written by the recorder. it already has the owner unless the recorder runs as someone else"""
+        if not self.is_needed:
+            return
+        started_at = time.perf_counter()
+        self.chown([filepath])
+        with self.lock:
+            self.seconds += time.perf_counter() - started_at
+
+    def chown(self, paths: List[str]):
+        uid, gid = self.ids
+        denied = []
+        for path in paths:
+            try:
+                os.chown(path, uid, gid)
+                self.chowned += 1
+            except PermissionError:
+                denied.append(path)
+            except FileNotFoundError:
+                pass
+        if not denied:
+            return
+        try:
+            result = subprocess.run(
+                ["sudo", "-n", "chown", f"{uid}:{gid}", "--"] + denied,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE,
+                check=False,
+            )
+        except OSError as e:
+            _logger.warning("cannot chown %s: %s", denied, e)
+            return
+        if result.returncode != 0:
+            _logger.warning("cannot chown %s: %s", denied, result.stderr.decode("utf8", "replace").strip())
+            return
+        self.chowned += len(denied)
+
+    def get_stats(self) -> dict:
+        """`cached` calls would each have been a `sudo chown -R` before"""
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "cached": self.cached,
+                "chowned": self.chowned,
+                "seconds": round(self.seconds, 6),
+            }
+
+
+OWNERSHIP = OwnershipManager()
@@ -0,0 +1,271 @@
+# remux finished .ts segments to mp4/mkv in the background
+#
+# - jobs run in a bounded pool with lowered cpu and io priority, so live recordings keep priority
+# - pending jobs are kept in a json file and resumed after a restart. failed jobs are kept in the same file with
+#   their error and are not retried (the input is usually broken); moving one back to `pending` retries it
+# - the source is deleted only after the output's duration matches the source's
+
+import os
+import json
+import shutil
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+from .logger import main_logger
+from .common import get_output_of_command
+from .metadata_journal import write_json_atomic
+
+
+def get_duration(filepath: str) -> Optional[float]:
+    output = get_output_of_command(
+        [
+            "ffprobe",
+            "-v",
+            "error",
+            "-show_entries",
+            "format=duration",
+            "-of",
+            "default=noprint_wrappers=1:nokey=1",
+            filepath,
+        ]
+    )
+    try:
+        return float(output.strip())
+    except ValueError:
+        return None
+
+
+class PostProcessor:
+    def __init__(
+        self,
+        queue_filepath: str,
+        output_format: str = "mp4",
+        workers: int = 1,
+        niceness: int = 19,
+        delete_source: bool = False,
+        duration_tolerance: float = 1.0,
+        on_done: Optional[Callable[[str, str], None]] = None,
+    ) -> None:
+        """`on_done(source_filepath, output_filepath)` is called after a job, also when the source was deleted"""
+        self.queue_filepath = queue_filepath
+        self.output_format = output_format
+        self.niceness = niceness
+        self.delete_source = delete_source
+        self.duration_tolerance = duration_tolerance
+        self.on_done = on_done
+
+        self.lock = threading.Lock()
+        self.pending: List[str] = []
+        # {"filepath", "error", "failed_at"}
+        self.failed: List[Dict[str, object]] = []
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="postprocess")
+        self.nice = shutil.which("nice")
+        self.ionice = shutil.which("ionice")
+
+        self.load_queue()
+
+    def load_queue(self):
+        if not os.path.exists(self.queue_filepath):
+            return
+        try:
+            with open(self.queue_filepath, "r", encoding="utf8") as f:
+                queue = json.load(f)
+        except Exception as e:
+            main_logger.warning("cannot load postprocess queue %s: %s", self.queue_filepath, e)
+            return
+
+        # a plain list of pending jobs before failed jobs were kept
+        pending = queue if isinstance(queue, list) else queue.get("pending", [])
+        self.failed = [] if isinstance(queue, list) else queue.get("failed", [])
+        if self.failed:
+            main_logger.warning("%d postprocess jobs failed before. see %s", len(self.failed), self.queue_filepath)
+        main_logger.info("resume %d postprocess jobs", len(pending))
+        for source_filepath in pending:
+            self.submit(source_filepath)
+
+    def save_queue(self):
+        try:
+            os.makedirs(os.path.dirname(self.queue_filepath), exist_ok=True)
+            write_json_atomic(self.queue_filepath, {"pending": self.pending, "failed": self.failed}, indent=2)
+        except Exception as e:
+            main_logger.warning("cannot save postprocess queue %s: %s", self.queue_filepath, e)
+
+    def submit(self, source_filepath: str):
+        with self.lock:
+            if source_filepath in self.pending:
+                return
+            self.pending.append(source_filepath)
+            self.save_queue()
+        self.executor.submit(self.run_job, source_filepath)
+
+    def finish(self, source_filepath: str, error: Optional[str] = None):
+        """removes the job from the queue. a job with `error` is kept in the failed list"""
+        with self.lock:
+            self.pending = [filepath for filepath in self.pending if filepath != source_filepath]
+            self.failed = [job for job in self.failed if job["filepath"] != source_filepath]
+            if error is not None:
+                self.failed.append({"filepath": source_filepath, "error": error, "failed_at": time.time()})
+            self.save_queue()
+
+    def get_output_filepath(self, source_filepath: str) -> str:
+        return f"{os.path.splitext(source_filepath)[0]}.{self.output_format}"
+
+    def run_job(self, source_filepath: str):
+        error = None
+        try:
+            if not os.path.exists(source_filepath):
+                main_logger.warning("postprocess source does not exist: %s", source_filepath)
+                return
+
+            output_filepath = self.get_output_filepath(source_filepath)
+            tmp_filepath = f"{output_filepath}.tmp.{self.output_format}"
+            command = [
+                "ffmpeg",
+                "-y",
+                "-loglevel",
+                "error",
+                "-i",
+                source_filepath,
+                "-map",
+                "0:v?",
+                "-map",
+                "0:a?",
+                "-c",
+                "copy",
+            ]
+            if self.output_format == "mp4":
+                command += ["-movflags", "+faststart"]
+            command += [tmp_filepath]
+            if self.nice:
+                command = [self.nice, "-n", str(self.niceness)] + command
+            if self.ionice:
+                # idle io class: only uses the disk when nothing else does
+                command = [self.ionice, "-c", "3"] + command
+
+            started_at = time.monotonic()
+            result = subprocess.run(
+                command,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                check=False,
+            )
+            if result.returncode != 0:
+                error = result.stdout.decode("utf8", errors="ignore").strip() or f"exit code {result.returncode}"
+                main_logger.error("postprocess failed %s: %s", source_filepath, error)
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+                return
+            os.replace(tmp_filepath, output_filepath)
+            main_logger.info("postprocess done in %.1fs: %s", time.monotonic() - started_at, output_filepath)
+
+            if self.delete_source:
+                self.delete_if_verified(source_filepath, output_filepath)
+            if self.on_done:
+                self.on_done(source_filepath, output_filepath)
+        except Exception as e:
+            error = str(e)
+            main_logger.error("postprocess error %s: %s", source_filepath, e)
+        finally:
+            self.finish(source_filepath, error)
+
+    def delete_if_verified(self, source_filepath: str, output_filepath: str):
+        source_duration = get_duration(source_filepath)
+        output_duration = get_duration(output_filepath)
+        if source_duration is None or output_duration is None:
+            main_logger.warning("cannot verify %s. keep the source", output_filepath)
+            return
+        if abs(source_duration - output_duration) > self.duration_tolerance:
+            main_logger.warning(
+                "duration mismatch %s (%.1fs) != %s (%.1fs). keep the source",
+                source_filepath,
+                source_duration,
+                output_filepath,
+                output_duration,
+            )
+            return
+        os.remove(source_filepath)
+        main_logger.info("removed postprocessed source %s", source_filepath)
+
+
+def get_file_size(filepath: str) -> int:
+    try:
+        return os.path.getsize(filepath)
+    except OSError:
+        return 0
+
+
+class SegmentWatcher:
+    """reports `<filepath> part<n>.ts` as closed once `part<n+1>.ts` exists, and the rest when stopped
+
+    ffmpeg's segment muxer does not tell when it closes a segment, nor how much it wrote (`total_size` is N/A).
+    """
+
+    def __init__(
+        self,
+        filepath: str,
+        is_segmented: bool,
+        on_segment_closed: Callable[[str], None],
+        interval: float = 10,
+    ) -> None:
+        self.filepath = filepath
+        self.is_segmented = is_segmented
+        self.on_segment_closed = on_segment_closed
+        self.interval = interval
+        self.next_segment_number = 1
+        # bytes of the segments reported as closed
+        self.closed_size = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def get_segment_filepath(self, segment_number: int) -> str:
+        if not self.is_segmented:
+            return f"{self.filepath}.ts"
+        return f"{self.filepath} part{segment_number}.ts"
+
+    def check(self, is_final: bool = False):
+        while True:
+            segment_filepath = self.get_segment_filepath(self.next_segment_number)
+            if not os.path.exists(segment_filepath):
+                return
+            if not is_final and (
+                not self.is_segmented or not os.path.exists(self.get_segment_filepath(self.next_segment_number + 1))
+            ):
+                return
+            with self.lock:
+                self.closed_size += get_file_size(segment_filepath)
+                self.next_segment_number += 1
+            self.on_segment_closed(segment_filepath)
+            if not self.is_segmented:
+                return
+
+    def get_written_size(self) -> int:
+        """bytes written so far, the open segments included"""
+        with self.lock:
+            if not self.is_segmented:
+                return self.closed_size or get_file_size(self.get_segment_filepath(1))
+            size = self.closed_size
+            segment_number = self.next_segment_number
+            while os.path.exists(self.get_segment_filepath(segment_number)):
+                size += get_file_size(self.get_segment_filepath(segment_number))
+                segment_number += 1
+            return size
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"{threading.current_thread().name}-segments")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """call after the muxer exited"""
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        self.check(is_final=True)
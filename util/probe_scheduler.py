@@ -0,0 +1,151 @@
+# decides when the next online check of a channel runs
+#
+# - a channel is checked more often around the times it usually goes online (learned from its online transitions)
+# - a channel which is offline for a long time or whose checks fail is checked less often
+# - every interval is jittered so that channels do not check at the same moment
+
+import json
+import os
+import random
+import threading
+import time
+from datetime import datetime
+from typing import List, Optional
+
+from .logger import main_logger
+
+WEEK_BUCKET_SIZE = 15 * 60
+WEEK_BUCKET_COUNT = 7 * 24 * 60 * 60 // WEEK_BUCKET_SIZE
+DAY_BUCKET_COUNT = 24 * 60 * 60 // WEEK_BUCKET_SIZE
+MAX_HISTORY_SIZE = 500
+
+
+def get_week_bucket(timestamp: float) -> int:
+    dt = datetime.fromtimestamp(timestamp)
+    return (dt.weekday() * 24 * 60 * 60 + dt.hour * 60 * 60 + dt.minute * 60 + dt.second) // WEEK_BUCKET_SIZE
+
+
+class ProbeScheduler:
+    def __init__(
+        self,
+        check_interval: float,
+        min_interval: Optional[float] = None,
+        max_interval: Optional[float] = None,
+        jitter: float = 0.1,
+        usual_start_window: float = 30 * 60,
+        long_offline: float = 6 * 60 * 60,
+        history_path: Optional[str] = None,
+    ) -> None:
+        self.check_interval = check_interval
+        self.min_interval = min_interval if min_interval is not None else max(check_interval / 3, 1)
+        self.max_interval = max_interval if max_interval is not None else check_interval * 4
+        self.jitter = jitter
+        self.usual_start_window = usual_start_window
+        self.long_offline = long_offline
+        self.history_path = history_path
+
+        self.lock = threading.Lock()
+        self.online_history: List[float] = []
+        self.week_buckets = [0] * WEEK_BUCKET_COUNT
+        self.day_buckets = [0] * DAY_BUCKET_COUNT
+        self.is_online = False
+        self.offline_since = time.time()
+        self.error_count = 0
+        self.next_probe_at: Optional[float] = None
+        self.last_interval: Optional[float] = None
+
+        self.load_history()
+
+    def load_history(self):
+        if not self.history_path or not os.path.exists(self.history_path):
+            return
+        try:
+            with open(self.history_path, "r", encoding="utf8") as f:
+                for timestamp in json.load(f):
+                    self.add_online_timestamp(float(timestamp))
+        except Exception as e:
+            main_logger.warning("cannot load probe history %s: %s", self.history_path, e)
+
+    def save_history(self):
+        if not self.history_path:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.history_path), exist_ok=True)
+            tmp_path = f"{self.history_path}.tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                json.dump(self.online_history, f)
+            os.replace(tmp_path, self.history_path)
+        except Exception as e:
+            main_logger.warning("cannot save probe history %s: %s", self.history_path, e)
+
+    def add_online_timestamp(self, timestamp: float):
+        self.online_history.append(timestamp)
+        week_bucket = get_week_bucket(timestamp)
+        self.week_buckets[week_bucket] += 1
+        self.day_buckets[week_bucket % DAY_BUCKET_COUNT] += 1
+
+        if len(self.online_history) > MAX_HISTORY_SIZE:
+            oldest_bucket = get_week_bucket(self.online_history.pop(0))
+            self.week_buckets[oldest_bucket] -= 1
+            self.day_buckets[oldest_bucket % DAY_BUCKET_COUNT] -= 1
+
+    def record_probe(self, is_online: bool, is_error: bool):
+        now = time.time()
+        with self.lock:
+            if is_error:
+                self.error_count += 1
+                return
+            self.error_count = 0
+
+            if is_online and not self.is_online:
+                self.add_online_timestamp(now)
+                self.save_history()
+            elif not is_online and self.is_online:
+                self.offline_since = now
+            self.is_online = is_online
+
+    def is_near_usual_start(self, now: Optional[float] = None) -> bool:
+        """True if the channel went online around this time of the week before (or of the day, twice or more)"""
+        now = now or time.time()
+        bucket_range = int(self.usual_start_window // WEEK_BUCKET_SIZE)
+        current_bucket = get_week_bucket(now)
+        for offset in range(-bucket_range, bucket_range + 1):
+            week_bucket = (current_bucket + offset) % WEEK_BUCKET_COUNT
+            if self.week_buckets[week_bucket] >= 1 or self.day_buckets[week_bucket % DAY_BUCKET_COUNT] >= 2:
+                return True
+        return False
+
+    def get_interval(self, now: Optional[float] = None) -> float:
+        now = now or time.time()
+        with self.lock:
+            if self.error_count:
+                interval = self.check_interval * (2 ** min(self.error_count, 8))
+            elif self.is_online:
+                interval = self.check_interval * 2
+            elif self.is_near_usual_start(now):
+                interval = self.min_interval
+            else:
+                offline_duration = now - self.offline_since
+                interval = self.check_interval * max(1, offline_duration / self.long_offline)
+            interval = min(max(interval, self.min_interval), self.max_interval)
+
+        return interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def schedule_next(self) -> float:
+        """returns seconds to wait until the next probe"""
+        now = time.time()
+        interval = self.get_interval(now)
+        self.last_interval = interval
+        self.next_probe_at = now + interval
+        return interval
+
+    def get_stats(self) -> dict:
+        return {
+            "is_online": self.is_online,
+            "error_count": self.error_count,
+            "offline_since": self.offline_since,
+            "online_transitions": len(self.online_history),
+            "last_interval": self.last_interval,
+            "next_probe_at": self.next_probe_at,
+            "is_near_usual_start": self.is_near_usual_start(),
+        }
@@ -0,0 +1,257 @@
+# opt-in profiling of a running recorder. off, a section costs a mode check and a nullcontext
+#
+# - PROFILE_MODE=cprofile: cProfile around every `section(name)`. the stats of a name are added up and written to
+#   `<name>.prof` at most every `dump_interval` seconds. `session=True` writes every run to its own file.
+#   python 3.12 allows one cProfile at a time, so a section that overlaps another one is skipped. a section profiles
+#   only the thread that entered it, not the threads it starts (pumps, muxer, output pump)
+# - PROFILE_MODE=sample: the stacks of all threads every `sample_interval` seconds, written as folded stacks
+#   (flamegraph.pl, speedscope) every `dump_interval` seconds. a thread inside a section is named after it.
+#   this is the mode for the threads of a recording, which are named `<channel>-fetch`, `<channel>-muxer`, ...
+# - tracemalloc: the top allocations and the growth since the last snapshot every `tracemalloc_interval` seconds
+# - `dump_signal`: the stacks of all threads and the state of the registered objects (e.g. StreamMetadata)
+#
+# files go to `output_dir`. only the newest `keep` files of each kind are kept.
+
+import os
+import cProfile
+import glob
+import json
+import pstats
+import signal
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from typing import Callable, ContextManager, Dict, Optional, Tuple
+
+from .logger import main_logger
+from .ownership import OWNERSHIP
+
+PROFILE_MODES = ("off", "cprofile", "sample")
+# distinct stacks kept between two dumps of the sampler. the rest is counted as one
+MAX_SAMPLED_STACKS = 10000
+
+
+def parse_signal(name: str) -> Optional[int]:
+    """`SIGUSR1`, `USR1` or a number. None if empty"""
+    if not name:
+        return None
+    if name.isdigit():
+        return int(name)
+    name = name.upper()
+    return getattr(signal, name if name.startswith("SIG") else f"SIG{name}")
+
+
+class Profiler:
+    def __init__(
+        self,
+        output_dir: str,
+        mode: str = "off",
+        sample_interval: float = 0.02,
+        dump_interval: float = 300,
+        tracemalloc_interval: float = 0,
+        tracemalloc_top: int = 25,
+        dump_signal: Optional[int] = None,
+        keep: int = 10,
+    ) -> None:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"unknown profile mode: {mode}")
+        self.output_dir = output_dir
+        self.mode = mode
+        self.sample_interval = sample_interval
+        self.dump_interval = dump_interval
+        self.tracemalloc_interval = tracemalloc_interval
+        self.tracemalloc_top = tracemalloc_top
+        self.dump_signal = dump_signal
+        self.keep = keep
+
+        # name: (profile, lock). one thread adds to a profile at a time
+        self.profiles: Dict[str, Tuple[cProfile.Profile, threading.Lock]] = {}
+        self.profiles_lock = threading.Lock()
+        self.dumped_at: Dict[str, float] = {}
+        self.skipped = 0
+        # thread ident: section name, for the sampler
+        self.sections: Dict[int, str] = {}
+        self.samples: Counter = Counter()
+        self.snapshot: Optional[tracemalloc.Snapshot] = None
+        # name: a function returning a json serializable dict
+        self.states: Dict[str, Callable[[], dict]] = {}
+        self.dump_requested = threading.Event()
+
+    def start(self):
+        OWNERSHIP.makedirs(self.output_dir)
+        if self.tracemalloc_interval:
+            tracemalloc.start()
+        if self.dump_signal:
+            # the handler runs in the main thread. the dump is written by the profiler thread
+            signal.signal(self.dump_signal, lambda *_: self.dump_requested.set())
+        if self.tracemalloc_interval or self.dump_signal:
+            threading.Thread(target=self.run, name="profiler", daemon=True).start()
+        if self.mode == "sample":
+            threading.Thread(target=self.sample_loop, name="profiler-sampler", daemon=True).start()
+
+    def add_state(self, name: str, get_state: Callable[[], dict]):
+        self.states[name] = get_state
+
+    def section(self, name: str, session: bool = False) -> ContextManager:
+        if self.mode == "cprofile":
+            return self.profile_section(name, session)
+        if self.mode == "sample":
+            return self.mark_section(name)
+        return nullcontext()
+
+    @contextmanager
+    def profile_section(self, name: str, session: bool):
+        if session:
+            profile, lock = cProfile.Profile(), threading.Lock()
+        else:
+            with self.profiles_lock:
+                profile, lock = self.profiles.setdefault(name, (cProfile.Profile(), threading.Lock()))
+
+        enabled = False
+        if lock.acquire(blocking=False):
+            try:
+                profile.enable()
+                enabled = True
+            except ValueError:
+                # another profiler is active (python 3.12+)
+                lock.release()
+        if not enabled:
+            self.skipped += 1
+        try:
+            yield
+        finally:
+            if enabled:
+                profile.disable()
+                try:
+                    if session:
+                        self.write_stats(profile, self.get_filepath(name, ".prof"))
+                    elif time.monotonic() - self.dumped_at.get(name, 0) >= self.dump_interval:
+                        self.dumped_at[name] = time.monotonic()
+                        self.write_stats(profile, os.path.join(self.output_dir, f"{name}.prof"))
+                except Exception as e:
+                    main_logger.warning("cannot write the profile of %s: %s", name, e)
+                finally:
+                    lock.release()
+
+    @contextmanager
+    def mark_section(self, name: str):
+        ident = threading.get_ident()
+        previous = self.sections.get(ident)
+        self.sections[ident] = name
+        try:
+            yield
+        finally:
+            if previous is None:
+                self.sections.pop(ident, None)
+            else:
+                self.sections[ident] = previous
+
+    def get_filepath(self, kind: str, extname: str) -> str:
+        """a new file of `kind`. removes the oldest ones over `keep`"""
+        filepaths = sorted(glob.glob(os.path.join(glob.escape(self.output_dir), f"{glob.escape(kind)}-*{extname}")))
+        for filepath in filepaths[: max(len(filepaths) - self.keep + 1, 0)]:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+        return os.path.join(self.output_dir, f"{kind}-{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}{extname}")
+
+    def write_text(self, filepath: str, text: str):
+        with open(filepath, "w", encoding="utf8") as f:
+            f.write(text)
+        OWNERSHIP.chown_file(filepath)
+
+    def write_stats(self, profile: cProfile.Profile, filepath: str):
+        pstats.Stats(profile).dump_stats(filepath)
+        OWNERSHIP.chown_file(filepath)
+
+    def sample_loop(self):
+        own_ident = threading.get_ident()
+        dumped_at = time.monotonic()
+        while True:
+            time.sleep(self.sample_interval)
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+                if ident == own_ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                stack.append(self.sections.get(ident) or names.get(ident) or str(ident))
+                key = ";".join(reversed(stack))
+                if key not in self.samples and len(self.samples) >= MAX_SAMPLED_STACKS:
+                    key = "(other stacks)"
+                self.samples[key] += 1
+
+            if time.monotonic() - dumped_at >= self.dump_interval:
+                dumped_at = time.monotonic()
+                samples, self.samples = self.samples, Counter()
+                try:
+                    text = "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+                    self.write_text(self.get_filepath("sample", ".folded"), text)
+                except Exception as e:
+                    main_logger.warning("cannot write the sampled stacks: %s", e)
+
+    def run(self):
+        next_snapshot_at = time.monotonic() + self.tracemalloc_interval if self.tracemalloc_interval else None
+        while True:
+            timeout = None if next_snapshot_at is None else max(next_snapshot_at - time.monotonic(), 0)
+            try:
+                if self.dump_requested.wait(timeout):
+                    self.dump_requested.clear()
+                    self.dump_stacks()
+                if next_snapshot_at is not None and time.monotonic() >= next_snapshot_at:
+                    next_snapshot_at = time.monotonic() + self.tracemalloc_interval
+                    self.dump_tracemalloc()
+            except Exception as e:
+                main_logger.warning("profiler error: %s", e)
+
+    def dump_stacks(self) -> str:
+        frames = sys._current_frames()  # pylint: disable=protected-access
+        lines = [f"# {datetime.now().astimezone().isoformat()} pid {os.getpid()}\n"]
+        for thread in threading.enumerate():
+            section = self.sections.get(thread.ident)
+            lines.append(f"\n## {thread.name} (daemon: {thread.daemon}, section: {section})\n")
+            if thread.ident in frames:
+                lines += traceback.format_stack(frames[thread.ident])
+        lines.append("\n## state\n")
+        for name, get_state in list(self.states.items()):
+            try:
+                state = get_state()
+            except Exception as e:
+                state = {"error": str(e)}
+            lines.append(f"{name}: {json.dumps(state, default=str, ensure_ascii=False)}\n")
+
+        filepath = self.get_filepath("stacks", ".txt")
+        self.write_text(filepath, "".join(lines))
+        main_logger.info("thread stacks written to %s", filepath)
+        return filepath
+
+    def dump_tracemalloc(self) -> str:
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            (
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+            )
+        )
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [
+            f"# {datetime.now().astimezone().isoformat()} traced {current} bytes, peak {peak} bytes\n",
+            "\n## top\n",
+        ]
+        lines += [f"{stat}\n" for stat in snapshot.statistics("lineno")[: self.tracemalloc_top]]
+        if self.snapshot is not None:
+            lines.append("\n## growth since the last snapshot\n")
+            lines += [f"{stat}\n" for stat in snapshot.compare_to(self.snapshot, "lineno")[: self.tracemalloc_top]]
+        self.snapshot = snapshot
+
+        filepath = self.get_filepath("tracemalloc", ".txt")
+        self.write_text(filepath, "".join(lines))
+        return filepath
@@ -0,0 +1,159 @@
+# recorder-owned writer of segment files
+#
+# many channels written at once with small buffered writes interleave their blocks on the disk and leave the
+# writeback to the kernel, which flushes in bursts. this writer:
+# - preallocates the file ahead of the write position with fallocate(FALLOC_FL_KEEP_SIZE). the file size
+#   stays the written size, so a growing recording stays playable. the unused rest is released on close
+# - collects writes into a large buffer and writes whole, block aligned chunks of it
+# - optionally fdatasyncs every `fsync_interval` seconds and drops the synced pages from the page cache
+
+import ctypes
+import ctypes.util
+import os
+import time
+from typing import Callable, Optional
+
+from .logger import main_logger
+
+FALLOC_FL_KEEP_SIZE = 0x01
+
+
+def _load_fallocate() -> Optional[Callable[[int, int, int, int], int]]:
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        function = libc.fallocate64
+    except (OSError, AttributeError, TypeError):
+        return None
+    function.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    function.restype = ctypes.c_int
+    return function
+
+
+_FALLOCATE = _load_fallocate()
+
+
+class SegmentFileWriter:
+    def __init__(
+        self,
+        filepath: str,
+        buffer_size: int = 4 * 1024 * 1024,
+        preallocate_size: int = 0,
+        fsync_interval: float = 0,
+        block_size: int = 4096,
+    ) -> None:
+        """
+        `preallocate_size`: bytes allocated ahead of the write position at a time. 0 disables it.
+        `fsync_interval`: seconds between fdatasync calls. 0 leaves the writeback to the kernel.
+        """
+        self.filepath = filepath
+        self.buffer_size = max(buffer_size - buffer_size % block_size, block_size)
+        self.preallocate_size = preallocate_size if _FALLOCATE else 0
+        self.fsync_interval = fsync_interval
+        self.block_size = block_size
+
+        self.fd = os.open(filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        self.buffer = bytearray()
+        self.position = 0
+        self.allocated = 0
+        self.synced = 0
+        self.synced_at = time.monotonic()
+        self.closed = False
+
+        self.writes = 0
+        self.fsyncs = 0
+        if preallocate_size and not _FALLOCATE:
+            main_logger.warning("fallocate is not available. %s is not preallocated", filepath)
+
+    def fileno(self) -> int:
+        return self.fd
+
+    def write(self, data) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self.buffer += data
+        if len(self.buffer) >= self.buffer_size:
+            self.write_buffer(len(self.buffer) - len(self.buffer) % self.block_size)
+        return len(data)
+
+    def flush(self):
+        """write everything buffered, also a partial block"""
+        self.write_buffer(len(self.buffer))
+
+    def write_buffer(self, size: int):
+        if size <= 0:
+            return
+        self.preallocate(self.position + size)
+        view = memoryview(self.buffer)
+        written = 0
+        try:
+            while written < size:
+                written += os.write(self.fd, view[written:size])
+                self.writes += 1
+        finally:
+            view.release()
+            del self.buffer[:written]
+            self.position += written
+        if self.fsync_interval and time.monotonic() - self.synced_at >= self.fsync_interval:
+            self.sync()
+
+    def preallocate(self, end: int):
+        if not self.preallocate_size or end <= self.allocated:
+            return
+        size = max(self.preallocate_size, end - self.allocated)
+        if _FALLOCATE(self.fd, FALLOC_FL_KEEP_SIZE, self.allocated, size) != 0:
+            errno = ctypes.get_errno()
+            main_logger.warning("cannot preallocate %s: %s", self.filepath, os.strerror(errno))
+            # e.g. the filesystem does not support it. do not try again
+            self.preallocate_size = 0
+            return
+        self.allocated += size
+
+    def sync(self):
+        os.fdatasync(self.fd)
+        self.fsyncs += 1
+        # the synced data is not read again by the recorder
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.fd, self.synced, self.position - self.synced, os.POSIX_FADV_DONTNEED)
+        self.synced = self.position
+        self.synced_at = time.monotonic()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.flush()
+            if self.allocated > self.position:
+                # release the preallocated blocks past the end
+                os.ftruncate(self.fd, self.position)
+            if self.fsync_interval:
+                self.sync()
+        finally:
+            os.close(self.fd)
+
+    def get_stats(self) -> dict:
+        return {
+            "bytes": self.position,
+            "allocated": self.allocated,
+            "writes": self.writes,
+            "fsyncs": self.fsyncs,
+        }
+
+
+def create_segment_file_opener(
+    buffer_size: int = 4 * 1024 * 1024,
+    bitrate: float = 0,
+    segment_duration: Optional[float] = None,
+    max_preallocate_size: int = 0,
+    fsync_interval: float = 0,
+) -> Callable[[str], SegmentFileWriter]:
+    """`bitrate` in bytes per second. a segment is preallocated `bitrate * segment_duration` bytes ahead,
+    at most `max_preallocate_size` at a time"""
+    preallocate_size = max_preallocate_size
+    if bitrate and segment_duration:
+        preallocate_size = min(int(bitrate * segment_duration), max_preallocate_size)
+
+    def open_segment_file(filepath: str) -> SegmentFileWriter:
+        return SegmentFileWriter(filepath, buffer_size, preallocate_size, fsync_interval)
+
+    return open_segment_file
@@ -0,0 +1,125 @@
+# hot standby: start the streamlink process of a recording before the channel goes online
+#
+# - while `is_wanted()` is true (around the channel's usual start time, or always), one streamlink process
+#   (util/standby_worker.py) is kept started with streamlink_cli imported and the plugin resolved
+# - the process blocks on stdin while it waits, so it costs memory but no cpu
+# - `take()` hands the arguments of the recording to that process. a new one is started for the next recording
+# - `prepare` runs along with it, e.g. to create the output directory
+
+import os
+import sys
+import json
+import subprocess
+import threading
+from typing import Callable, List, Optional
+
+from .logger import main_logger
+from .stream import SIDELOADED_PLUGIN_DIRS
+from .metrics import STANDBY_READY, STANDBY_TAKEN
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class StreamlinkStandby:
+    def __init__(
+        self,
+        target_url: str,
+        is_wanted: Callable[[], bool],
+        name: Optional[str] = None,
+        check_interval: float = 15,
+        prepare: Optional[Callable[[], None]] = None,
+    ) -> None:
+        self.target_url = target_url
+        self.is_wanted = is_wanted
+        self.name = name or "default"
+        self.check_interval = check_interval
+        self.prepare = prepare
+
+        self.lock = threading.Lock()
+        self.process: Optional[subprocess.Popen] = None
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def is_ready(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name=f"{self.name}-standby")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+        with self.lock:
+            self.discard()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.update()
+            except Exception as e:
+                main_logger.error("standby of %s: %s", self.name, e)
+            self.wakeup.wait(self.check_interval)
+            self.wakeup.clear()
+
+    def update(self):
+        is_wanted = self.is_wanted()
+        with self.lock:
+            if is_wanted and not self.is_ready:
+                self.spawn()
+            elif not is_wanted and self.process is not None:
+                main_logger.info("discard the standby streamlink process of %s", self.name)
+                self.discard()
+        if is_wanted and self.prepare:
+            self.prepare()
+
+    def spawn(self):
+        if self.process is not None:
+            # exited while it waited
+            main_logger.warning("standby streamlink process exited: %s", self.process.returncode)
+            self.discard()
+        command = [sys.executable, "-m", "util.standby_worker", self.target_url] + SIDELOADED_PLUGIN_DIRS
+        self.process = subprocess.Popen(
+            command,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=ROOT_DIR,
+        )
+        STANDBY_READY.set(1, channel=self.name)
+        main_logger.info("standby streamlink process of %s started: %s", self.name, self.process.pid)
+
+    def discard(self):
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            # eof on stdin ends it
+            self.process.stdin.close()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process = None
+        STANDBY_READY.set(0, channel=self.name)
+
+    def take(self, streamlink_arguments: List[str]) -> Optional[subprocess.Popen]:
+        """the standby process running `streamlink <streamlink_arguments>`, or None if there is none"""
+        with self.lock:
+            process, self.process = self.process, None
+            STANDBY_READY.set(0, channel=self.name)
+        if process is None or process.poll() is not None:
+            return None
+        try:
+            process.stdin.write(json.dumps(streamlink_arguments).encode("utf8") + b"\n")
+            process.stdin.close()
+        except OSError as e:
+            main_logger.warning("cannot use the standby streamlink process: %s", e)
+            process.kill()
+            return None
+        STANDBY_TAKEN.inc(channel=self.name)
+        # the next recording of this broadcast (a retry) gets a new one
+        self.wakeup.set()
+        return process
@@ -0,0 +1,55 @@
+# the process behind util/standby.py
+#
+# python -m util.standby_worker <target_url> [<plugin_dir> ...]
+#
+# imports streamlink_cli and resolves the plugin of `target_url`, then blocks until one json line with the
+# arguments of `streamlink` arrives on stdin and runs streamlink with them in this process.
+# stderr goes to /dev/null until then: the recorder reads the pipe only after it took the process.
+# it must not import the rest of util: the recorder's logger would open the same log files.
+
+import json
+import os
+import sys
+
+
+def warm_up(target_url: str, plugin_dirs: list):
+    # pylint: disable=import-outside-toplevel,unused-import
+    import streamlink_cli.main
+    from streamlink import Streamlink
+
+    session = Streamlink()
+    for plugin_dir in plugin_dirs:
+        if os.path.isdir(plugin_dir):
+            session.plugins.load_path(plugin_dir)
+    # imports the plugin module and its dependencies
+    session.resolve_url_no_redirect(target_url)
+
+
+def main():
+    target_url, plugin_dirs = sys.argv[1], sys.argv[2:]
+    stderr_fd = os.dup(2)
+    devnull_fd = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull_fd, 2)
+    os.close(devnull_fd)
+    try:
+        warm_up(target_url, plugin_dirs)
+    except Exception:  # pylint: disable=broad-except
+        # streamlink reports the same error again when it runs
+        pass
+
+    line = sys.stdin.readline()
+    if not line:
+        # the recorder discarded this process
+        sys.exit(0)
+    sys.stderr.flush()
+    os.dup2(stderr_fd, 2)
+    os.close(stderr_fd)
+
+    from streamlink_cli.main import main as streamlink_main  # pylint: disable=import-outside-toplevel
+
+    sys.argv = ["streamlink"] + json.loads(line)
+    streamlink_main()
+
+
+if __name__ == "__main__":
+    main()
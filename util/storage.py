@@ -0,0 +1,331 @@
+# free space of the recording volume
+#
+# without it the volume fills up, ffmpeg fails in the middle of a segment and every channel loses data at once.
+#
+# - finished recordings are kept in an in-memory index (persisted as json). the tree is scanned once, when
+#   there is no index yet. after that only recordings reported by the recorder are added. changes only mark the
+#   index dirty; the storage thread writes it after its next check, and once more at exit
+# - the bytes per second of every channel are sampled from RECORDING_BYTES, the growth of the recording files in
+#   both pipelines. it gives the time until the free space reaches `low_watermark`
+# - recordings past their channel's retention (age, total size) are removed. the recordings found by the first scan
+#   have no channel: only the age and the low space remove them, since one size limit over all channels would
+#   remove most of the history at once
+# - if the low watermark would be reached within `horizon` seconds, the oldest finished recordings are removed
+#   until `high_watermark` is free at the end of the horizon
+
+import os
+import atexit
+import glob
+import json
+import re
+import shutil
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from .logger import main_logger
+from .metadata_journal import JOURNAL_EXTNAME, write_json_atomic
+from .metrics import RECORDING_BYTES, STORAGE_EVICTED, STORAGE_FREE_BYTES, STORAGE_TIME_TO_FULL
+
+GIB = 1024 * 1024 * 1024
+RECORDING_EXTNAMES = (".ts", ".mp4", ".mkv")
+# `<filepath> part<n>.ts`, `<filepath>.mp4`, ...
+RECORDING_FILENAME_PATTERN = re.compile(r"^(.*?)(?: part\d+)?\.(?:ts|mp4|mkv)$")
+
+
+class RetentionRule:
+    def __init__(self, max_age: float = 0, max_size: int = 0) -> None:
+        """`max_age`: seconds, `max_size`: bytes of all recordings of the channel. 0 is no limit"""
+        self.max_age = max_age
+        self.max_size = max_size
+
+    def __repr__(self) -> str:
+        return f"RetentionRule({self.max_age}, {self.max_size})"
+
+
+class Recording:
+    __slots__ = ("filepath", "channel", "size", "finished_at")
+
+    def __init__(self, filepath: str, channel: str, size: int, finished_at: float) -> None:
+        self.filepath = filepath
+        self.channel = channel
+        self.size = size
+        # unix time
+        self.finished_at = finished_at
+
+
+def get_recording_base(filepath: str) -> str:
+    """the output path without part number and extension. `<base>.json` is the metadata of the recording"""
+    dirpath, filename = os.path.split(filepath)
+    match = RECORDING_FILENAME_PATTERN.match(filename)
+    return os.path.join(dirpath, match.group(1) if match else filename)
+
+
+class StorageManager:
+    def __init__(
+        self,
+        root: str,
+        index_filepath: str,
+        low_watermark: int,
+        high_watermark: int,
+        horizon: float = 600,
+        default_rule: Optional[RetentionRule] = None,
+        check_interval: float = 10,
+    ) -> None:
+        """watermarks are free bytes. `horizon`: seconds of writing the free space must last"""
+        self.root = root
+        self.index_filepath = index_filepath
+        self.low_watermark = low_watermark
+        self.high_watermark = max(high_watermark, low_watermark)
+        self.horizon = horizon
+        self.default_rule = default_rule or RetentionRule()
+        self.check_interval = check_interval
+
+        self.lock = threading.Lock()
+        # one writer of the index file at a time
+        self.save_lock = threading.Lock()
+        # the index has changes that are not written yet
+        self.is_dirty = False
+        self.recordings: Dict[str, Recording] = {}
+        self.rules: Dict[str, RetentionRule] = {}
+        # channel: (bytes, time.monotonic()) of the last sample
+        self.samples: Dict[str, Tuple[float, float]] = {}
+        # channel: bytes per second
+        self.rates: Dict[str, float] = {}
+        self.free = 0
+        self.evicted_files = 0
+        self.evicted_bytes = 0
+        self.thread: Optional[threading.Thread] = None
+
+        self.load_index()
+
+    def set_rule(self, channel: str, rule: RetentionRule):
+        self.rules[channel] = rule
+
+    def get_rule(self, channel: str) -> RetentionRule:
+        return self.rules.get(channel, self.default_rule)
+
+    def load_index(self):
+        try:
+            with open(self.index_filepath, "r", encoding="utf8") as f:
+                items = json.load(f)
+        except FileNotFoundError:
+            self.scan()
+            return
+        except (OSError, ValueError) as e:
+            main_logger.warning("cannot read storage index %s: %s. scan %s", self.index_filepath, e, self.root)
+            self.scan()
+            return
+        for item in items:
+            recording = Recording(item["filepath"], item["channel"], item["size"], item["finished_at"])
+            self.recordings[recording.filepath] = recording
+        main_logger.info("storage index: %d recordings", len(self.recordings))
+
+    def scan(self):
+        """the only walk over the tree. the channel of these recordings is unknown"""
+        started_at = time.monotonic()
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if not filename.endswith(RECORDING_EXTNAMES) or ".tmp." in filename:
+                    continue
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(filepath)
+                except OSError:
+                    continue
+                self.recordings[filepath] = Recording(filepath, "", stat.st_size, stat.st_mtime)
+        main_logger.info("storage scan: %d recordings in %.1fs", len(self.recordings), time.monotonic() - started_at)
+        self.save_index()
+
+    def save_index(self):
+        with self.save_lock:
+            with self.lock:
+                self.is_dirty = False
+                items = [
+                    {
+                        "filepath": recording.filepath,
+                        "channel": recording.channel,
+                        "size": recording.size,
+                        "finished_at": recording.finished_at,
+                    }
+                    for recording in self.recordings.values()
+                ]
+            try:
+                os.makedirs(os.path.dirname(self.index_filepath) or ".", exist_ok=True)
+                write_json_atomic(self.index_filepath, items)
+            except OSError as e:
+                main_logger.warning("cannot write storage index %s: %s", self.index_filepath, e)
+                with self.lock:
+                    self.is_dirty = True
+
+    def save_index_if_dirty(self):
+        if self.is_dirty:
+            self.save_index()
+
+    def add(self, filepath: str, channel: str):
+        """a finished recording"""
+        try:
+            stat = os.stat(filepath)
+        except OSError:
+            return
+        with self.lock:
+            self.recordings[filepath] = Recording(filepath, channel, stat.st_size, stat.st_mtime)
+            self.is_dirty = True
+
+    def replace(self, source_filepath: str, output_filepath: str):
+        """a finished recording was remuxed. the source may be gone"""
+        with self.lock:
+            source = self.recordings.get(source_filepath)
+        self.add(output_filepath, source.channel if source else "")
+        if not os.path.exists(source_filepath):
+            self.discard(source_filepath)
+
+    def discard(self, filepath: str):
+        with self.lock:
+            if self.recordings.pop(filepath, None):
+                self.is_dirty = True
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="storage")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.save_index_if_dirty)
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception as e:
+                main_logger.error("storage check error: %s", e)
+            self.save_index_if_dirty()
+            time.sleep(self.check_interval)
+
+    def update_rates(self) -> float:
+        """bytes per second of all channels"""
+        now = time.monotonic()
+        for (channel,), value in RECORDING_BYTES.get_values().items():
+            last = self.samples.get(channel)
+            self.samples[channel] = (value, now)
+            if last is None or now <= last[1]:
+                continue
+            rate = (value - last[0]) / (now - last[1])
+            # smooth over a few checks. a channel that stopped drops to 0 quickly
+            self.rates[channel] = rate if rate == 0 else 0.5 * self.rates.get(channel, rate) + 0.5 * rate
+        return sum(self.rates.values())
+
+    def get_time_to_full(self, free: int, rate: float) -> Optional[float]:
+        """seconds until `low_watermark` is reached. None if nothing is written"""
+        if rate <= 0:
+            return None
+        return max(free - self.low_watermark, 0) / rate
+
+    def get_free(self) -> int:
+        return shutil.disk_usage(self.root).free
+
+    def check(self):
+        self.free = self.get_free()
+        rate = self.update_rates()
+        time_to_full = self.get_time_to_full(self.free, rate)
+        STORAGE_FREE_BYTES.set(self.free)
+        STORAGE_TIME_TO_FULL.set(time_to_full if time_to_full is not None else -1)
+
+        self.apply_retention()
+
+        if (time_to_full is not None and time_to_full < self.horizon) or self.free < self.low_watermark:
+            # the space the horizon needs, and the high watermark left at its end
+            needed = self.high_watermark + rate * self.horizon - self.free
+            main_logger.warning(
+                "%d bytes free, full in %ss at %.0f bytes/s. remove %d bytes of old recordings",
+                self.free,
+                None if time_to_full is None else round(time_to_full),
+                rate,
+                needed,
+            )
+            freed = self.evict_oldest(needed)
+            if freed < needed:
+                main_logger.error("only %d bytes could be removed. the volume fills up", freed)
+
+    def get_oldest_first(self) -> List[Recording]:
+        with self.lock:
+            return sorted(self.recordings.values(), key=lambda recording: (recording.finished_at, recording.filepath))
+
+    def apply_retention(self):
+        now = time.time()
+        expired = []
+        sizes: Dict[str, List[Recording]] = {}
+        recordings = self.get_oldest_first()
+        for recording in recordings:
+            rule = self.get_rule(recording.channel)
+            if rule.max_age and now - recording.finished_at > rule.max_age:
+                expired.append(recording)
+            elif recording.channel:
+                sizes.setdefault(recording.channel, []).append(recording)
+        for channel, channel_recordings in sizes.items():
+            rule = self.get_rule(channel)
+            if not rule.max_size:
+                continue
+            total = sum(recording.size for recording in channel_recordings)
+            for recording in channel_recordings:
+                if total <= rule.max_size:
+                    break
+                expired.append(recording)
+                total -= recording.size
+        for recording in expired:
+            self.evict(recording, "retention")
+
+    def evict_oldest(self, size: float) -> int:
+        freed = 0
+        recordings = self.get_oldest_first()
+        for recording in recordings:
+            if freed >= size:
+                break
+            freed += self.evict(recording, "low space")
+        return freed
+
+    def evict(self, recording: Recording, reason: str) -> int:
+        """returns the bytes freed"""
+        with self.lock:
+            self.recordings.pop(recording.filepath, None)
+            self.is_dirty = True
+        freed = 0
+        try:
+            freed = os.path.getsize(recording.filepath)
+            os.remove(recording.filepath)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            main_logger.error("cannot remove %s: %s", recording.filepath, e)
+        self.remove_orphaned_metadata(get_recording_base(recording.filepath))
+        if freed:
+            self.evicted_files += 1
+            self.evicted_bytes += freed
+            STORAGE_EVICTED.inc(freed, channel=recording.channel, reason=reason)
+            main_logger.info("removed %s (%s, %d bytes)", recording.filepath, reason, freed)
+        return freed
+
+    @staticmethod
+    def remove_orphaned_metadata(base: str):
+        """the metadata of a recording once none of its files is left. also one that is still recording"""
+        sidecar_filepaths = (f"{base}.json", f"{base}{JOURNAL_EXTNAME}")
+        if any(filepath not in sidecar_filepaths for filepath in glob.glob(f"{glob.escape(base)}*")):
+            return
+        for filepath in sidecar_filepaths:
+            try:
+                os.remove(filepath)
+            except OSError:
+                pass
+
+    def get_stats(self) -> dict:
+        rate = sum(self.rates.values())
+        with self.lock:
+            indexed_bytes = sum(recording.size for recording in self.recordings.values())
+            recordings = len(self.recordings)
+        return {
+            "free": self.free,
+            "bytes_per_second": round(rate),
+            "time_to_full": self.get_time_to_full(self.free, rate),
+            "recordings": recordings,
+            "indexed_bytes": indexed_bytes,
+            "evicted_files": self.evicted_files,
+            "evicted_bytes": self.evicted_bytes,
+        }
@@ -1,48 +1,33 @@
+import os
 import sys
+import argparse
 import json
-from typing import Optional
+import signal
+import threading
+from typing import Dict, Optional, Tuple
 
 from .logger import main_logger
-from .common import get_output_of_command, get_stdout_of_command
+from .common import get_output_of_command
 
-IS_INSTALL_STREAMLINK_PRINTED = False
 IS_GET_STREAM_INFO_PRINTED = False
 
+PROBE_ENGINE_SUBPROCESS = "subprocess"
+PROBE_ENGINE_SESSION = "session"
 
-def install_streamlink(streamlink_github=None, streamlink_commit=None, streamlink_version=None):
-    global IS_INSTALL_STREAMLINK_PRINTED
+SIDELOADED_PLUGIN_DIRS = ["/plugins", os.path.expanduser("~/.local/share/streamlink/plugins")]
 
-    command = [sys.executable, "-m", "pip", "install", "--upgrade", "--force-reinstall"]
 
-    if streamlink_github:
-        if not IS_INSTALL_STREAMLINK_PRINTED:
-            IS_INSTALL_STREAMLINK_PRINTED = True
-            main_logger.info("install streamlink from %s", streamlink_github)
-        command += [f"git+{streamlink_github}"]
-        return get_stdout_of_command(command)
+def get_stream_info(target_url: str, streamlink_args: Optional[str], engine: str = PROBE_ENGINE_SUBPROCESS):
+    if engine == PROBE_ENGINE_SESSION:
+        probe = get_session_probe(streamlink_args)
+        if probe is not None:
+            result_json = probe.get_stream_info(target_url)
+            if result_json is not None:
+                return result_json
+    return get_stream_info_by_subprocess(target_url, streamlink_args)
 
-    if streamlink_commit:
-        if not IS_INSTALL_STREAMLINK_PRINTED:
-            IS_INSTALL_STREAMLINK_PRINTED = True
-            main_logger.info("install streamlink from %s", streamlink_commit)
-        command += [f"git+https://github.com/streamlink/streamlink.git@{streamlink_commit}"]
-        return get_stdout_of_command(command)
 
-    if streamlink_version:
-        if not IS_INSTALL_STREAMLINK_PRINTED:
-            IS_INSTALL_STREAMLINK_PRINTED = True
-            main_logger.info("install streamlink %s", streamlink_version)
-        command += [f"streamlink=={streamlink_version}"]
-        return get_stdout_of_command(command)
-
-    if not IS_INSTALL_STREAMLINK_PRINTED:
-        IS_INSTALL_STREAMLINK_PRINTED = True
-        main_logger.info("install the latest streamlink")
-    command += ["streamlink"]
-    return get_stdout_of_command(command)
-
-
-def get_stream_info(target_url: str, streamlink_args: Optional[str]):
+def get_stream_info_by_subprocess(target_url: str, streamlink_args: Optional[str]):
     global IS_GET_STREAM_INFO_PRINTED
 
     command = [
@@ -70,8 +55,156 @@ def get_stream_info(target_url: str, streamlink_args: Optional[str]):
         main_logger.error("streamlink stream info json loads error: %s\n%s", result, e)
         return result_json
 
+    log_stream_info_error(result_json)
+    return result_json
+
+
+def log_stream_info_error(result_json: dict):
     error_message = result_json.get("error", "")
     if error_message and "No playable streams found" not in error_message:
         main_logger.warning(error_message)
 
-    return result_json
+
+def preload_streamlink_cli():
+    """import streamlink_cli from the main thread
+
+    streamlink_cli sets signal handlers on import, which fails in any other thread. The handlers are restored.
+    """
+    handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        # pylint: disable=import-outside-toplevel,unused-import
+        import streamlink_cli.main
+    except ImportError as e:
+        main_logger.warning("cannot import streamlink_cli: %s", e)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
+
+def create_streamlink_session(streamlink_args: Optional[str]):
+    """create a streamlink session configured the same way as `python -m streamlink <streamlink_args>`
+
+    returns a (session, cli_args) pair. `cli_args` is the parsed argument namespace of streamlink_cli.
+    """
+    # pylint: disable=import-outside-toplevel
+    from streamlink import Streamlink
+    from streamlink_cli import main as streamlink_cli_main
+
+    session = Streamlink()
+    for plugin_dir in SIDELOADED_PLUGIN_DIRS:
+        if os.path.isdir(plugin_dir):
+            session.plugins.load_path(plugin_dir)
+
+    parser = streamlink_cli_main.build_parser()
+    streamlink_cli_main.setup_plugin_args(session, parser)
+    cli_args = parser.parse_args([streamlink_args] if streamlink_args else [])
+    streamlink_cli_main.setup_session_options(session, cli_args)
+    return session, cli_args
+
+
+def create_plugin_options(cli_args, pluginname: str, pluginclass):
+    """the plugin options of `cli_args`, like setup_plugin_options() of streamlink_cli
+
+    setup_plugin_options() reads the module global `args` of streamlink_cli, which is shared by every channel and
+    thread. required arguments are not prompted for.
+    """
+    # pylint: disable=import-outside-toplevel
+    from streamlink.options import Options
+
+    arguments = list(pluginclass.arguments or [])
+    options = Options({parg.dest: parg.default for parg in arguments})
+    options.update(
+        {
+            parg.dest: getattr(cli_args, parg.namespace_dest(pluginname), None)
+            for parg in arguments
+            if parg.help != argparse.SUPPRESS
+        }
+    )
+    return options
+
+
+class StreamlinkSessionProbe:
+    """keeps one streamlink session alive and probes streams in-process
+
+    Plugins are resolved once per url and the http session (and its keep-alive connections) is reused,
+    so a probe costs a couple of http requests instead of a new python interpreter. probes of different channels
+    run at the same time; only the plugin cache is locked.
+    """
+
+    def __init__(self, streamlink_args: Optional[str]):
+        self.streamlink_args = streamlink_args
+        self.session, self.cli_args = create_streamlink_session(streamlink_args)
+        self.resolved_plugins: Dict[str, Tuple[str, type, str, object]] = {}
+        self.lock = threading.Lock()
+
+    def resolve_plugin(self, target_url: str):
+        with self.lock:
+            if target_url not in self.resolved_plugins:
+                pluginname, pluginclass, resolved_url = self.session.resolve_url(target_url)
+                options = create_plugin_options(self.cli_args, pluginname, pluginclass)
+                self.resolved_plugins[target_url] = (pluginname, pluginclass, resolved_url, options)
+            return self.resolved_plugins[target_url]
+
+    def get_streams(self, target_url: str) -> Tuple[str, object, dict]:
+        """(plugin name, plugin, streams). raises the errors of streamlink"""
+        pluginname, pluginclass, resolved_url, options = self.resolve_plugin(target_url)
+        plugin = pluginclass(self.session, resolved_url, options)
+        streams = plugin.streams(
+            stream_types=self.cli_args.stream_types,
+            sorting_excludes=self.cli_args.stream_sorting_excludes,
+        )
+        return pluginname, plugin, streams
+
+    def get_stream_info(self, target_url: str) -> Optional[dict]:
+        """returns the same dict as `streamlink --json`, or None if the probe itself failed"""
+        # pylint: disable=import-outside-toplevel
+        from streamlink import NoPluginError, PluginError
+
+        try:
+            pluginname, plugin, streams = self.get_streams(target_url)
+        except NoPluginError:
+            return {"error": f"No plugin can handle URL: {target_url}"}
+        except PluginError as e:
+            result_json = {"error": str(e)}
+            log_stream_info_error(result_json)
+            return result_json
+        except Exception as e:
+            main_logger.error("streamlink session probe error: %s", e)
+            return None
+
+        if not streams:
+            return {"error": f"No playable streams found on this URL: {target_url}"}
+
+        return {
+            "plugin": pluginname,
+            "metadata": plugin.get_metadata(),
+            "streams": {name: stream.__json__() for name, stream in streams.items()},
+        }
+
+
+_SESSION_PROBES: Dict[Tuple[Optional[str], tuple], Optional[StreamlinkSessionProbe]] = {}
+_SESSION_PROBES_LOCK = threading.Lock()
+
+
+def get_session_probe(
+    streamlink_args: Optional[str], session_options: Optional[Dict[str, object]] = None
+) -> Optional[StreamlinkSessionProbe]:
+    """one probe per distinct STREAMLINK_ARGS and `session_options`. returns None if the session cannot be created
+
+    `session_options` are set once on a session of their own, e.g. `ringbuffer-size` of the in-process fetcher.
+    the options of a session never change while its streams are probed or opened.
+    """
+    key = (streamlink_args, tuple(sorted((session_options or {}).items())))
+    with _SESSION_PROBES_LOCK:
+        if key not in _SESSION_PROBES:
+            try:
+                probe = StreamlinkSessionProbe(streamlink_args)
+                for name, value in key[1]:
+                    probe.session.set_option(name, value)
+                _SESSION_PROBES[key] = probe
+                main_logger.info("streamlink session probe is ready")
+            except (Exception, SystemExit) as e:
+                # argparse exits on unknown arguments
+                main_logger.warning("cannot create streamlink session probe. fallback to subprocess: %s", e)
+                _SESSION_PROBES[key] = None
+        return _SESSION_PROBES[key]
@@ -0,0 +1,242 @@
+# fetch a stream through the streamlink python api inside the recorder
+#
+# replaces `python -m streamlink -O <url> <stream>`: no second interpreter, no second plugin load,
+# and the data goes from streamlink's ring buffer straight into the output (ffmpeg's stdin or a file).
+# streams are opened from a streamlink session of the probe (see util/stream.py). a fetcher with reader options
+# (ring buffer size, live edge) gets a session of its own with these options.
+
+import threading
+import time
+from typing import Callable, Optional
+
+from .logger import main_logger
+from .stream import get_session_probe
+
+
+class StreamFetchException(Exception):
+    pass
+
+
+# internals of streamlink's RingBuffer and FilteredStream which readinto() uses. any streamlink version can be
+# installed (STREAMLINK_VERSION, ...), so they are checked before use and read() is used if one is missing
+_RING_BUFFER_ATTRIBUTES = ("buffer_lock", "current_chunk", "chunks", "length", "closed", "event_used", "_check_events")
+_READER_ATTRIBUTES = ("writer", "timeout")
+
+
+def get_readinto(stream_fd) -> Optional[Callable[[memoryview], int]]:
+    """`readinto` for the segmented readers of streamlink (hls, dash), which only have `read`
+
+    read() joins the chunks of the ring buffer into a new bytes object. this copies them into the caller's buffer.
+    None if the reader is of another kind, has its own read(), or the internals differ from the known ones.
+    """
+    # pylint: disable=import-outside-toplevel,protected-access
+    try:
+        from streamlink.buffers import Chunk, RingBuffer
+        from streamlink.stream.filtered import FilteredStream
+        from streamlink.stream.segmented import SegmentedStreamReader
+    except ImportError:
+        return None
+
+    if not isinstance(stream_fd, SegmentedStreamReader) or type(stream_fd.buffer) is not RingBuffer:
+        return None
+    if type(stream_fd).read not in (SegmentedStreamReader.read, FilteredStream.read):
+        return None
+    buffer = stream_fd.buffer
+    is_supported = (
+        all(hasattr(buffer, name) for name in _RING_BUFFER_ATTRIBUTES)
+        and all(hasattr(stream_fd, name) for name in _READER_ATTRIBUTES)
+        and hasattr(Chunk, "readinto")
+        and hasattr(Chunk, "empty")
+        and (not isinstance(stream_fd, FilteredStream) or hasattr(stream_fd, "_event_filter"))
+    )
+    if not is_supported:
+        main_logger.info("streamlink's ring buffer is not the known one. read the stream with read()")
+        return None
+
+    def read_buffer(view: memoryview) -> int:
+        # RingBuffer.read()
+        if stream_fd.writer.is_alive() and not buffer.closed:
+            if not buffer.event_used.wait(stream_fd.timeout) and buffer.length == 0:
+                raise OSError("Read timeout")
+        with buffer.buffer_lock:
+            size = 0
+            while size < len(view) and (buffer.current_chunk or buffer.chunks):
+                chunk = buffer.current_chunk or Chunk(buffer.chunks.popleft())
+                size += chunk.readinto(view[size:])
+                buffer.current_chunk = None if chunk.empty else chunk
+            buffer.length -= size
+            buffer._check_events()
+        return size
+
+    def readinto(view: memoryview) -> int:
+        # FilteredStream.read(): reads wait while the stream is filtered (e.g. ads of twitch)
+        while True:
+            try:
+                return read_buffer(view)
+            except OSError:
+                if not isinstance(stream_fd, FilteredStream):
+                    raise
+                stream_fd._event_filter.wait()
+                if buffer.closed:
+                    return 0
+                if buffer.length > 0:
+                    continue
+                raise
+
+    return readinto
+
+
+class StreamFetcher:
+    def __init__(
+        self,
+        target_url: str,
+        target_stream: str,
+        streamlink_args: Optional[str],
+        chunk_size: int = 1024 * 1024,
+        readahead_size: Optional[int] = None,
+        bytes_counter=None,
+        live_edge: Optional[int] = None,
+        prepare_reader: Optional[Callable] = None,
+    ) -> None:
+        """
+        `chunk_size`: bytes read from streamlink and written to the output at once
+        `readahead_size`: size of streamlink's ring buffer. streamlink's default is used if None
+        `bytes_counter`: a bound metrics counter which is increased by the bytes written
+        `live_edge`: number of segments from the end of a live hls playlist to start with (hls-live-edge)
+        `prepare_reader`: called with streamlink's hls reader before it is opened
+        """
+        self.target_url = target_url
+        self.target_stream = target_stream
+        self.streamlink_args = streamlink_args
+        self.chunk_size = chunk_size
+        self.readahead_size = readahead_size
+        self.bytes_counter = bytes_counter
+        self.live_edge = live_edge
+        self.prepare_reader = prepare_reader
+
+        self.stream_name: Optional[str] = None
+        self.stream_fd = None
+        self.is_closed = False
+
+        self.bytes_written = 0
+        self.started_at: Optional[float] = None
+        self.first_byte_at: Optional[float] = None
+        self.ended_at: Optional[float] = None
+        self.cpu_seconds = 0.0
+
+    def open(self):
+        options = {}
+        if self.readahead_size:
+            options["ringbuffer-size"] = self.readahead_size
+        if self.live_edge:
+            options["hls-live-edge"] = self.live_edge
+        probe = get_session_probe(self.streamlink_args, options)
+        if probe is None:
+            raise StreamFetchException(f"cannot create a streamlink session of {self.streamlink_args}")
+
+        # pylint: disable=import-outside-toplevel
+        from streamlink.stream.hls import HLSStream
+
+        _, _, streams = probe.get_streams(self.target_url)
+        if not streams:
+            raise StreamFetchException(f"No playable streams found on this URL: {self.target_url}")
+
+        # same as the cli: the first available stream of a comma separated list
+        for stream_name in self.target_stream.split(","):
+            stream_name = stream_name.strip()
+            if stream_name in streams:
+                self.stream_name = stream_name
+                break
+        else:
+            raise StreamFetchException(
+                f"The specified stream(s) '{self.target_stream}' could not be found. available: {list(streams)}"
+            )
+
+        main_logger.info("open stream %s of %s", self.stream_name, self.target_url)
+        stream = streams[self.stream_name]
+        if self.prepare_reader and isinstance(stream, HLSStream) and type(stream).open is HLSStream.open:
+            # the same as HLSStream.open()
+            self.stream_fd = stream.__reader__(stream)
+            self.prepare_reader(self.stream_fd)
+            self.stream_fd.open()
+        else:
+            self.stream_fd = stream.open()
+        self.started_at = time.monotonic()
+
+    def close(self):
+        self.is_closed = True
+        if self.stream_fd is not None:
+            try:
+                self.stream_fd.close()
+            except Exception as e:
+                main_logger.warning("cannot close stream: %s", e)
+
+    def pump(self, write: Callable[[bytes], None]):
+        """read the stream until it ends and pass every chunk to `write`
+
+        a chunk can be a view of a buffer which is reused for the next one. `write` copies what it keeps.
+        """
+        cpu_started_at = time.thread_time()
+        readinto = get_readinto(self.stream_fd)
+        view = memoryview(bytearray(self.chunk_size)) if readinto else None
+        try:
+            while not self.is_closed:
+                try:
+                    data = view[: readinto(view)] if readinto else self.stream_fd.read(self.chunk_size)
+                except OSError as e:
+                    main_logger.warning("stream read error: %s", e)
+                    break
+                except (AttributeError, TypeError) as e:
+                    if readinto is None:
+                        raise
+                    main_logger.warning("cannot read into the buffer: %s. read the stream with read()", e)
+                    readinto = None
+                    continue
+                if not data:
+                    break
+
+                if self.first_byte_at is None:
+                    self.first_byte_at = time.monotonic()
+                write(data)
+                self.bytes_written += len(data)
+                if self.bytes_counter:
+                    self.bytes_counter.inc(len(data))
+        except (BrokenPipeError, ValueError):
+            # the output is closed (ffmpeg exited)
+            main_logger.warning("stream output is closed")
+        finally:
+            self.ended_at = time.monotonic()
+            self.cpu_seconds = time.thread_time() - cpu_started_at
+            self.close()
+
+    def pump_to_pipe(self, pipe):
+        """pump into a binary pipe and close it at the end, so the reader sees EOF"""
+        # text mode pipes (universal_newlines) expose the binary pipe as `.buffer`
+        binary_pipe = getattr(pipe, "buffer", pipe)
+        try:
+            self.pump(binary_pipe.write)
+        finally:
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def start_pump_thread(self, pipe) -> threading.Thread:
+        thread = threading.Thread(
+            target=self.pump_to_pipe, args=(pipe,), name=f"{threading.current_thread().name}-fetch"
+        )
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def get_stats(self) -> dict:
+        ended_at = self.ended_at or time.monotonic()
+        elapsed = ended_at - self.started_at if self.started_at else 0
+        return {
+            "stream": self.stream_name,
+            "bytes_written": self.bytes_written,
+            "elapsed": elapsed,
+            "bytes_per_second": self.bytes_written / elapsed if elapsed else 0,
+            "time_to_first_byte": self.first_byte_at - self.started_at if self.first_byte_at else None,
+            "cpu_seconds": self.cpu_seconds,
+        }
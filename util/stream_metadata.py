@@ -2,28 +2,47 @@ import threading
 import time
 import traceback
 import logging
-from datetime import datetime, timezone
-from copy import deepcopy
-from typing import List, Tuple
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
 
-from .event import Publisher, Subscriber
-from .common import safe_get
-from .stream import get_stream_info
+from .event import DROP_OLDEST, Publisher, Subscriber
+from .common import KeyPath
+from .stream import get_stream_info, PROBE_ENGINE_SUBPROCESS
+from .probe_scheduler import ProbeScheduler
+from .metadata_history import MetadataHistory, MetadataRecord
+from .metrics import PROBE_DURATION, STREAM_TRANSITIONS
+from .profiling import Profiler
 from .logger import main_logger
 
 logger = logging.getLogger()
 
 
+ERROR = KeyPath("error")
+PLUGIN = KeyPath("plugin")
+STREAMS = KeyPath("streams")
+METADATA_ID = KeyPath("metadata", "id")
+METADATA_AUTHOR = KeyPath("metadata", "author")
+METADATA_CATEGORY = KeyPath("metadata", "category")
+METADATA_TITLE = KeyPath("metadata", "title")
+
+
 def is_online(stream_info: dict):
-    return safe_get(stream_info, "error") is None and safe_get(stream_info, ["metadata", "id"]) is not None
+    return ERROR(stream_info) is None and METADATA_ID(stream_info) is not None
+
+
+def is_probe_error(stream_info: dict):
+    if not stream_info:
+        return True
+    error_message = ERROR(stream_info)
+    return error_message is not None and "No playable streams found" not in error_message
 
 
 def parse_metadata_from_stream_info(stream_info: dict) -> tuple:
-    plugin = safe_get(stream_info, ["plugin"])
-    metadata_id = safe_get(stream_info, ["metadata", "id"])
-    metadata_author = safe_get(stream_info, ["metadata", "author"])
-    metadata_category = safe_get(stream_info, ["metadata", "category"])
-    metadata_title = safe_get(stream_info, ["metadata", "title"])
+    plugin = PLUGIN(stream_info)
+    metadata_id = METADATA_ID(stream_info)
+    metadata_author = METADATA_AUTHOR(stream_info)
+    metadata_category = METADATA_CATEGORY(stream_info)
+    metadata_title = METADATA_TITLE(stream_info)
     return (plugin, metadata_id, metadata_author, metadata_category, metadata_title)
 
 
@@ -32,13 +51,15 @@ class StreamMetadata:
     target_url: str
     streamlink_args: str
     check_interval: float
+    probe_engine: str
+    probe_slots: Optional[threading.Semaphore]
+    scheduler: ProbeScheduler
+    name: str
+    # time.monotonic() of the last online transition
+    online_at: Optional[float] = None
     is_stop = False
     is_online = False
     thread = None
-    stack = []
-    stack_raw = []
-    last_stack = []
-    last_stack_raw = []
 
     def __init__(
         self,
@@ -46,8 +67,15 @@ class StreamMetadata:
         streamlink_args: str,
         check_interval: float,
         subscribers: List[Tuple[Subscriber, str]] = None,
+        probe_engine: str = PROBE_ENGINE_SUBPROCESS,
+        probe_slots: Optional[threading.Semaphore] = None,
+        name: Optional[str] = None,
+        scheduler: Optional[ProbeScheduler] = None,
+        profiler: Optional[Profiler] = None,
+        max_history: int = 0,
     ) -> None:
-        self.publisher = Publisher()
+        """`max_history`: metadata changes kept per broadcast. 0 is no limit"""
+        self.publisher = Publisher(name)
         if subscribers:
             for subscriber, topic in subscribers:
                 self.add_subscriber(subscriber, topic)
@@ -55,126 +83,176 @@ class StreamMetadata:
         self.target_url = target_url
         self.streamlink_args = streamlink_args
         self.check_interval = check_interval
-        self.thread = threading.Thread(target=self.set_metadata_loop)
+        self.probe_engine = probe_engine
+        self.name = name or "default"
+        self.probe_duration = PROBE_DURATION.labels(channel=self.name, engine=probe_engine)
+        # shared between channels to limit concurrent probes
+        self.probe_slots = probe_slots or nullcontext()
+        self.scheduler = scheduler or ProbeScheduler(check_interval)
+        self.profiler = profiler
+        self.wakeup = threading.Event()
+        self.max_history = max_history
+        # the metadata changes of the current broadcast, empty while offline
+        self.history = MetadataHistory(max_history)
+        # the current or the last broadcast
+        self.last_history = self.history
+        # the last online stream_info, updated by every probe
+        self.latest_stream_info: Optional[dict] = None
+        # the same, kept after the offline transition. the only raw payload kept
+        self.last_stream_info: Optional[dict] = None
+        self.probe_count = 0
+        self.probe_done = threading.Condition()
+        self.thread = threading.Thread(
+            target=self.set_metadata_loop,
+            name=f"{name}-metadata" if name else None,
+        )
         self.thread.daemon = True
         self.thread.start()
 
     def __del__(self):
         self.destroy()
 
-    def add_subscriber(self, subscriber: Subscriber, topic: str):
-        self.publisher.subscribe(subscriber, topic)
+    def add_subscriber(self, subscriber: Subscriber, topic: str, policy: str = DROP_OLDEST):
+        self.publisher.subscribe(subscriber, topic, policy)
 
     def remove_subscriber(self, subscriber: Subscriber, topic: str):
         self.publisher.unsubscribe(subscriber, topic)
 
-    def destroy(self):
+    def destroy(self, wait: bool = True):
+        """stops the probe thread. `wait=False` does not wait for a running probe"""
         self.is_stop = True
-        if self.thread is not None:
+        self.wakeup.set()
+        # __del__ can run in the probe thread itself once it dropped the last reference
+        if wait and self.thread is not None and self.thread is not threading.current_thread():
             self.thread.join()
 
+    @property
+    def next_probe_at(self) -> Optional[float]:
+        return self.scheduler.next_probe_at
+
+    def probe_now(self):
+        """wake up the loop to probe without waiting for the schedule"""
+        self.wakeup.set()
+
+    def wait_for_next_probe(self, timeout: float, delay: float = 0) -> bool:
+        """probe after `delay` seconds and wait until it is done. False on timeout"""
+        with self.probe_done:
+            probe_count = self.probe_count
+        if delay:
+            time.sleep(delay)
+        self.probe_now()
+        with self.probe_done:
+            return self.probe_done.wait_for(lambda: self.probe_count > probe_count, timeout)
+
     def set_metadata_loop(self):
         while not self.is_stop:
-            if self.is_online:
-                time.sleep(self.check_interval)
             self.set_metadata()
-            time.sleep(self.check_interval)
+            # updates the event queue metrics
+            self.publisher.get_stats()
+            self.wakeup.wait(self.scheduler.schedule_next())
+            self.wakeup.clear()
 
     def set_metadata(self):
         try:
-            stream_info = get_stream_info(self.target_url, self.streamlink_args)
+            with self.profiler.section(f"{self.name}-probe") if self.profiler else nullcontext():
+                self.update_metadata()
+        finally:
+            with self.probe_done:
+                self.probe_count += 1
+                self.probe_done.notify_all()
+
+    def probe(self) -> dict:
+        with self.probe_slots:
+            probe_started_at = time.monotonic()
+            stream_info = get_stream_info(self.target_url, self.streamlink_args, engine=self.probe_engine)
+            self.probe_duration.observe(time.monotonic() - probe_started_at)
+        return stream_info
+
+    def update_metadata(self):
+        try:
+            stream_info = self.probe()
             current_is_online = is_online(stream_info)
+            self.scheduler.record_probe(current_is_online, is_probe_error(stream_info))
 
             if not current_is_online:
                 if self.is_online:
                     main_logger.info("now stream goes to offline")
-                    self.last_stack = self.stack
-                    self.last_stack_raw = self.stack_raw
+                    STREAM_TRANSITIONS.inc(channel=self.name, state="offline")
+                    self.last_history = self.history
                     self.publisher.publish("is_online", False)
-                self.stack = []
-                self.stack_raw = []
+                if len(self.history):
+                    self.history = MetadataHistory(self.max_history)
+                self.latest_stream_info = None
                 self.is_online = current_is_online
                 return
 
             # current_is_online is True
+            self.latest_stream_info = stream_info
+            self.last_stream_info = stream_info
 
             if not self.is_online:
                 # new stream starts
                 main_logger.info("now stream goes to online")
-                self.stack = []
-                self.stack_raw = []
-                self.last_stack = []
-                self.last_stack_raw = []
+                STREAM_TRANSITIONS.inc(channel=self.name, state="online")
+                self.online_at = time.monotonic()
+                self.history = MetadataHistory(self.max_history)
+                self.last_history = self.history
                 self.publisher.publish("is_online", True)
 
             self.is_online = current_is_online
 
-            (plugin, metadata_id, metadata_author, metadata_category, metadata_title) = parse_metadata_from_stream_info(
+            plugin, metadata_id, metadata_author, metadata_category, metadata_title = parse_metadata_from_stream_info(
                 stream_info
             )
 
-            if not self.stack:
-                self.stack_raw.append(stream_info)
-                self.stack.append(
-                    {
-                        "plugin": plugin,
-                        "id": metadata_id,
-                        "author": metadata_author,
-                        "category": metadata_category,
-                        "title": metadata_title,
-                        "timestamp": datetime.now(timezone.utc).astimezone().strftime("%Y%m%dT%H%M%S%z"),
-                        "datetime": datetime.now().strftime("%Y%m%d_%H%M%S"),
-                    }
-                )
-                self.last_stack = self.stack
-                self.last_stack_raw = self.stack_raw
-                self.publisher.publish("stream_info", stream_info)
-                return
-
-            latest_metadata = self.stack[-1]
-            if (
-                latest_metadata["plugin"] == plugin
-                and latest_metadata["id"] == metadata_id
-                and latest_metadata["author"] == metadata_author
-                and latest_metadata["category"] == metadata_category
-                and latest_metadata["title"] == metadata_title
-            ):
+            record = self.history.add(plugin, metadata_id, metadata_author, metadata_category, metadata_title)
+            if record is None:
                 return
-
-            self.stack_raw.append(stream_info)
-            self.stack.append(
-                {
-                    "plugin": plugin,
-                    "id": metadata_id,
-                    "author": metadata_author,
-                    "category": metadata_category,
-                    "title": metadata_title,
-                    "timestamp": datetime.now(timezone.utc).astimezone().strftime("%Y%m%dT%H%M%S%z"),
-                    "datetime": datetime.now().strftime("%Y%m%d_%H%M%S"),
-                }
-            )
-            self.last_stack = self.stack
-            self.last_stack_raw = self.stack_raw
+            self.last_history = self.history
             self.publisher.publish("stream_info", stream_info)
-            main_logger.info("update metadata: %s", self.stack[-1])
+            if record.position > 0:
+                main_logger.info("update metadata: %s", record.to_dict())
         except Exception as e:
             main_logger.error(e)
             main_logger.error(traceback.format_exc())
 
+    def get_last_record(self) -> Optional[MetadataRecord]:
+        """the latest metadata of the current or the last broadcast. not copied, do not change it"""
+        return self.last_history.latest
+
+    def get_current_record(self) -> Optional[MetadataRecord]:
+        """the latest metadata of the current broadcast. not copied, do not change it"""
+        return self.history.latest
+
     def get_last_metadata(self) -> dict:
-        if not self.last_stack:
-            return {}
-        return deepcopy(self.last_stack[-1])
+        record = self.get_last_record()
+        return record.to_dict() if record else {}
 
     def get_current_metadata(self) -> dict:
-        if not self.stack:
-            return {}
-        return deepcopy(self.stack[-1])
+        record = self.get_current_record()
+        return record.to_dict() if record else {}
+
+    def get_state(self) -> dict:
+        """for the stack dump of util/profiling.py"""
+        return {
+            "target_url": self.target_url,
+            "is_online": self.is_online,
+            "online_at": self.online_at,
+            "probe_count": self.probe_count,
+            "scheduler": self.scheduler.get_stats(),
+            "history": len(self.history),
+            "history_dropped": self.history.dropped,
+            "last_history": len(self.last_history),
+            "current_metadata": self.get_current_metadata() or None,
+            "last_metadata": self.get_last_metadata() or None,
+            "stream_types": self.get_stream_types(),
+            "events": self.publisher.get_stats(),
+        }
 
     def get_stream_types(self) -> List[str]:
-        if not self.last_stack_raw:
+        metadata = self.latest_stream_info or self.last_stream_info
+        if not metadata:
             return []
-        metadata = self.last_stack_raw[-1]
-        streams_dict = safe_get(metadata, ["streams"], {})
-        streams_types = streams_dict.keys()
+        streams_dict = STREAMS(metadata, {})
+        streams_types = list(streams_dict.keys())
         return streams_types
@@ -0,0 +1,143 @@
+# run many channels from one process
+#
+# each channel runs its own pipeline (metadata thread + download loop) in its own thread.
+# an exception in one channel restarts only that channel.
+
+import json
+import threading
+import time
+import traceback
+from typing import Callable, List, Optional
+
+from .logger import main_logger
+
+
+class Channel:
+    def __init__(
+        self,
+        name: str,
+        target_url: str,
+        target_stream: str,
+        streamlink_args: str,
+        filepath_template: str,
+        check_interval: float,
+        retention_days: float = 0,
+        retention_size: float = 0,
+    ) -> None:
+        """`retention_days` and `retention_size` (GiB): finished recordings past these are removed. 0 is no limit"""
+        self.name = name
+        self.target_url = target_url
+        self.target_stream = target_stream
+        self.streamlink_args = streamlink_args
+        self.filepath_template = filepath_template
+        self.check_interval = check_interval
+        self.retention_days = retention_days
+        self.retention_size = retention_size
+
+    def __repr__(self) -> str:
+        return f"Channel({self.name}, {self.target_url})"
+
+
+def load_channels(
+    filepath: str,
+    target_stream: str,
+    streamlink_args: str,
+    filepath_template: str,
+    check_interval: float,
+    retention_days: float = 0,
+    retention_size: float = 0,
+) -> List[Channel]:
+    """read channels from a json file
+
+    The file is a list of objects which use the same keys as the environment variables.
+    Missing keys fall back to the given defaults.
+
+    ```json
+    [
+        {"NAME": "twitch-hanryang1125", "TARGET_URL": "https://www.twitch.tv/hanryang1125", "TARGET_STREAM": "best"}
+    ]
+    ```
+    """
+    with open(filepath, "r", encoding="utf8") as f:
+        items = json.load(f)
+
+    channels = []
+    names = set()
+    for item in items:
+        target_url = item.get("TARGET_URL")
+        if not target_url:
+            main_logger.warning("TARGET_URL is not set. skip channel: %s", item)
+            continue
+
+        name = item.get("NAME") or target_url.rstrip("/").split("/")[-1]
+        if name in names:
+            main_logger.warning("duplicated channel name. skip channel: %s", name)
+            continue
+        names.add(name)
+
+        channels.append(
+            Channel(
+                name,
+                target_url,
+                item.get("TARGET_STREAM") or target_stream,
+                item.get("STREAMLINK_ARGS", streamlink_args),
+                item.get("FILEPATH_TEMPLATE") or filepath_template,
+                float(item.get("CHECK_INTERVAL") or check_interval),
+                float(item.get("RETENTION_DAYS", retention_days)),
+                float(item.get("RETENTION_SIZE", retention_size)),
+            )
+        )
+    return channels
+
+
+class Supervisor:
+    """keeps one `run_channel(channel)` thread alive per channel"""
+
+    def __init__(
+        self,
+        channels: List[Channel],
+        run_channel: Callable[[Channel], None],
+        restart_interval: float = 15,
+        max_restart_interval: float = 600,
+    ) -> None:
+        self.channels = channels
+        self.run_channel = run_channel
+        self.restart_interval = restart_interval
+        self.max_restart_interval = max_restart_interval
+        self.threads: List[threading.Thread] = []
+        self.restart_counts = {channel.name: 0 for channel in channels}
+
+    def run_channel_forever(self, channel: Channel):
+        restart_interval = self.restart_interval
+        while True:
+            started_at = time.monotonic()
+            try:
+                main_logger.info("start channel %s", channel)
+                self.run_channel(channel)
+                main_logger.warning("channel %s returned", channel)
+            except Exception as e:
+                main_logger.error("channel %s crashed: %s", channel, e)
+                main_logger.error(traceback.format_exc())
+
+            self.restart_counts[channel.name] += 1
+            # a channel that ran for a while starts again quickly. a crash loop backs off.
+            if time.monotonic() - started_at > self.max_restart_interval:
+                restart_interval = self.restart_interval
+            time.sleep(restart_interval)
+            restart_interval = min(restart_interval * 2, self.max_restart_interval)
+
+    def start(self):
+        for channel in self.channels:
+            thread = threading.Thread(target=self.run_channel_forever, args=(channel,), name=channel.name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+        main_logger.info("supervisor started %d channels", len(self.threads))
+
+    def join(self, timeout: Optional[float] = None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+    def run(self):
+        self.start()
+        self.join()
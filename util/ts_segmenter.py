@@ -0,0 +1,440 @@
+# native mpeg-ts segmenter
+#
+# does what `ffmpeg -i - -c copy -f segment -segment_time N <filepath> part%d.ts` does for a plain mpeg-ts input:
+# packets are copied as they are and a new file starts at the first keyframe after `segment_duration`.
+#
+# - a file is cut right before the PAT which precedes the keyframe (hls segments start with PAT, PMT, keyframe).
+#   packets from a PAT within `CUT_LOOKAHEAD` of the segment duration are held until the next frame shows whether
+#   the file is cut there, so they move to the new file. if there is no such PAT the last PAT and PMT are repeated
+#   at the start of the new file.
+#   a repeated packet keeps its continuity counter, which is a valid duplicate packet for the decoder.
+# - timestamps are not rewritten. the segment length is measured with wrap-around and jump safe DTS/PTS deltas.
+# - every file starts with an SDT: the title is the service name, as in ffmpeg, and the author is the provider
+#   (ffmpeg writes its `service_provider` option there, "FFmpeg" by default).
+
+import threading
+import time
+from typing import BinaryIO, Callable, List, Optional
+
+from .logger import main_logger
+from .common import truncate_string_in_byte_size
+
+PACKET_SIZE = 188
+SYNC_BYTE = 0x47
+PAT_PID = 0x0000
+SDT_PID = 0x0011
+
+PTS_CLOCK = 90000
+PTS_WRAP = 1 << 33
+# a larger jump between two PTS is treated as a discontinuity
+PTS_MAX_JUMP = 10 * PTS_CLOCK
+# packets held while waiting for the keyframe after a PAT
+MAX_HOLD_SIZE = 4 * 1024 * 1024
+# a PAT this close to the segment duration may precede the keyframe of the cut
+CUT_LOOKAHEAD = 1 * PTS_CLOCK
+
+STREAM_TYPE_MPEG2_VIDEO = 0x02
+STREAM_TYPE_H264 = 0x1B
+STREAM_TYPE_HEVC = 0x24
+VIDEO_STREAM_TYPES = (STREAM_TYPE_MPEG2_VIDEO, STREAM_TYPE_H264, STREAM_TYPE_HEVC)
+
+
+def _make_crc32_table() -> List[int]:
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else (crc << 1)
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_CRC32_TABLE = _make_crc32_table()
+
+
+def crc32_mpeg2(data: bytes) -> int:
+    crc = 0xFFFFFFFF
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC32_TABLE[((crc >> 24) ^ byte) & 0xFF]
+    return crc
+
+
+def encode_dvb_string(value: str, size: int) -> bytes:
+    encoded = value.encode("utf8")
+    if len(encoded) == len(value):
+        return encoded[:size]
+    # 0x15: the rest of the string is utf-8
+    return b"\x15" + truncate_string_in_byte_size(value, size - 4).encode("utf8")
+
+
+def make_sdt_packet(service_id: int, provider: str, name: str, continuity_counter: int = 0) -> bytes:
+    provider_bytes = encode_dvb_string(provider or "", 32)
+    # the packet is 30 bytes + provider + name
+    name_bytes = encode_dvb_string(name or "", 182 - 24 - len(provider_bytes))
+
+    descriptor = bytes([0x48, 3 + len(provider_bytes) + len(name_bytes), 0x01, len(provider_bytes)])
+    descriptor += provider_bytes + bytes([len(name_bytes)]) + name_bytes
+
+    service = service_id.to_bytes(2, "big") + bytes([0xFC])
+    # running_status: running (4), free_CA_mode: 0
+    service += ((4 << 13) | len(descriptor)).to_bytes(2, "big") + descriptor
+
+    # transport_stream_id, version 0 + current, section_number, last_section_number, original_network_id, reserved
+    body = b"\x00\x01" + b"\xc1\x00\x00" + b"\xff\x01" + b"\xff" + service
+    section = bytes([0x42]) + (0xF000 | (len(body) + 4)).to_bytes(2, "big") + body
+    section += crc32_mpeg2(section).to_bytes(4, "big")
+
+    header = bytes([SYNC_BYTE, 0x40 | (SDT_PID >> 8), SDT_PID & 0xFF, 0x10 | (continuity_counter & 0x0F), 0x00])
+    packet = header + section
+    assert len(packet) <= PACKET_SIZE
+    return packet + b"\xff" * (PACKET_SIZE - len(packet))
+
+
+def get_payload_offset(packet, offset: int = 0) -> Optional[int]:
+    """offset of the payload in `packet[offset:]`, None if the packet has no payload"""
+    adaptation_field_control = (packet[offset + 3] >> 4) & 0x3
+    if not adaptation_field_control & 0x1:
+        return None
+    payload_offset = offset + 4
+    if adaptation_field_control & 0x2:
+        payload_offset += 1 + packet[offset + 4]
+    if payload_offset >= offset + PACKET_SIZE:
+        return None
+    return payload_offset
+
+
+def get_section(packet, offset: int = 0) -> Optional[bytes]:
+    """psi section which starts in this packet (payload_unit_start_indicator set)"""
+    payload_offset = get_payload_offset(packet, offset)
+    if payload_offset is None:
+        return None
+    section_offset = payload_offset + 1 + packet[payload_offset]
+    end = offset + PACKET_SIZE
+    if section_offset + 3 > end:
+        return None
+    section_length = ((packet[section_offset + 1] & 0x0F) << 8) | packet[section_offset + 2]
+    return bytes(packet[section_offset : min(section_offset + 3 + section_length, end)])
+
+
+def parse_pat(section: bytes) -> Optional[tuple]:
+    """returns (program_number, pmt_pid) of the first program"""
+    if not section or section[0] != 0x00:
+        return None
+    # skip the 8 byte header. the last 4 bytes are crc
+    for i in range(8, len(section) - 4 - 3, 4):
+        program_number = (section[i] << 8) | section[i + 1]
+        pid = ((section[i + 2] & 0x1F) << 8) | section[i + 3]
+        if program_number != 0:
+            return (program_number, pid)
+    return None
+
+
+def parse_pmt(section: bytes) -> List[tuple]:
+    """returns [(stream_type, pid), ...]"""
+    if not section or section[0] != 0x02 or len(section) < 12:
+        return []
+    program_info_length = ((section[10] & 0x0F) << 8) | section[11]
+    streams = []
+    i = 12 + program_info_length
+    while i + 5 <= len(section) - 4:
+        stream_type = section[i]
+        pid = ((section[i + 1] & 0x1F) << 8) | section[i + 2]
+        es_info_length = ((section[i + 3] & 0x0F) << 8) | section[i + 4]
+        streams.append((stream_type, pid))
+        i += 5 + es_info_length
+    return streams
+
+
+def parse_pes_start(packet, offset: int, stream_type: Optional[int]) -> tuple:
+    """returns (timestamp, is_keyframe) of the pes which starts in this packet
+
+    The timestamp is the DTS if there is one, because PTS is not monotonic with b-frames.
+    """
+    adaptation_field_control = (packet[offset + 3] >> 4) & 0x3
+    random_access = adaptation_field_control & 0x2 and packet[offset + 4] > 0 and packet[offset + 5] & 0x40
+
+    payload_offset = get_payload_offset(packet, offset)
+    end = offset + PACKET_SIZE
+    if payload_offset is None or payload_offset + 9 > end:
+        return (None, bool(random_access))
+    if packet[payload_offset : payload_offset + 3] != b"\x00\x00\x01":
+        return (None, bool(random_access))
+
+    pts = None
+    pts_dts_flags = packet[payload_offset + 7] >> 6
+    if pts_dts_flags & 0x2 and payload_offset + 14 <= end:
+        # DTS follows PTS
+        p = payload_offset + 14 if pts_dts_flags == 0x3 and payload_offset + 19 <= end else payload_offset + 9
+        pts = (
+            ((packet[p] >> 1) & 0x07) << 30
+            | packet[p + 1] << 22
+            | (packet[p + 2] >> 1) << 15
+            | packet[p + 3] << 7
+            | packet[p + 4] >> 1
+        )
+
+    if random_access or stream_type not in VIDEO_STREAM_TYPES:
+        # audio frames are all keyframes
+        return (pts, True)
+
+    # look for an idr / irap nal unit (or the parameter sets in front of it) in this packet
+    es_offset = payload_offset + 9 + packet[payload_offset + 8]
+    es = bytes(packet[es_offset:end])
+    start = es.find(b"\x00\x00\x01")
+    while 0 <= start < len(es) - 3:
+        nal_header = es[start + 3]
+        if stream_type == STREAM_TYPE_H264 and nal_header & 0x1F in (5, 7):
+            return (pts, True)
+        if stream_type == STREAM_TYPE_HEVC and (
+            16 <= (nal_header >> 1) & 0x3F <= 23 or (nal_header >> 1) & 0x3F in (32, 33)
+        ):
+            return (pts, True)
+        if stream_type == STREAM_TYPE_MPEG2_VIDEO and nal_header == 0xB3:
+            return (pts, True)
+        start = es.find(b"\x00\x00\x01", start + 3)
+    return (pts, False)
+
+
+class TSSegmenter:
+    def __init__(
+        self,
+        filepath: str,
+        segment_duration: Optional[float],
+        title: Optional[str] = None,
+        artist: Optional[str] = None,
+        genre: Optional[str] = None,
+        date: Optional[str] = None,
+        on_segment_closed: Optional[Callable[[str], None]] = None,
+        bytes_counter=None,
+        on_first_byte: Optional[Callable[[], None]] = None,
+        open_file: Optional[Callable[[str], BinaryIO]] = None,
+    ) -> None:
+        """
+        `filepath`: the output path without extension. files are named `<filepath> part<n>.ts`,
+        or `<filepath>.ts` if `segment_duration` is None.
+        `genre` and `date` are kept for parity with the ffmpeg command. mpeg-ts has no field for them,
+        and ffmpeg does not write them into .ts either. They are in the `.json` sidecar.
+        `on_first_byte` is called once the first byte is written to the disk.
+        `open_file` opens a segment file for writing, e.g. util/segment_writer.py. a buffered `open()` by default.
+        """
+        self.filepath = filepath
+        self.segment_duration = segment_duration * PTS_CLOCK if segment_duration else None
+        self.title = title
+        self.artist = artist
+        self.genre = genre
+        self.date = date
+        self.on_segment_closed = on_segment_closed
+        self.bytes_counter = bytes_counter
+        self.on_first_byte = on_first_byte
+        self.open_file = open_file
+
+        self.lock = threading.Lock()
+        self.remainder = b""
+        self.file: Optional[BinaryIO] = None
+        self.segment_number = 0
+        self.segment_filepaths: List[str] = []
+
+        self.service_id = 1
+        self.pmt_pid: Optional[int] = None
+        self.timing_pid: Optional[int] = None
+        self.timing_stream_type: Optional[int] = None
+        self.last_pat: Optional[bytes] = None
+        self.last_pmt: Optional[bytes] = None
+
+        self.last_pts: Optional[int] = None
+        self.segment_elapsed = 0
+        self.is_cut_pending = False
+        self.held: Optional[bytearray] = None
+
+        self.bytes_written = 0
+        self.bytes_dropped = 0
+        self.first_byte_at: Optional[float] = None
+        self.is_closed = False
+
+    def get_segment_filepath(self, segment_number: int) -> str:
+        if self.segment_duration is None:
+            return f"{self.filepath}.ts"
+        return f"{self.filepath} part{segment_number}.ts"
+
+    def open_segment_file(self, filepath: str) -> BinaryIO:
+        if self.open_file:
+            return self.open_file(filepath)
+        return open(filepath, "wb", buffering=1024 * 1024)
+
+    def next_segment(self, prefix: bytes = b""):
+        self.close_segment()
+        self.segment_number += 1
+        filepath = self.get_segment_filepath(self.segment_number)
+        main_logger.info("open segment %s", filepath)
+        self.file = self.open_segment_file(filepath)
+        self.segment_filepaths.append(filepath)
+        self.segment_elapsed = 0
+        self.is_cut_pending = False
+        self.emit(make_sdt_packet(self.service_id, self.artist, self.title))
+        if prefix:
+            self.emit(prefix)
+
+    def close_segment(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if self.on_segment_closed:
+            try:
+                self.on_segment_closed(self.segment_filepaths[-1])
+            except Exception as e:
+                main_logger.error("segment closed callback error: %s", e)
+
+    def emit(self, data):
+        if not data:
+            return
+        if self.held is not None:
+            self.held += data
+            if len(self.held) > MAX_HOLD_SIZE:
+                self.release_held()
+            return
+        if self.file is None:
+            self.next_segment()
+        self.file.write(data)
+        self.bytes_written += len(data)
+        if self.bytes_counter:
+            self.bytes_counter.inc(len(data))
+        if self.first_byte_at is None:
+            # do not keep the first bytes in the buffer. the recording is only started once they are on the disk
+            self.file.flush()
+            self.first_byte_at = time.monotonic()
+            if self.on_first_byte:
+                self.on_first_byte()
+
+    def release_held(self):
+        held, self.held = self.held, None
+        self.emit(held)
+
+    def update_elapsed(self, pts: int):
+        if self.last_pts is not None:
+            delta = (pts - self.last_pts) % PTS_WRAP
+            if delta <= PTS_MAX_JUMP:
+                self.segment_elapsed += delta
+        self.last_pts = pts
+        if self.segment_duration is not None and self.segment_elapsed >= self.segment_duration:
+            self.is_cut_pending = True
+
+    def is_cut_near(self) -> bool:
+        return self.segment_duration is not None and self.segment_elapsed + CUT_LOOKAHEAD >= self.segment_duration
+
+    def handle_psi(self, buffer, offset: int, pid: int):
+        section = get_section(buffer, offset)
+        if pid == PAT_PID:
+            self.last_pat = bytes(buffer[offset : offset + PACKET_SIZE])
+            program = parse_pat(section)
+            if program:
+                self.service_id, self.pmt_pid = program
+            return
+
+        self.last_pmt = bytes(buffer[offset : offset + PACKET_SIZE])
+        streams = parse_pmt(section)
+        if not streams:
+            return
+        video_streams = [stream for stream in streams if stream[0] in VIDEO_STREAM_TYPES]
+        self.timing_stream_type, self.timing_pid = (video_streams or streams)[0]
+
+    def write(self, data: bytes):
+        with self.lock:
+            if self.is_closed:
+                raise ValueError("write to closed segmenter")
+            if self.remainder:
+                data = self.remainder + data
+            buffer = memoryview(data)
+            size = len(buffer)
+            flush_from = 0
+            offset = 0
+
+            while offset + PACKET_SIZE <= size:
+                if buffer[offset] != SYNC_BYTE:
+                    self.emit(buffer[flush_from:offset])
+                    next_offset = self.resync(bytes(buffer), offset)
+                    self.bytes_dropped += next_offset - offset
+                    offset = flush_from = next_offset
+                    continue
+
+                header1 = buffer[offset + 1]
+                pid = ((header1 & 0x1F) << 8) | buffer[offset + 2]
+                is_unit_start = header1 & 0x40
+
+                if pid == SDT_PID:
+                    # our own SDT is written at the start of each file
+                    self.emit(buffer[flush_from:offset])
+                    flush_from = offset + PACKET_SIZE
+                elif pid == PAT_PID or pid == self.pmt_pid:
+                    if is_unit_start:
+                        self.handle_psi(buffer, offset, pid)
+                    if pid == PAT_PID and self.held is None and self.is_cut_near():
+                        # hold from this PAT until we know whether a keyframe follows
+                        self.emit(buffer[flush_from:offset])
+                        flush_from = offset
+                        self.held = bytearray()
+                elif pid == self.timing_pid and is_unit_start:
+                    pts, is_keyframe = parse_pes_start(buffer, offset, self.timing_stream_type)
+                    if pts is not None:
+                        self.update_elapsed(pts)
+                    if self.is_cut_pending and is_keyframe:
+                        self.emit(buffer[flush_from:offset])
+                        flush_from = offset
+                        if self.held is not None:
+                            held, self.held = self.held, None
+                            self.next_segment(bytes(held))
+                        else:
+                            self.next_segment((self.last_pat or b"") + (self.last_pmt or b""))
+                    elif self.held is not None:
+                        self.emit(buffer[flush_from:offset])
+                        flush_from = offset
+                        self.release_held()
+
+                offset += PACKET_SIZE
+
+            self.emit(buffer[flush_from:offset])
+            self.remainder = bytes(buffer[offset:])
+
+    def resync(self, data: bytes, offset: int) -> int:
+        """find the next offset where two packets in a row start with the sync byte"""
+        size = len(data)
+        position = data.find(bytes([SYNC_BYTE]), offset + 1)
+        while position != -1:
+            if position + PACKET_SIZE >= size or data[position + PACKET_SIZE] == SYNC_BYTE:
+                return position
+            position = data.find(bytes([SYNC_BYTE]), position + 1)
+        return size
+
+    def close(self):
+        with self.lock:
+            if self.is_closed:
+                return
+            self.is_closed = True
+            if self.held is not None:
+                self.release_held()
+            self.close_segment()
+
+    def get_segment_duration(self) -> float:
+        """seconds of the current segment, also from `on_segment_closed`"""
+        return self.segment_elapsed / PTS_CLOCK
+
+    def get_stats(self) -> dict:
+        return {
+            "segments": len(self.segment_filepaths),
+            "bytes_written": self.bytes_written,
+            "bytes_dropped": self.bytes_dropped,
+        }
+
+
+def pump_pipe_to_segmenter(pipe: BinaryIO, segmenter: TSSegmenter, chunk_size: int = 1024 * 1024):
+    """copy a pipe (streamlink's stdout) into the segmenter until EOF, then close it"""
+    try:
+        while True:
+            data = pipe.read1(chunk_size) if hasattr(pipe, "read1") else pipe.read(chunk_size)
+            if not data:
+                break
+            segmenter.write(data)
+    except (OSError, ValueError) as e:
+        main_logger.warning("segmenter pipe error: %s", e)
+    finally:
+        segmenter.close()